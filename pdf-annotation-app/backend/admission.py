@@ -0,0 +1,181 @@
+"""
+Admission control for the heavy rendering endpoints.
+
+Each heavy endpoint sits behind a Gate that allows a limited number of
+requests to run at once and caps the summed cost estimate of the
+running requests (roughly: document megabytes plus annotation count, see
+app.estimate_render_cost). Requests that don't fit wait in a bounded
+FIFO queue; when the queue is full, or a request has waited longer than
+the gate's timeout, it is turned away with 429 and a Retry-After based
+on recent service times. Light endpoints (health, fonts, ...) are never
+gated, so they keep answering while renders are queued.
+
+Gate.stats() reports running, queued and rejected counts for /api/metrics.
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import jsonify, request
+
+# Weight of the latest request in the moving average of service times
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Raised when a gate cannot admit a request"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Gate:
+    """Concurrency, cost and queue limits for one endpoint"""
+
+    def __init__(self, name, max_concurrent, max_cost, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_cost = max_cost
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.in_flight_cost = 0.0
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.peak_queue_depth = 0
+        self.avg_service_seconds = 0.0
+        self._waiting = deque()
+        self._condition = threading.Condition()
+
+    def _fits(self, cost):
+        # A request larger than max_cost still runs, alone, so it can't starve
+        return self.running < self.max_concurrent and (
+            self.running == 0 or self.in_flight_cost + cost <= self.max_cost)
+
+    def retry_after(self):
+        """Seconds a rejected client should wait, from queue depth and recent service times"""
+        backlog = (len(self._waiting) + self.running) / max(self.max_concurrent, 1)
+        return max(1, int(round(backlog * max(self.avg_service_seconds, 1.0))))
+
+    @contextmanager
+    def admit(self, cost):
+        with self._condition:
+            if self._waiting or not self._fits(cost):
+                if len(self._waiting) >= self.max_queue:
+                    self.rejected_full += 1
+                    raise AdmissionRejected(f'Too many {self.name} requests queued', self.retry_after())
+
+                ticket = object()
+                self._waiting.append(ticket)
+                self.peak_queue_depth = max(self.peak_queue_depth, len(self._waiting))
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while not (self._waiting[0] is ticket and self._fits(cost)):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.rejected_timeout += 1
+                            raise AdmissionRejected(
+                                f'Timed out after {self.queue_timeout:g}s waiting for a {self.name} slot',
+                                self.retry_after())
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting.remove(ticket)
+                    self._condition.notify_all()
+
+            self.running += 1
+            self.in_flight_cost += cost
+            self.admitted += 1
+
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start_time
+            with self._condition:
+                self.running -= 1
+                self.in_flight_cost -= cost
+                self.avg_service_seconds += SERVICE_TIME_SMOOTHING * (elapsed - self.avg_service_seconds)
+                self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'running': self.running,
+                'queue_depth': len(self._waiting),
+                'peak_queue_depth': self.peak_queue_depth,
+                'in_flight_cost': round(self.in_flight_cost, 2),
+                'max_concurrent': self.max_concurrent,
+                'max_cost': self.max_cost,
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_full,
+                'rejected_timeout': self.rejected_timeout,
+                'avg_service_ms': round(self.avg_service_seconds * 1000, 1),
+            }
+
+
+class AdmissionController:
+    """Named gates sharing default limits (ADMISSION_* environment variables)"""
+
+    def __init__(self, max_concurrent, max_cost, max_queue, queue_timeout):
+        self.defaults = {
+            'max_concurrent': max_concurrent,
+            'max_cost': max_cost,
+            'max_queue': max_queue,
+            'queue_timeout': queue_timeout,
+        }
+        self.gates = {}
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            max_concurrent=int(os.environ.get('ADMISSION_MAX_CONCURRENT', os.cpu_count() or 2)),
+            max_cost=float(os.environ.get('ADMISSION_MAX_COST', 256)),
+            max_queue=int(os.environ.get('ADMISSION_QUEUE_SIZE', 32)),
+            queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 15)),
+        )
+
+    def gate(self, name, **limits):
+        """Create (or return) the gate for name; limits override the defaults"""
+        if name not in self.gates:
+            settings = dict(self.defaults)
+            settings.update({key: value for key, value in limits.items() if value is not None})
+            self.gates[name] = Gate(name, **settings)
+        return self.gates[name]
+
+    def limit(self, name, cost=None, **limits):
+        """
+        Route decorator: run the view only once the named gate admits it.
+        cost is a callable returning the request's cost estimate (default 1).
+        If it fails, the request costs 1 and the view reports the problem
+        with the request itself.
+        """
+        gate = self.gate(name, **limits)
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                request_cost = 1
+                if cost:
+                    try:
+                        request_cost = cost()
+                    except Exception as e:
+                        print(f"  Warning: No cost estimate for {request.path}: {e}")
+                try:
+                    with gate.admit(request_cost):
+                        return view(*args, **kwargs)
+                except AdmissionRejected as e:
+                    print(f"Rejected {request.path}: {e}")
+                    response = jsonify({'error': str(e)})
+                    response.headers['Retry-After'] = str(e.retry_after)
+                    return response, 429
+            return wrapper
+        return decorator
+
+    def stats(self):
+        return {name: gate.stats() for name, gate in self.gates.items()}
@@ -0,0 +1,240 @@
+"""
+Columnar encoding of annotation lists, for the msgpack wire format.
+
+As JSON, every annotation repeats every key ('fontFamily', 'borderColor',
+...) and usually the same handful of style values. A columnar message
+stores each key once, with one column of values per key:
+
+- numeric columns (x, y, width, height, page, fontSize, ...) as packed
+  little-endian arrays: 'i32' when every value is an int that fits,
+  otherwise 'f64'
+- low-cardinality columns (fonts, colors, flags) dictionary-encoded: the
+  distinct values once, then one 'u16'/'u32' id per annotation
+- anything else as a plain list of values
+
+An annotation that lacks a key is id 0 in a dictionary column (values
+are numbered from 1) or is listed in the column's 'absent' indexes, so
+decoding gives back exactly the keys each annotation had. A numeric
+column never has gaps; a key missing somewhere falls back to the other
+encodings.
+
+    {'format': 'columnar', 'version': 1, 'count': n, 'keys': [...],
+     'columns': {key: {'type': 'f64' | 'i32', 'data': bytes}
+                      | {'type': 'dict', 'values': [...], 'ids': 'u16' | 'u32', 'data': bytes}
+                      | {'type': 'list', 'values': [...], 'absent': [index, ...]}}}
+
+Nothing in here depends on Flask; msgpack itself is optional and only
+needed by pack() and unpack(). Messages come from clients, so a
+malformed one raises ValueError rather than whatever lookup failed.
+"""
+import sys
+from array import array
+from functools import partial
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/msgpack', 'application/vnd.msgpack')
+
+COLUMNAR_FORMAT = 'columnar'
+COLUMNAR_VERSION = 1
+
+# A column is dictionary-encoded when it has at most this many distinct values,
+# or when its distinct values are at most this fraction of the rows
+DICTIONARY_MAX_VALUES = 256
+DICTIONARY_MAX_FRACTION = 0.25
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+# Most annotations one message may hold; columns bound the count anyway, except when there are none
+MAX_ANNOTATIONS = 1000000
+
+# array typecodes of the wire types (all little-endian on the wire)
+ARRAY_TYPES = {'f64': 'd', 'i32': 'i', 'u16': 'H', 'u32': 'I'}
+
+_ABSENT = object()
+
+
+def msgpack_available():
+    return msgpack is not None
+
+def pack(value):
+    """Serialize a message to msgpack bytes"""
+    if msgpack is None:
+        raise RuntimeError('msgpack is not installed')
+    return msgpack.packb(value, use_bin_type=True)
+
+def unpack(data):
+    """Deserialize msgpack bytes"""
+    if msgpack is None:
+        raise RuntimeError('msgpack is not installed')
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def _to_bytes(values, wire_type):
+    packed = array(ARRAY_TYPES[wire_type], values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def _from_bytes(data, wire_type):
+    values = array(ARRAY_TYPES[wire_type])
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist()
+
+def _numeric_type(values):
+    """'i32' or 'f64' if every value is a number, else None"""
+    all_ints = True
+    for value in values:
+        value_type = type(value)
+        if value_type is int:
+            if all_ints and not INT32_MIN <= value <= INT32_MAX:
+                all_ints = False
+        elif value_type is float:
+            all_ints = False
+        else:
+            return None
+    return 'i32' if all_ints else 'f64'
+
+def _encode_column(values):
+    count = len(values)
+    wire_type = _numeric_type(values) if count else None
+    if wire_type:
+        return {'type': wire_type, 'data': _to_bytes(values, wire_type)}
+
+    # True, 1 and 1.0 are the same dict key, so a column mixing them can't be dictionary-encoded
+    mixed_numbers = len({type(value) for value in values} & {bool, int, float}) > 1
+    ids = {}
+    try:
+        for value in values:
+            if mixed_numbers:
+                break
+            if value is not _ABSENT and value not in ids:
+                ids[value] = len(ids) + 1
+                if len(ids) > DICTIONARY_MAX_VALUES and len(ids) > count * DICTIONARY_MAX_FRACTION:
+                    break
+        else:
+            id_type = 'u16' if len(ids) < 2 ** 16 else 'u32'
+            return {
+                'type': 'dict',
+                'values': list(ids),
+                'ids': id_type,
+                'data': _to_bytes([0 if value is _ABSENT else ids[value] for value in values], id_type),
+            }
+    except TypeError:
+        pass  # Unhashable values (lists, dicts) are stored as a plain list
+
+    return {
+        'type': 'list',
+        'values': [None if value is _ABSENT else value for value in values],
+        'absent': [index for index, value in enumerate(values) if value is _ABSENT],
+    }
+
+def encode_annotations(annotations):
+    """Encode a list of annotation dicts as a columnar message"""
+    keys = {}
+    for annotation in annotations:
+        for key in annotation:
+            keys[key] = None
+    keys = list(keys)
+
+    columns = {}
+    for key in keys:
+        columns[key] = _encode_column([annotation.get(key, _ABSENT) for annotation in annotations])
+
+    return {
+        'format': COLUMNAR_FORMAT,
+        'version': COLUMNAR_VERSION,
+        'count': len(annotations),
+        'keys': keys,
+        'columns': columns,
+    }
+
+
+def is_columnar(value):
+    return isinstance(value, dict) and value.get('format') == COLUMNAR_FORMAT
+
+def count_annotations(value):
+    """Number of annotations in a list or columnar message (0 for anything else)"""
+    if isinstance(value, list):
+        return len(value)
+    if is_columnar(value):
+        count = value.get('count', 0)
+        return count if type(count) is int and count > 0 else 0
+    return 0
+
+def _decode_column(column, count):
+    """Column values as a list, plus the indexes of annotations without the key"""
+    if not isinstance(column, dict):
+        raise ValueError('Column must be a map')
+    column_type = column.get('type')
+    try:
+        if column_type in ('f64', 'i32'):
+            values = _from_bytes(column['data'], column_type)
+            absent = []
+        elif column_type == 'dict':
+            if column['ids'] not in ('u16', 'u32'):
+                raise ValueError(f"Unknown id type {column['ids']!r}")
+            ids = _from_bytes(column['data'], column['ids'])
+            lookup = [_ABSENT] + list(column['values'])
+            values = list(map(lookup.__getitem__, ids))
+            absent = [index for index, i in enumerate(ids) if i == 0] if 0 in ids else []
+        elif column_type == 'list':
+            values = list(column['values'])
+            absent = list(column.get('absent', []))
+        else:
+            raise ValueError(f'Unknown column type {column_type!r}')
+    except (KeyError, IndexError, TypeError) as e:
+        # Missing fields, ids past the end of the values, data that isn't bytes
+        raise ValueError(f'Malformed {column_type} column: {e!r}') from None
+
+    if len(values) != count:
+        raise ValueError(f'Column has {len(values)} values, expected {count}')
+    if absent and (len(set(absent)) != len(absent)
+                   or not all(type(index) is int and 0 <= index < count for index in absent)):
+        raise ValueError('Column has invalid absent indexes')
+    return values, absent
+
+def decode_annotations(value):
+    """
+    Annotation dicts from a columnar message. A plain list is returned as is,
+    so request handlers can accept either form.
+    """
+    if isinstance(value, list):
+        return value
+    if not is_columnar(value):
+        raise ValueError('Annotations must be a list or a columnar message')
+    if value.get('version', 0) > COLUMNAR_VERSION:
+        raise ValueError(f"Columnar version {value.get('version')} is not supported")
+
+    count = value.get('count')
+    keys = value.get('keys')
+    column_map = value.get('columns')
+    if type(count) is not int or not 0 <= count <= MAX_ANNOTATIONS:
+        raise ValueError(f'Columnar count must be an integer from 0 to {MAX_ANNOTATIONS}')
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys) or len(set(keys)) != len(keys):
+        raise ValueError('Columnar keys must be a list of distinct strings')
+    if not isinstance(column_map, dict) or any(key not in column_map for key in keys):
+        raise ValueError('Columnar message must have a column for every key')
+
+    columns = []
+    absent_by_key = []
+    for key in keys:
+        values, absent = _decode_column(column_map[key], count)
+        columns.append(values)
+        if absent:
+            absent_by_key.append((key, absent))
+
+    if keys:
+        annotations = list(map(dict, map(partial(zip, keys), zip(*columns))))
+    else:
+        annotations = [{} for _ in range(count)]
+    for key, absent in absent_by_key:
+        for index in absent:
+            del annotations[index][key]
+    return annotations
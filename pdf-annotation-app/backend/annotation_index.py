@@ -0,0 +1,190 @@
+"""
+Spatial index over a project's annotations.
+
+Annotations are bucketed by page, and each page gets a uniform grid of
+cells (in page points, web convention: top-left origin) listing the
+boxes that touch each cell. Queries only visit the cells under the
+query rectangle, so their cost follows the number of results rather
+than the number of annotations in the document. Boxes too large to be
+worth spreading over many cells are kept in a short per-page list that
+every query checks.
+
+Indexes are immutable; build a new one when the annotations change.
+AnnotationIndexCache keeps recently used indexes keyed by project id and
+a version (e.g. the project file's modification time).
+"""
+import math
+import threading
+from collections import OrderedDict
+
+from renderer import group_annotations_by_page
+
+# Grid cell size in points; a Letter page is about 10 x 13 cells
+DEFAULT_CELL_SIZE = 64
+
+# Boxes covering more cells than this are checked on every query instead
+MAX_CELLS_PER_BOX = 64
+
+
+def annotation_box(annotation):
+    """(x0, y0, x1, y1) of an annotation, with the same defaults the renderer uses"""
+    x = float(annotation.get('x', 0))
+    y = float(annotation.get('y', 0))
+    width = float(annotation.get('width', 100))
+    height = float(annotation.get('height', 20))
+    return (x, y, x + width, y + height)
+
+def boxes_intersect(a, b):
+    """True if two boxes overlap or touch"""
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def intersection_box(a, b):
+    return (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+
+
+class PageGrid:
+    """Uniform grid over the annotation boxes of one page"""
+
+    def __init__(self, annotations, cell_size=DEFAULT_CELL_SIZE):
+        self.annotations = annotations
+        self.cell_size = cell_size
+        self.boxes = [annotation_box(ann) for ann in annotations]
+        self.cells = {}
+        self.oversized = []
+
+        for i, box in enumerate(self.boxes):
+            if not all(math.isfinite(v) for v in box):
+                # Can't be placed in a cell; comparisons still work for inf, and nan matches nothing
+                self.oversized.append(i)
+                continue
+            cells = self._cell_range(box)
+            if len(cells[0]) * len(cells[1]) > MAX_CELLS_PER_BOX:
+                self.oversized.append(i)
+                continue
+            for cx in cells[0]:
+                for cy in cells[1]:
+                    self.cells.setdefault((cx, cy), []).append(i)
+
+    def _cell_range(self, box):
+        size = self.cell_size
+        return (range(int(box[0] // size), int(box[2] // size) + 1),
+                range(int(box[1] // size), int(box[3] // size) + 1))
+
+    def query(self, rect):
+        """Indexes (in page order) of the boxes intersecting rect"""
+        if not all(math.isfinite(v) for v in rect):
+            # An unbounded box (only ever a stored annotation's) can't be mapped to cells
+            return [i for i, box in enumerate(self.boxes) if boxes_intersect(box, rect)]
+        xs, ys = self._cell_range(rect)
+        if len(xs) * len(ys) > len(self.cells):
+            # Rectangle covers most of the page: walking the occupied cells is cheaper
+            candidates = {i for cell in self.cells.values() for i in cell}
+        else:
+            candidates = set()
+            for cx in xs:
+                for cy in ys:
+                    candidates.update(self.cells.get((cx, cy), ()))
+        candidates.update(self.oversized)
+        return sorted(i for i in candidates if boxes_intersect(self.boxes[i], rect))
+
+    def overlapping_pairs(self):
+        """Yield (i, j) with i < j for every pair of boxes that overlap with a positive area"""
+        seen = set()
+
+        def candidate_pairs():
+            for members in self.cells.values():
+                for pos, i in enumerate(members):
+                    for j in members[pos + 1:]:
+                        yield i, j
+            for i in self.oversized:
+                for j in self.query(self.boxes[i]):
+                    if j != i:
+                        yield i, j
+
+        for i, j in candidate_pairs():
+            pair = (i, j) if i < j else (j, i)
+            if pair in seen:
+                continue
+            a, b = self.boxes[i], self.boxes[j]
+            if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                seen.add(pair)
+                yield pair
+
+
+class AnnotationIndex:
+    """Annotations bucketed by page, with a lazily built grid per page"""
+
+    def __init__(self, annotations, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.count = len(annotations)
+        self.by_page = group_annotations_by_page(annotations)
+        self._grids = {}
+        self._lock = threading.Lock()
+
+    def pages(self):
+        return sorted(self.by_page)
+
+    def on_page(self, page):
+        """All annotations on a page, in their original order"""
+        return self.by_page.get(page, [])
+
+    def grid(self, page):
+        with self._lock:
+            grid = self._grids.get(page)
+            if grid is None:
+                grid = PageGrid(self.on_page(page), self.cell_size)
+                self._grids[page] = grid
+            return grid
+
+    def query(self, page, x, y, width=0, height=0):
+        """Annotations on page intersecting the rectangle (or point, with zero size)"""
+        grid = self.grid(page)
+        return [grid.annotations[i] for i in grid.query((x, y, x + width, y + height))]
+
+    def overlaps(self, page=None):
+        """
+        Pairs of overlapping annotations as dicts with both ids and the
+        shared area, for one page or the whole document.
+        """
+        results = []
+        for page_num in ([page] if page is not None else self.pages()):
+            grid = self.grid(page_num)
+            for i, j in grid.overlapping_pairs():
+                shared = intersection_box(grid.boxes[i], grid.boxes[j])
+                results.append({
+                    'page': page_num,
+                    'first': grid.annotations[i].get('id'),
+                    'second': grid.annotations[j].get('id'),
+                    'intersection': {
+                        'x': shared[0],
+                        'y': shared[1],
+                        'width': shared[2] - shared[0],
+                        'height': shared[3] - shared[1],
+                    },
+                })
+        return results
+
+
+class AnnotationIndexCache:
+    """Small LRU of built indexes keyed by project id, invalidated by a version value"""
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, load_annotations):
+        """Return the index for key at version, building it from load_annotations() if needed"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        index = AnnotationIndex(load_annotations())
+        with self._lock:
+            self._entries[key] = (version, index)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
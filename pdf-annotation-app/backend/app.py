@@ -1,433 +1,144 @@
 import glob
 import platform
 import sys
-from datetime import datetime
-import uuid
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfbase import pdfmetrics
-from reportlab.lib.colors import HexColor, toColor
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from pypdf import PdfReader, PdfWriter
 from io import BytesIO
 import base64
-import pickle
 import json
+import math
 import os
+import re
+import tempfile
+import time
 from flask_cors import CORS
-from flask import Flask, request, jsonify, send_file
-import glob
-import glob
+from flask import Flask, Response, g, request, jsonify, send_file
+
+# Importing the font tables registers the bundled fonts, so that happens at startup rather than on the first request
+from renderer import (FONT_FAMILY_MAP, AVAILABLE_FONT_FAMILIES, FONT_TABLE_VERSION, GLYPH_COVERAGE, fallback_fonts,
+                      generate_annotated_pdf, map_font_family, render_pages)
+from pdf_optimize import linearize_pdf
+from image_optimize import normalize_image_options
+from annotation_codec import count_annotations, encode_annotations
+from request_memory import (MB, MemoryBudget, buffer_size, load_request_body, msgpack_response, peek_request_body,
+                            take_base64_payload, wants_msgpack)
+from admission import AdmissionController
+from profiling import RequestProfiler, annotate
+from autosave import WriteBehindBuffer
+from document_cache import DocumentCache, document_hash
+from overlay_cache import RenderCache, hash_json
+from annotation_index import AnnotationIndex, AnnotationIndexCache
+from thumbnails import DEFAULT_THUMBNAIL_SIZE, MAX_THUMBNAIL_SIZE, MIN_THUMBNAIL_SIZE, ThumbnailService
+from search_index import open_search_index
+from project_bundle import BundleError, import_bundle, iter_bundle
+from project_store import DEFAULT_PROJECTS_FOLDER, ProjectData, open_project_store
+from mail_merge import MergeTemplate, detect_data_format, iter_rows, merge_to_single_pdf, merge_to_zip
 
 # Force stdout to flush immediately
 sys.stdout.reconfigure(line_buffering=True)
 
 app = Flask(__name__)
 CORS(app, origins=['http://localhost:3000', 'http://127.0.0.1:3000', 'http://localhost:3001', 'http://127.0.0.1:3001'], 
-     allow_headers=['Content-Type'], 
+     allow_headers=['Content-Type', 'Range', 'X-Profile-Token'], 
+     expose_headers=['X-Size-Before', 'X-Size-After', 'X-Images-Replaced', 'X-Image-Bytes-Saved', 'X-Document-Hash',
+                     'X-Render-Time-Ms', 'X-Cache', 'Retry-After', 'X-Profile-Id', 'X-Merged-Rows',
+                     'Accept-Ranges', 'Content-Range', 'Content-Length', 'ETag'],
      methods=['GET', 'POST', 'OPTIONS'])
 
-def register_system_fonts():
-    """
-    Register fonts from bundled fonts directory ONLY.
-    Returns a dict mapping font family names to registered font identifiers.
-    Also returns a list of available font families for the frontend.
-    """
-    bundled_fonts_dir = os.path.join(os.path.dirname(__file__), 'fonts')
-    
-    if not os.path.isdir(bundled_fonts_dir):
-        print(f"WARNING: Bundled fonts directory not found: {bundled_fonts_dir}")
-        print("Creating directory. Please add .ttf font files to this directory.")
-        os.makedirs(bundled_fonts_dir, exist_ok=True)
-        return {}, []
-    
-    print(f"Loading bundled fonts from: {bundled_fonts_dir}")
-    
-    # Font family name mappings (display name -> filename patterns)
-    # This maps friendly names to the actual font filenames
-    font_family_patterns = {
-        # Liberation Fonts (core fonts)
-        'Arial': ['liberationsans-regular', 'liberationsans-bold', 'liberationsans-italic', 'liberationsans-bolditalic'],
-        'Times New Roman': ['liberationserif-regular', 'liberationserif-bold', 'liberationserif-italic', 'liberationserif-bolditalic'],
-        'Courier New': ['liberationmono-regular', 'liberationmono-bold', 'liberationmono-italic', 'liberationmono-bolditalic'],
-        
-        # Google Fonts and others
-        'Roboto': ['roboto-variablefont', 'roboto-italic-variablefont'],
-        'Open Sans': ['opensans-variablefont', 'opensans-italic-variablefont'],
-        'Lato': ['lato-regular', 'lato-bold', 'lato-italic', 'lato-bolditalic', 'lato-black', 'lato-blackitalic', 'lato-light', 'lato-lightitalic'],
-        'Merriweather': ['merriweather-variablefont', 'merriweather-italic-variablefont'],
-        'Montserrat': ['montserrat-variablefont', 'montserrat-italic-variablefont'],
-        'Source Code Pro': ['sourcecodepro-variablefont', 'sourcecodepro-italic-variablefont'],
-        'Saira': ['saira-variablefont', 'saira-italic-variablefont'],
-        
-        # Script/Handwriting fonts
-        'Caveat': ['caveat-variablefont'],
-        'Dancing Script': ['dancingscript-variablefont'],
-        'Pacifico': ['pacifico-regular'],
-        'Great Vibes': ['greatvibes-regular'],
-        'Parisienne': ['parisienne-regular'],
-        'Shadows Into Light': ['shadowsintolight-regular'],
-        'Berkshire Swash': ['berkshireswash-regular'],
-        
-        # Signature fonts
-        'Momo Signature': ['momosignature-regular'],
-        'Are You Serious': ['areyouserious-regular'],
-        
-        # Display/Decorative fonts
-        'Lobster': ['lobster-regular', 'lobstertwo-regular', 'lobstertwo-bold', 'lobstertwo-italic', 'lobstertwo-bolditalic'],
-        'Anton': ['anton-regular'],
-        'Fjalla One': ['fjallaone-regular'],
-        'Gravitas One': ['gravitasone-regular'],
-        'Orbitron': ['orbitron-variablefont'],
-        'Michroma': ['michroma-regular'],
-        'Creepster': ['creepster-regular'],
-        'Sixtyfour': ['sixtyfour-regular-variablefont'],
-    }
-
-    registered_fonts = {}  # Maps registered name to font path
-    font_family_map = {}   # Maps font family name to list of registered variants
-    available_families = []  # List of font families available for frontend
-    
-    # Find all font files in bundled directory only
-    font_files_to_scan = []
-    font_files_to_scan.extend(glob.glob(os.path.join(bundled_fonts_dir, "*.ttf")))
-    font_files_to_scan.extend(glob.glob(os.path.join(bundled_fonts_dir, "*.ttc")))
-
-    print(f"Found {len(font_files_to_scan)} font files in bundled directory.")
-
-    # Register fonts and build mapping
-    for font_path in font_files_to_scan:
-        try:
-            filename = os.path.basename(font_path)
-            base_name = os.path.splitext(filename)[0].lower()
-            
-            # Register with the filename as the identifier
-            pdfmetrics.registerFont(TTFont(filename, font_path))
-            registered_fonts[filename] = font_path
-            
-            # Map this file to font families
-            for family_name, patterns in font_family_patterns.items():
-                for pattern in patterns:
-                    if base_name == pattern or base_name.startswith(pattern.split('-')[0]):
-                        if family_name not in font_family_map:
-                            font_family_map[family_name] = []
-                            available_families.append(family_name)
-                        font_family_map[family_name].append(filename)
-                        break
-        except Exception as e:
-            print(f"  Warning: Failed to register {filename}: {e}")
-
-    # Sort available families alphabetically
-    available_families.sort()
-
-    if registered_fonts:
-        print(f"Successfully registered {len(registered_fonts)} bundled font files.")
-        print(f"Available font families: {len(available_families)}")
-        with open('font_mapping.log', 'w', encoding='utf-8') as f:
-            f.write(f"=== Bundled Font Registration ===\n\n")
-            f.write(f"Total registered: {len(registered_fonts)} font files\n")
-            f.write(f"Font families mapped: {len(font_family_map)}\n\n")
-            for family in available_families:
-                files = font_family_map.get(family, [])
-                f.write(f"{family}:\n")
-                for file in files:
-                    f.write(f"  - {file}\n")
-    else:
-        print("WARNING: No fonts were registered. Please add .ttf files to the fonts/ directory.")
-    
-    return font_family_map, available_families
+# Configure upload folder
+UPLOAD_FOLDER = DEFAULT_PROJECTS_FOLDER
 
-# Register fonts on startup - returns a dict mapping font family names to file lists and available families
-FONT_FAMILY_MAP, AVAILABLE_FONT_FAMILIES = register_system_fonts()
+# Sharded, crash-safe project storage with deduplicated PDFs. A store with files of the old flat
+# layout is migrated by the development server (python app.py); any other server refuses to start
+# until 'python manage.py migrate-layout' has been run, rather than serving without those projects.
+project_store = open_project_store(UPLOAD_FOLDER, migrate=__name__ == '__main__')
 
-# Configure upload folder
-UPLOAD_FOLDER = '../projects'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-def parse_color(color_str):
-    """Convert CSS color to reportlab color"""
-    if not color_str:
-        return "black"
-    
-    # Handle named colors
-    color_map = {
-        'red': HexColor('#FF0000'),
-        'blue': HexColor('#0000FF'),
-        'green': HexColor('#008000'),
-        'black': HexColor('#000000'),
-        'white': HexColor('#FFFFFF'),
-        'yellow': HexColor('#FFFF00'),
-        'orange': HexColor('#FFA500'),
-        'purple': HexColor('#800080'),
-        'gray': HexColor('#808080'),
-        'grey': HexColor('#808080'),
-        'brown': HexColor('#A52A2A'),
-        'pink': HexColor('#FFC0CB'),
-        'cyan': HexColor('#00FFFF'),
-        'magenta': HexColor('#FF00FF'),
-        'lime': HexColor('#00FF00'),
-        'navy': HexColor('#000080'),
-        'maroon': HexColor('#800000'),
-        'olive': HexColor('#808000'),
-        'teal': HexColor('#008080'),
-        'silver': HexColor('#C0C0C0')
-    }
-    
-    color_str = color_str.lower().strip()
-    
-    if color_str in color_map:
-        return color_map[color_str]
-    
-    # Handle hex colors
-    if color_str.startswith('#'):
-        try:
-            return HexColor(color_str)
-        except:
-            return "black"
-    
-    # Handle rgb() format
-    if color_str.startswith('rgb('):
-        try:
-            # Extract numbers from rgb(r,g,b)
-            rgb_part = color_str[4:-1]  # Remove 'rgb(' and ')'
-            r, g, b = [int(x.strip()) for x in rgb_part.split(',')]
-            hex_color = '#%02x%02x%02x' % (r, g, b)
-            return HexColor(hex_color)
-        except:
-            return "black"
-    
-    # Default fallback
-    return "black"
-
-def parse_border_style(style_str):
-    """Convert CSS border style to reportlab dash pattern"""
-    if not style_str:
-        return []  # solid
-    
-    style_str = style_str.lower().strip()
-    
-    if style_str == 'none':
-        return None  # Special value for no border
-    elif style_str == 'dashed':
-        return [3, 3]  # 3 points on, 3 points off
-    elif style_str == 'dotted':
-        return [1, 2]  # 1 point on, 2 points off
-    else:
-        return []  # solid for anything else
+# Full-text index of annotation values and page text, updated in the background on save
+search_index = open_search_index(UPLOAD_FOLDER, project_store)
 
-def map_font_family(font_family, font_bold=False, font_italic=False):
-    """
-    Map CSS font family and style to reportlab font name.
-    Uses the FONT_FAMILY_MAP created during startup to find registered system fonts.
-    Falls back to built-in fonts if the requested font isn't available.
-    """
-    if not font_family:
-        font_family = 'Arial'
-    
-    # Write to log file for debugging
-    try:
-        with open('font_mapping.log', 'a', encoding='utf-8') as f:
-            f.write(f"\nMapping font '{font_family}', bold={font_bold}, italic={font_italic}\n")
-    except:
-        pass
-    
-    # Check if we have this font family registered
-    # Try exact match first (case-sensitive)
-    if font_family in FONT_FAMILY_MAP:
-        available_files = FONT_FAMILY_MAP[font_family]
-        
-        # Try to find the right variant based on bold/italic
-        # Common patterns: 'b' or 'bd' for bold, 'i' for italic, 'z' or 'bi' for bold-italic
-        selected_font = None
-        
-        if font_bold and font_italic:
-            # Look for bold-italic variant
-            for f in available_files:
-                base = f.lower().replace('.ttf', '').replace('.ttc', '')
-                if 'z' in base or ('b' in base and 'i' in base) or 'bolditalic' in base:
-                    selected_font = f
-                    break
-        
-        if not selected_font and font_bold:
-            # Look for bold variant
-            for f in available_files:
-                base = f.lower().replace('.ttf', '').replace('.ttc', '')
-                if ('b' in base or 'bold' in base) and 'i' not in base and 'z' not in base:
-                    selected_font = f
-                    break
-        
-        if not selected_font and font_italic:
-            # Look for italic variant
-            for f in available_files:
-                base = f.lower().replace('.ttf', '').replace('.ttc', '')
-                if 'i' in base and 'b' not in base and 'z' not in base:
-                    selected_font = f
-                    break
-        
-        if not selected_font:
-            # Use the first file (usually the regular variant)
-            selected_font = available_files[0]
-        
-        try:
-            with open('font_mapping.log', 'a', encoding='utf-8') as f:
-                f.write(f"  Using registered font: '{selected_font}'\n")
-        except:
-            pass
-        
-        return selected_font
-    
-    # Fall back to built-in reportlab fonts
-    # Map common web fonts to reportlab font families
-    fallback_map = {
-        # Sans-serif fonts -> Helvetica
-        'Arial': 'Helvetica',
-        'Helvetica': 'Helvetica',
-        'Verdana': 'Helvetica',
-        'Tahoma': 'Helvetica',
-        'Geneva': 'Helvetica',
-        'Calibri': 'Helvetica',
-        'Candara': 'Helvetica',
-        'Trebuchet MS': 'Helvetica',
-        'Century Gothic': 'Helvetica',
-        'Franklin Gothic Medium': 'Helvetica',
-        'Comic Sans MS': 'Helvetica',
-        
-        # Serif fonts -> Times-Roman
-        'Times New Roman': 'Times-Roman',
-        'Georgia': 'Times-Roman',
-        'Garamond': 'Times-Roman',
-        'Palatino': 'Times-Roman',
-        'Book Antiqua': 'Times-Roman',
-        'Cambria': 'Times-Roman',
-        
-        # Monospace fonts -> Courier
-        'Courier New': 'Courier',
-        'Consolas': 'Courier',
-        'Monaco': 'Courier',
-        
-        # Bold fonts -> Helvetica (will be made bold below)
-        'Arial Black': 'Helvetica',
-        'Impact': 'Helvetica',
-        
-        # Signature/Script fonts -> Helvetica (will be made oblique for handwriting effect)
-        'Brush Script MT': 'Helvetica',
-        'Lucida Handwriting': 'Helvetica',
-        'Segoe Script': 'Helvetica',
-        'Monotype Corsiva': 'Helvetica',
-        
-        # Decorative fonts
-        'Papyrus': 'Times-Roman',
-        'Copperplate': 'Times-Roman',
-    }
-    
-    # Get base font family
-    base_font = fallback_map.get(font_family, 'Helvetica')
-    
-    try:
-        with open('font_mapping.log', 'a', encoding='utf-8') as f:
-            f.write(f"  Fallback to built-in font, base: '{base_font}'\n")
-    except:
-        pass
-    
-    # Special handling for signature fonts - always use oblique/italic
-    signature_fonts = ['Brush Script MT', 'Lucida Handwriting', 'Segoe Script', 'Monotype Corsiva']
-    if font_family in signature_fonts:
-        try:
-            with open('font_mapping.log', 'a', encoding='utf-8') as f:
-                f.write(f"  '{font_family}' is a signature font, forcing italic=True\n")
-        except:
-            pass
-        font_italic = True
-    
-    # Special handling for Impact and Arial Black - always bold
-    if font_family in ['Impact', 'Arial Black']:
-        try:
-            with open('font_mapping.log', 'a', encoding='utf-8') as f:
-                f.write(f"  '{font_family}' is a bold font, forcing bold=True\n")
-        except:
-            pass
-        font_bold = True
-    
-    # Apply font style based on bold and italic flags
-    result_font = base_font  # Default
-    
-    if font_bold and font_italic:
-        # Both bold and italic
-        if base_font == 'Helvetica':
-            result_font = 'Helvetica-BoldOblique'
-        elif base_font == 'Times-Roman':
-            result_font = 'Times-BoldItalic'
-        elif base_font == 'Courier':
-            result_font = 'Courier-BoldOblique'
-    elif font_bold:
-        # Only bold
-        if base_font == 'Helvetica':
-            result_font = 'Helvetica-Bold'
-        elif base_font == 'Times-Roman':
-            result_font = 'Times-Bold'
-        elif base_font == 'Courier':
-            result_font = 'Courier-Bold'
-    elif font_italic:
-        # Only italic
-        if base_font == 'Helvetica':
-            result_font = 'Helvetica-Oblique'
-        elif base_font == 'Times-Roman':
-            result_font = 'Times-Italic'
-        elif base_font == 'Courier':
-            result_font = 'Courier-Oblique'
-    
-    try:
-        with open('font_mapping.log', 'a', encoding='utf-8') as f:
-            f.write(f"  Final reportlab font: '{result_font}'\n")
-    except:
-        pass
-    
-    return result_font
+# Coalesces frequent annotation-only saves (AUTOSAVE_FLUSH_INTERVAL, AUTOSAVE_DURABILITY)
+autosave = WriteBehindBuffer.from_environment(project_store, on_flush=search_index.submit)
+autosave.start()
+autosave.install_shutdown_hooks()
+
+# Estimated memory of in-flight render requests (REQUEST_MEMORY_BUDGET_MB, TOTAL_MEMORY_BUDGET_MB)
+memory_budget = MemoryBudget.from_environment()
+
+# Opt-in cProfile of requests (PROFILING_TOKEN, PROFILE_SAMPLE_RATE); no hooks when unset
+request_profiler = RequestProfiler.from_environment()
+request_profiler.install(app)
+
+# Per-endpoint concurrency/cost limits with a bounded wait queue (ADMISSION_* settings)
+admission = AdmissionController.from_environment()
+
+# Render cost units: one per MB of document plus one per this many annotations
+ANNOTATIONS_PER_COST_UNIT = 500
+
+# Bodies up to this size are parsed early to count annotations for the cost estimate
+COST_PEEK_BODY_BYTES = 1 * MB
+
+# Parsed source documents shared by preview requests (DOCUMENT_CACHE_ENTRIES, DOCUMENT_CACHE_MB)
+document_cache = DocumentCache.from_environment()
+
+# Rendered per-page overlays and finished documents, in memory and under RENDER_CACHE_FOLDER
+overlay_cache = RenderCache.from_environment('overlays', memory_mb=64, disk_mb=512)
+output_cache = RenderCache.from_environment('outputs', memory_mb=128, disk_mb=2048)
+
+# Page thumbnails for the navigator (THUMBNAILS_CACHE_MEMORY_MB, THUMBNAILS_CACHE_DISK_MB)
+thumbnails = ThumbnailService(RenderCache.from_environment('thumbnails', memory_mb=32, disk_mb=512, suffix='.jpg'))
+
+# Most pages one thumbnail request may ask for
+THUMBNAIL_BATCH_MAX = 1000
+
+# Most rows one single-PDF mail merge may render; the whole document is held until it is written
+MAIL_MERGE_SINGLE_MAX_ROWS = int(os.environ.get('MAIL_MERGE_SINGLE_MAX_ROWS', 2000))
 
-def get_background_fill(annotation):
+# Spatial indexes of recently queried projects, rebuilt when a project is saved again
+annotation_indexes = AnnotationIndexCache()
+
+def peek_render_request():
     """
-    Determine background fill settings for an annotation.
-    Returns tuple: (should_fill, fill_color)
+    Look at a render request before its view runs. Returns (body, stored bytes):
+    small bodies (project_id or document_hash requests) are parsed, and what they
+    refer to is sized without being loaded. A project is sized by its project file,
+    since reading its PDF size would mean unpickling it before admission. Large
+    bodies are mostly the base64 document and give ({}, 0). Computed once per request.
     """
-    # Check new backgroundColor property first
-    bg_color = annotation.get('backgroundColor')
-    
-    if bg_color is None:
-        # Fall back to old transparent property for backward compatibility
-        transparent = annotation.get('transparent', False)
-        if transparent:
-            return (False, None)
-        else:
-            return (True, HexColor('#FFFFFF'))  # White background
+    if 'render_request' not in g:
+        data, stored_bytes = {}, 0
+        if (request.content_length or 0) <= COST_PEEK_BODY_BYTES:
+            # Cached on the request, so the view does not read the body again
+            data = peek_request_body()
+            if not isinstance(data, dict):
+                data = {}
+            project_id = data.get('project_id')
+            if project_id and isinstance(project_id, str):
+                try:
+                    revision = project_store.revision(project_id)
+                except ValueError:
+                    # Invalid id, the view reports it
+                    revision = None
+                if revision is not None:
+                    stored_bytes = revision[1]
+            elif data.get('document_hash'):
+                document = document_cache.get(data['document_hash'])
+                if document is not None:
+                    stored_bytes = document.size
+        g.render_request = (data, stored_bytes)
+    return g.render_request
+
+def stored_document_bytes():
+    """Size of the stored document or project a render request loads, for the memory budget"""
+    return peek_render_request()[1]
+
+def estimate_render_cost():
+    """Cost of a render request from its document (or project file) size and annotation count"""
+    data, stored_bytes = peek_render_request()
+    document_bytes = stored_bytes or (request.content_length or 0) * 3 / 4
+    annotation_count = count_annotations(data.get('annotations'))
     
-    # Handle new backgroundColor values
-    if bg_color == 'transparent':
-        return (False, None)
-    elif bg_color == 'white':
-        return (True, HexColor('#FFFFFF'))
-    else:
-        # Custom color - parse it
-        color = parse_color(bg_color)
-        return (True, color)
-
-
-class ProjectData:
-    def __init__(self):
-        self.project_id = str(uuid.uuid4())
-        self.created_at = datetime.now().isoformat()
-        self.pdf_data = None
-        self.pdf_filename = ""
-        self.annotations = []
-        self.metadata = {}
-
-    def to_dict(self):
-        return {
-            'project_id': self.project_id,
-            'created_at': self.created_at,
-            'pdf_filename': self.pdf_filename,
-            'annotations': self.annotations,
-            'metadata': self.metadata
-        }
+    return 1 + document_bytes / MB + annotation_count / ANNOTATIONS_PER_COST_UNIT
 
 @app.route('/api/upload-pdf', methods=['POST'])
 def upload_pdf():
@@ -453,9 +164,14 @@ def upload_pdf():
         # Convert PDF to base64 for frontend
         pdf_base64 = base64.b64encode(pdf_data).decode('utf-8')
         
+        # Keep the parsed document around so previews don't have to resend it
+        digest = document_hash(pdf_data)
+        document_cache.put(pdf_data, digest)
+        
         return jsonify({
             'success': True,
             'pdf_data': pdf_base64,
+            'document_hash': digest,
             'filename': file.filename,
             'num_pages': num_pages,
             'message': 'PDF uploaded successfully'
@@ -468,77 +184,186 @@ def upload_pdf():
 def save_project():
     """Save project data to a binary file"""
     try:
-        data = request.json
+        try:
+            data = load_request_body()
+        except ValueError as e:
+            return jsonify({'error': f'Invalid request body: {str(e)}'}), 400
+        
+        # The PDF is stored as a raw file next to the project so it can be served with Range requests
+        pdf_bytes = take_base64_payload(data, 'pdf_data') or b''
+        linearized = False
+        if data.get('linearize', False):
+            pdf_bytes, linearized = linearize_pdf(pdf_bytes)
         
-        # Create project data object
+        # Create project data object, or replace an existing project when its id is given
         project = ProjectData()
-        project.pdf_data = data.get('pdf_data', '')
         project.pdf_filename = data.get('pdf_filename', '')
         project.annotations = data.get('annotations', [])
         project.metadata = data.get('metadata', {})
         
-        # Save to binary file
-        filename = f"project_{project.project_id}.pkl"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        
-        with open(filepath, 'wb') as f:
-            pickle.dump(project, f)
+        # Hold the project lock from reading the existing project until the new one is written,
+        # so neither a write-behind flush nor a newly staged annotation save can land in between
+        with project_store.lock(data.get('project_id') or project.project_id):
+            existing = project_store.load(data['project_id']) if data.get('project_id') else None
+            if existing is not None:
+                project.project_id = existing.project_id
+                project.created_at = existing.created_at
+                # A full save supersedes any annotation saves still waiting to be written
+                autosave.discard(project.project_id)
+            
+            # Save to binary file (atomic, the PDF is written before the project that refers to it)
+            project_store.save(project, pdf_bytes)
+        filename = project_store.project_key(project.project_id)
+        search_index.submit(project.project_id)
         
         return jsonify({
             'success': True,
             'project_id': project.project_id,
             'filename': filename,
+            'linearized': linearized,
             'message': 'Project saved successfully'
         })
     
     except Exception as e:
         return jsonify({'error': f'Error saving project: {str(e)}'}), 500
 
-@app.route('/api/load-project/<project_id>', methods=['GET'])
-def load_project(project_id):
-    """Load project data from binary file"""
+@app.route('/api/save-annotations', methods=['POST'])
+def save_annotations():
+    """
+    Lightweight save of an existing project's annotations (and optionally metadata).
+    The change is buffered and written behind the request; pass commit=true to
+    write it before responding.
+    """
     try:
-        filename = f"project_{project_id}.pkl"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        payload_size = request.content_length
+        try:
+            data = load_request_body()
+        except ValueError as e:
+            return jsonify({'error': f'Invalid request body: {str(e)}'}), 400
         
-        if not os.path.exists(filepath):
+        if not data or not data.get('project_id'):
+            return jsonify({'error': 'Project id is required'}), 400
+        
+        annotations = data.get('annotations')
+        if not isinstance(annotations, list):
+            return jsonify({'error': 'Annotations must be a list'}), 400
+        
+        project_id = data['project_id']
+        try:
+            written = autosave.stage(project_id, annotations, data.get('metadata'), payload_size)
+        except KeyError:
             return jsonify({'error': 'Project not found'}), 404
         
-        with open(filepath, 'rb') as f:
-            project = pickle.load(f)
+        if data.get('commit', False) and not written:
+            written = autosave.flush(project_id) > 0
         
         return jsonify({
+            'success': True,
+            'project_id': project_id,
+            'written': written,
+            'message': 'Annotations saved' if written else 'Annotations queued for saving'
+        })
+    
+    except Exception as e:
+        return jsonify({'error': f'Error saving annotations: {str(e)}'}), 500
+
+@app.route('/api/commit-project/<project_id>', methods=['POST'])
+def commit_project(project_id):
+    """Write any buffered changes of a project now"""
+    try:
+        written = autosave.flush(project_id)
+        return jsonify({
+            'success': True,
+            'project_id': project_id,
+            'written': written > 0
+        })
+    
+    except Exception as e:
+        return jsonify({'error': f'Error committing project: {str(e)}'}), 500
+
+@app.route('/api/load-project/<project_id>', methods=['GET'])
+def load_project(project_id):
+    """
+    Load the project manifest (annotations and metadata).
+    The PDF itself is fetched from pdf_url, which supports Range requests.
+    Pass ?include_pdf=true to also get the PDF inline as base64.
+    Clients that prefer application/x-msgpack in Accept get the manifest as
+    msgpack, with columnar annotations and the inline PDF as raw bytes.
+    """
+    try:
+        project = autosave.load(project_id)
+        
+        if project is None:
+            return jsonify({'error': 'Project not found'}), 404
+        
+        response = {
             'success': True,
             'project_data': project.to_dict(),
-            'pdf_data': project.pdf_data,
+            'pdf_url': f'/api/project-pdf/{project_id}',
             'message': 'Project loaded successfully'
-        })
+        }
+        
+        include_pdf = request.args.get('include_pdf', 'false').lower() == 'true'
+        
+        if wants_msgpack():
+            response['project_data']['annotations'] = encode_annotations(project.annotations)
+            if include_pdf:
+                response['pdf_data'] = project_store.load_pdf(project)
+            response = msgpack_response(response)
+        else:
+            if include_pdf:
+                response['pdf_data'] = base64.b64encode(project_store.load_pdf(project)).decode('utf-8')
+            response = jsonify(response)
+        response.vary.add('Accept')
+        return response
     
     except Exception as e:
         return jsonify({'error': f'Error loading project: {str(e)}'}), 500
 
+@app.route('/api/project-pdf/<project_id>', methods=['GET'])
+def get_project_pdf(project_id):
+    """Serve the raw PDF of a project, with support for Range requests (206 Partial Content)"""
+    try:
+        project = project_store.load(project_id)
+        
+        if project is None:
+            return jsonify({'error': 'Project not found'}), 404
+        
+        # Older projects keep the PDF inside the pickle - move it to the blob store once so it can be range-served
+        project = project_store.migrate_pdf(project)
+        
+        pdf_path = project_store.pdf_path(project)
+        if pdf_path is None:
+            # Backend without local files - serve from memory, still honouring Range
+            pdf_bytes = project_store.load_pdf(project)
+            response = Response(pdf_bytes, mimetype='application/pdf')
+            return response.make_conditional(request, accept_ranges=True, complete_length=len(pdf_bytes))
+        
+        return send_file(
+            pdf_path,
+            mimetype='application/pdf',
+            as_attachment=False,
+            download_name=project.pdf_filename or 'document.pdf',
+            conditional=True
+        )
+    
+    except Exception as e:
+        return jsonify({'error': f'Error serving project PDF: {str(e)}'}), 500
+
 @app.route('/api/list-projects', methods=['GET'])
 def list_projects():
     """List all saved projects"""
     try:
         projects = []
         
-        for filename in os.listdir(UPLOAD_FOLDER):
-            if filename.startswith('project_') and filename.endswith('.pkl'):
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                try:
-                    with open(filepath, 'rb') as f:
-                        project = pickle.load(f)
-                    
-                    projects.append({
-                        'project_id': project.project_id,
-                        'created_at': project.created_at,
-                        'pdf_filename': project.pdf_filename,
-                        'filename': filename,
-                        'annotation_count': len(project.annotations)
-                    })
-                except:
-                    continue
+        for key, project in project_store.iter_projects():
+            projects.append({
+                'project_id': project.project_id,
+                'created_at': project.created_at,
+                'pdf_filename': project.pdf_filename,
+                'filename': key,
+                'annotation_count': len(project.annotations)
+            })
         
         # Sort by creation date
         projects.sort(key=lambda x: x['created_at'], reverse=True)
@@ -551,19 +376,156 @@ def list_projects():
     except Exception as e:
         return jsonify({'error': f'Error listing projects: {str(e)}'}), 500
 
+@app.route('/api/search', methods=['GET'])
+def search_projects():
+    """
+    Search annotation values and page text across all projects.
+    Query parameters: q, limit (default 20, max 100), offset, project_id, prefix.
+    """
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'error': 'q is required'}), 400
+        
+        try:
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({'error': 'limit and offset must be integers'}), 400
+        
+        found = search_index.search(
+            query,
+            limit=limit,
+            offset=offset,
+            project_id=request.args.get('project_id'),
+            prefix=request.args.get('prefix', 'false').lower() == 'true'
+        )
+        
+        return jsonify({
+            'success': True,
+            'query': query,
+            'total': found['total'],
+            'limit': limit,
+            'offset': offset,
+            'results': found['results']
+        })
+    
+    except Exception as e:
+        return jsonify({'error': f'Error searching projects: {str(e)}'}), 500
+
+@app.route('/api/export-projects', methods=['GET'])
+def export_projects():
+    """
+    Stream a bundle (tar) of projects with their deduplicated PDFs.
+    Query parameters: project_id (repeatable, default all projects), compress=true for gzip.
+    """
+    try:
+        project_ids = request.args.getlist('project_id') or None
+        compress = request.args.get('compress', 'false').lower() == 'true'
+        
+        # Buffered annotation saves are written first so the bundle has them
+        autosave.flush()
+        
+        filename = f"projects-{time.strftime('%Y%m%d-%H%M%S')}.tar{'.gz' if compress else ''}"
+        return Response(
+            iter_bundle(project_store, project_ids, compress),
+            mimetype='application/gzip' if compress else 'application/x-tar',
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        )
+    
+    except Exception as e:
+        return jsonify({'error': f'Error exporting projects: {str(e)}'}), 500
+
+@app.route('/api/import-projects', methods=['POST'])
+@admission.limit('import-projects', max_concurrent=1, max_queue=2)
+def import_projects():
+    """
+    Restore projects from a bundle made by /api/export-projects, sent as the raw
+    request body or as the 'bundle' file of a form. Existing projects are kept
+    unless overwrite=true. Returns the import report.
+    """
+    try:
+        overwrite = request.args.get('overwrite', 'false').lower() == 'true'
+        if request.mimetype == 'multipart/form-data':
+            if 'bundle' not in request.files:
+                return jsonify({'error': 'No bundle file provided'}), 400
+            stream = request.files['bundle'].stream
+        else:
+            stream = request.stream
+        
+        def project_imported(project_id):
+            # An overwritten project must not be clobbered later by an older buffered save
+            autosave.discard(project_id)
+            search_index.submit(project_id)
+        
+        autosave.flush()
+        try:
+            report = import_bundle(project_store, stream, overwrite=overwrite, on_project=project_imported)
+        except BundleError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify({'success': report['complete'] and not report['projects_failed'], **report})
+    
+    except Exception as e:
+        return jsonify({'error': f'Error importing projects: {str(e)}'}), 500
+
 @app.route('/api/generate-pdf', methods=['POST'])
+@admission.limit('generate-pdf', cost=estimate_render_cost)
+@memory_budget.limit(stored_bytes=stored_document_bytes)
 def generate_pdf():
     """Generate a PDF with annotations overlaid for printing"""
     try:
         print("=== PDF Generation Request ===")
-        data = request.json
+        try:
+            data = load_request_body()
+        except ValueError as e:
+            return jsonify({'error': f'Invalid request body: {str(e)}'}), 400
         print(f"Request data keys: {list(data.keys()) if data else 'No data'}")
         
         if not data:
             return jsonify({'error': 'No data provided'}), 400
-            
-        pdf_data = base64.b64decode(data['pdf_data'])
-        annotations = data.get('annotations', [])
+        
+        if data.get('project_id'):
+            # Export a saved project without sending its PDF back to the server
+            try:
+                project = autosave.load(data['project_id'])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            if project is None:
+                return jsonify({'error': 'Project not found'}), 404
+            project = project_store.migrate_pdf(project)
+            digest = project.pdf_sha256
+            annotations = data.get('annotations', project.annotations)
+            pdf_data = None
+        else:
+            # Decoded once; the base64 string is released and the bytes are shared by BytesIO, not copied
+            pdf_data = take_base64_payload(data, 'pdf_data')
+            if not pdf_data:
+                return jsonify({'error': 'PDF data is required'}), 400
+            digest = document_hash(pdf_data)
+            annotations = data.get('annotations', [])
+        optimize = bool(data.get('optimize', False))
+        try:
+            image_options = parse_image_options(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # An unchanged document with unchanged annotations is served straight from the cache
+        output_key = hash_json([digest, FONT_TABLE_VERSION, optimize, image_options, annotations])
+        cached_output = output_cache.get(output_key)
+        if cached_output is not None:
+            print(f"Serving cached PDF ({len(cached_output)} bytes)")
+            response = send_file(
+                BytesIO(cached_output),
+                mimetype='application/pdf',
+                as_attachment=True,
+                download_name='annotated_document.pdf'
+            )
+            response.headers['X-Cache'] = 'HIT'
+            return response
+        
+        if pdf_data is None:
+            pdf_data = project_store.load_pdf(project)
         
         print(f"PDF data length: {len(pdf_data)} bytes")
         print(f"Number of annotations: {len(annotations)}")
@@ -572,192 +534,441 @@ def generate_pdf():
         
         # Read original PDF
         pdf_reader = PdfReader(BytesIO(pdf_data))
-        pdf_writer = PdfWriter()
         
         print(f"Original PDF has {len(pdf_reader.pages)} pages")
+        annotate(document_bytes=len(pdf_data), pages=len(pdf_reader.pages), annotations=len(annotations))
         
-        # Process each page
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            page_box = page.mediabox
-            page_width = float(page_box.width)
-            page_height = float(page_box.height)
-            
-            print(f"Page {page_num + 1}: {page_width} x {page_height}")
-            
-            # Get page annotations (using 0-based indexing consistently)
-            page_annotations = [ann for ann in annotations if ann.get('page', 0) == page_num]
-            
-            print(f"Page {page_num + 1} has {len(page_annotations)} annotations")
-            
-            if page_annotations:
-                # Create overlay with annotations
-                packet = BytesIO()
-                can = canvas.Canvas(packet, pagesize=(page_width, page_height))
-                
-                for annotation in page_annotations:
-                    x = float(annotation.get('x', 0))
-                    y = float(annotation.get('y', 0))
-                    width = float(annotation.get('width', 100))
-                    height = float(annotation.get('height', 20))
-                    value = str(annotation.get('value', ''))
-                    
-                    print(f"  Original annotation: '{value}' at web({x},{y}) size({width},{height})")
-                    
-                    # Skip annotations that are completely outside the page bounds
-                    if x >= page_width or y >= page_height or x + width <= 0 or y + height <= 0:
-                        print(f"  Skipping annotation outside bounds: x={x}, y={y}, page_size=({page_width},{page_height})")
-                        continue
-                    
-                    # Clip coordinates to page bounds but don't force them to arbitrary values
-                    clipped_x = max(0, min(x, page_width - 1))
-                    clipped_y = max(0, min(y, page_height - 1))
-                    clipped_width = min(width, page_width - clipped_x)
-                    clipped_height = min(height, page_height - clipped_y)
-                    
-                    # Convert web coordinates (top-left origin) to PDF coordinates (bottom-left origin)
-                    pdf_x = clipped_x
-                    pdf_y = page_height - clipped_y - clipped_height
-                    
-                    print(f"  Final annotation: '{value}' at web({clipped_x},{clipped_y}) -> pdf({pdf_x},{pdf_y}) size({clipped_width},{clipped_height})")
-                    
-                    # All annotations are now text type
-                    # Get font properties from annotation
-                    font_family = annotation.get('fontFamily', 'Arial')
-                    font_bold = annotation.get('fontBold', False)
-                    font_italic = annotation.get('fontItalic', False)
-                    font_strikethrough = annotation.get('fontStrikethrough', False)
-                    font_size = float(annotation.get('fontSize', 12))
-                    font_color = parse_color(annotation.get('fontColor', '#000000'))
-                    
-                    # Map font family and style to reportlab font
-                    reportlab_font = map_font_family(font_family, font_bold, font_italic)
-                    
-                    # Set font and size with error handling
-                    try:
-                        can.setFont(reportlab_font, font_size)
-                    except Exception as e:
-                        print(f"Warning: Failed to set font '{reportlab_font}' for annotation, falling back to Helvetica. Error: {e}")
-                        can.setFont('Helvetica', font_size)
-                        reportlab_font = 'Helvetica'
-                    
-                    # Get border properties from annotation
-                    border_color = parse_color(annotation.get('borderColor', 'black'))
-                    border_style = parse_border_style(annotation.get('borderStyle', 'solid'))
-                    border_width = float(annotation.get('borderWidth', 1))
-                    
-                    # Get background fill settings
-                    should_fill_bg, fill_color = get_background_fill(annotation)
-                    
-                    # Determine if border should be drawn
-                    should_draw_border = border_style is not None
-                    
-                    if should_draw_border:
-                        # Apply border styling
-                        can.setStrokeColor(border_color)
-                        can.setLineWidth(border_width)
-                        if border_style:
-                            can.setDash(border_style)
-                        else:
-                            can.setDash([])  # solid line
-                    
-                    # Set fill color if background should be filled
-                    if should_fill_bg and fill_color:
-                        can.setFillColor(fill_color)
-                    
-                    # Draw rectangle with border and/or fill
-                    can.rect(pdf_x, pdf_y, clipped_width, clipped_height, 
-                            stroke=1 if should_draw_border else 0, 
-                            fill=1 if should_fill_bg else 0)
-                    
-                    # Draw text inside the box with font color (handle multiline)
-                    can.setFillColor(font_color)
-                    text_x = pdf_x + 2  # small padding
-                    
-                    # Split text by newlines and draw each line
-                    lines = value.split('\n')
-                    line_height = font_size * 1.2  # Line spacing
-                    
-                    # Calculate starting Y position (top of text block)
-                    total_text_height = len(lines) * line_height
-                    # Start from top and work down
-                    start_y = pdf_y + clipped_height - line_height + (font_size / 3)
-                    
-                    for i, line in enumerate(lines):
-                        line_y = start_y - (i * line_height)
-                        can.drawString(text_x, line_y, line)
-                        
-                        # Draw strikethrough for this line if needed
-                        if font_strikethrough:
-                            text_width = can.stringWidth(line, reportlab_font, font_size)
-                            strike_y = line_y + (font_size / 3)  # Position line through middle of text
-                            can.setStrokeColor(font_color)
-                            can.setLineWidth(1)  # Always use 1px line for strikethrough
-                            can.setDash([])  # Reset to solid line (no dash pattern)
-                            can.line(text_x, strike_y, text_x + text_width, strike_y)
-                            can.setFillColor(font_color)  # Reset fill color for next line
-                
-                can.save()
-                packet.seek(0)
-                
-                # Merge overlay with original page
-                overlay_pdf = PdfReader(packet)
-                page.merge_page(overlay_pdf.pages[0])
-                print(f"  Merged overlay for page {page_num + 1}")
-            
-            pdf_writer.add_page(page)
+        # Overlay annotations on every page, reusing cached overlays of unchanged pages
+        output, stats = generate_annotated_pdf(pdf_reader, annotations, optimize, overlay_cache, image_options)
         
-        # Save to bytes
-        output = BytesIO()
-        pdf_writer.write(output)
-        output.seek(0)
+        # getvalue() shares the BytesIO's buffer, where a memoryview would be copied by the cache
+        output_cache.put(output_key, output.getvalue())
+        print(f"Overlay cache: {overlay_cache.stats()}")
         
-        print(f"Generated PDF size: {len(output.getvalue())} bytes")
         print("=== PDF Generation Complete ===")
         
-        return send_file(
+        response = send_file(
             output,
             mimetype='application/pdf',
             as_attachment=True,
             download_name='annotated_document.pdf'
         )
+        response.headers['X-Cache'] = 'MISS'
+        if stats['optimize']:
+            response.headers['X-Size-Before'] = str(stats['optimize']['size_before'])
+            response.headers['X-Size-After'] = str(stats['optimize']['size_after'])
+        if stats['images']:
+            response.headers['X-Images-Replaced'] = str(stats['images']['replaced'])
+            response.headers['X-Image-Bytes-Saved'] = str(stats['images']['bytes_before'] - stats['images']['bytes_after'])
+        return response
     
     except Exception as e:
         print(f"ERROR in PDF generation: {str(e)}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': f'Error generating PDF: {str(e)}'}), 500
+
+def parse_image_options(data):
+    """
+    Image downsampling options of a generate request: downsample_images=true
+    turns it on, image_dpi, image_quality and image_format tune it.
+    """
+    if not data.get('downsample_images', False):
+        return None
+    return normalize_image_options(data.get('image_dpi'), data.get('image_quality'), data.get('image_format'))
+
+def parse_preview_pages(data, page_count):
+    """
+    Work out which 0-based pages a preview request wants.
+    Accepts 'page' (single page), 'pages' (list) or 'page_from'/'page_to' (inclusive range).
+    """
+    if 'page' in data:
+        pages = [int(data['page'])]
+    elif 'pages' in data:
+        pages = [int(p) for p in data['pages']]
+    elif 'page_from' in data:
+        page_from = int(data['page_from'])
+        page_to = int(data.get('page_to', page_from))
+        pages = list(range(page_from, page_to + 1))
+    else:
+        raise ValueError('One of page, pages or page_from is required')
+    
+    if not pages:
+        raise ValueError('No pages requested')
+    for page_num in pages:
+        if page_num < 0 or page_num >= page_count:
+            raise ValueError(f'Page {page_num} is out of range (document has {page_count} pages)')
+    return pages
+
+@app.route('/api/preview-pdf', methods=['POST'])
+@admission.limit('preview-pdf', cost=estimate_render_cost, queue_timeout=5)
+@memory_budget.limit(stored_bytes=stored_document_bytes)
+def preview_pdf():
+    """
+    Render only the requested pages of a document, for live print-accurate preview.
+    The source is identified by document_hash (from upload or an earlier preview),
+    project_id, or sent as pdf_data. Parsed sources are cached between requests.
+    """
+    try:
+        start_time = time.perf_counter()
+        try:
+            data = load_request_body()
+        except ValueError as e:
+            return jsonify({'error': f'Invalid request body: {str(e)}'}), 400
         
-        # Save to bytes
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+        
+        # Annotations default to the saved ones of a project previewed by project_id
+        saved_annotations = []
+        if data.get('document_hash'):
+            document = document_cache.get(data['document_hash'])
+            if document is None:
+                return jsonify({'error': 'Document not cached, send pdf_data', 'code': 'document_not_cached'}), 404
+        elif data.get('project_id'):
+            try:
+                project = autosave.load(data['project_id'])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            if project is None:
+                return jsonify({'error': 'Project not found'}), 404
+            project = project_store.migrate_pdf(project)
+            saved_annotations = project.annotations
+            document = document_cache.get_or_load(project.pdf_sha256, lambda: project_store.load_pdf(project))
+        else:
+            pdf_data = take_base64_payload(data, 'pdf_data')
+            if not pdf_data:
+                return jsonify({'error': 'PDF data is required'}), 400
+            document = document_cache.put(pdf_data)
+            del pdf_data
+        
+        try:
+            pages = parse_preview_pages(data, document.page_count)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        annotations = [ann for ann in data.get('annotations', saved_annotations) if ann.get('page', 0) in pages]
+        annotate(document_bytes=document.size, document_pages=document.page_count,
+                 pages=len(pages), annotations=len(annotations))
+        
+        # pypdf readers are not thread safe, hold the document while reading its pages
         output = BytesIO()
-        pdf_writer.write(output)
+        with document.lock:
+            pdf_writer = render_pages(document.reader, annotations, pages, overlay_cache=overlay_cache)
+            pdf_writer.write(output)
         output.seek(0)
         
-        return send_file(
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        print(f"Preview of pages {[p + 1 for p in pages]} rendered in {elapsed_ms:.1f} ms ({buffer_size(output)} bytes)")
+        
+        response = send_file(
             output,
             mimetype='application/pdf',
+            as_attachment=False,
+            download_name='preview.pdf'
+        )
+        response.headers['X-Document-Hash'] = document.digest
+        response.headers['X-Render-Time-Ms'] = f'{elapsed_ms:.1f}'
+        return response
+    
+    except Exception as e:
+        print(f"ERROR in preview: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Error rendering preview: {str(e)}'}), 500
+
+def resolve_document(document_hash=None, project_id=None):
+    """
+    Parsed document for a read-only request, from the document cache, the
+    blob store (a document hash is a blob digest) or a project. None if unknown.
+    """
+    if document_hash:
+        document = document_cache.get(document_hash)
+        if document is None and re.fullmatch(r'[0-9a-f]{64}', document_hash) and project_store.blobs.exists(document_hash):
+            document = document_cache.get_or_load(document_hash, lambda: project_store.blobs.get(document_hash))
+        return document
+    if project_id:
+        project = autosave.load(project_id)
+        if project is None:
+            return None
+        project = project_store.migrate_pdf(project)
+        return document_cache.get_or_load(project.pdf_sha256, lambda: project_store.load_pdf(project))
+    return None
+
+def parse_thumbnail_size(value):
+    size = int(value) if value else DEFAULT_THUMBNAIL_SIZE
+    if not MIN_THUMBNAIL_SIZE <= size <= MAX_THUMBNAIL_SIZE:
+        raise ValueError(f'size must be between {MIN_THUMBNAIL_SIZE} and {MAX_THUMBNAIL_SIZE}')
+    return size
+
+@app.route('/api/thumbnails', methods=['GET'])
+@admission.limit('thumbnails')
+def get_thumbnails():
+    """
+    Thumbnails of a range of pages in one response, as base64 JPEGs.
+    Query parameters: document_hash or project_id, page_from and page_to
+    (0-based, inclusive, default all pages), size (longest side in pixels).
+    Pages that have no embedded image to make a thumbnail from get data: null.
+    """
+    try:
+        document_hash = request.args.get('document_hash')
+        document = resolve_document(document_hash, request.args.get('project_id'))
+        if document is None:
+            return jsonify({'error': 'Document not found'}), 404
+        
+        try:
+            size = parse_thumbnail_size(request.args.get('size'))
+            page_from = int(request.args.get('page_from', 0))
+            page_to = int(request.args.get('page_to', document.page_count - 1))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        page_to = min(page_to, document.page_count - 1)
+        if page_from < 0 or page_from > page_to:
+            return jsonify({'error': f'Invalid page range (document has {document.page_count} pages)'}), 400
+        if page_to - page_from + 1 > THUMBNAIL_BATCH_MAX:
+            return jsonify({'error': f'At most {THUMBNAIL_BATCH_MAX} pages per request'}), 400
+        
+        # Thumbnails only depend on the document contents, so a hash-addressed response never changes
+        etag = hash_json(['thumbnails', document.digest, page_from, page_to, size])
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            start_time = time.perf_counter()
+            results = []
+            for page_number in range(page_from, page_to + 1):
+                thumbnail = thumbnails.describe(document, page_number, size)
+                if thumbnail['data'] is not None:
+                    thumbnail['data'] = base64.b64encode(thumbnail['data']).decode('ascii')
+                results.append(thumbnail)
+            elapsed_ms = (time.perf_counter() - start_time) * 1000
+            print(f"Thumbnails of pages {page_from + 1}-{page_to + 1} at {size}px in {elapsed_ms:.1f} ms")
+            
+            response = jsonify({
+                'success': True,
+                'document_hash': document.digest,
+                'page_count': document.page_count,
+                'size': size,
+                'mimetype': 'image/jpeg',
+                'thumbnails': results
+            })
+        
+        response.set_etag(etag)
+        response.headers['X-Document-Hash'] = document.digest
+        if document_hash:
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            # A project's PDF can be replaced, so revalidate with the ETag
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    except Exception as e:
+        return jsonify({'error': f'Error making thumbnails: {str(e)}'}), 500
+
+@app.route('/api/thumbnails/<document_hash>/<int:page_number>', methods=['GET'])
+@admission.limit('thumbnails')
+def get_thumbnail(document_hash, page_number):
+    """A single page thumbnail as a JPEG image, for use in an <img> tag"""
+    try:
+        document = resolve_document(document_hash)
+        if document is None:
+            return jsonify({'error': 'Document not found'}), 404
+        try:
+            size = parse_thumbnail_size(request.args.get('size'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if page_number >= document.page_count:
+            return jsonify({'error': f'Page {page_number} is out of range (document has {document.page_count} pages)'}), 400
+        
+        data = thumbnails.get(document, page_number, size)
+        if data is None:
+            return jsonify({'error': 'Page has no embedded image to make a thumbnail from'}), 404
+        
+        response = Response(data, mimetype='image/jpeg')
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+    
+    except Exception as e:
+        return jsonify({'error': f'Error making thumbnail: {str(e)}'}), 500
+
+def resolve_annotation_index(data):
+    """
+    Annotation index for a query request: the cached index of a saved project
+    (project_id, including annotation saves not written yet) or one built from
+    annotations sent with the request. Returns None if the project doesn't exist.
+    """
+    project_id = data.get('project_id')
+    if not project_id:
+        return AnnotationIndex(data.get('annotations', []))
+    
+    revision = autosave.revision(project_id)
+    if revision is None:
+        return None
+    
+    def load_annotations():
+        project = autosave.load(project_id)
+        return project.annotations if project else []
+    
+    return annotation_indexes.get(project_id, revision, load_annotations)
+
+def parse_query_number(data, key, default=None):
+    """A coordinate of a query request; inf and nan (which Python's JSON parser accepts) are rejected"""
+    value = float(data[key] if default is None else data.get(key, default))
+    if not math.isfinite(value):
+        raise ValueError(f'{key} must be a finite number')
+    return value
+
+def parse_query_page(data):
+    return int(parse_query_number(data, 'page'))
+
+@app.route('/api/annotations/query', methods=['POST'])
+def query_annotations():
+    """
+    Annotations on a page intersecting a rectangle such as the visible viewport.
+    Without x/y the whole page is returned; with zero width and height it is a hit test.
+    """
+    try:
+        data = request.get_json()
+        if not data or 'page' not in data:
+            return jsonify({'error': 'page is required'}), 400
+        
+        index = resolve_annotation_index(data)
+        if index is None:
+            return jsonify({'error': 'Project not found'}), 404
+        
+        page = parse_query_page(data)
+        if 'x' in data and 'y' in data:
+            matches = index.query(page, parse_query_number(data, 'x'), parse_query_number(data, 'y'),
+                                  parse_query_number(data, 'width', 0), parse_query_number(data, 'height', 0))
+        else:
+            matches = index.on_page(page)
+        
+        return jsonify({
+            'success': True,
+            'page': page,
+            'annotations': matches,
+            'count': len(matches)
+        })
+    
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Error querying annotations: {str(e)}'}), 500
+
+@app.route('/api/annotations/overlaps', methods=['POST'])
+def annotation_overlaps():
+    """Pairs of overlapping annotations on one page, or in the whole document if no page is given"""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+        
+        index = resolve_annotation_index(data)
+        if index is None:
+            return jsonify({'error': 'Project not found'}), 404
+        
+        page = parse_query_page(data) if data.get('page') is not None else None
+        overlaps = index.overlaps(page)
+        
+        return jsonify({
+            'success': True,
+            'overlaps': overlaps,
+            'count': len(overlaps)
+        })
+    
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Error finding overlaps: {str(e)}'}), 500
+
+@app.route('/api/mail-merge', methods=['POST'])
+@admission.limit('mail-merge', max_concurrent=2, max_queue=8)
+def mail_merge():
+    """
+    Render a saved project once per row of an uploaded CSV or JSON-lines file.
+    Placeholders like {{name}} in annotation values are filled from each row.
+    Form fields: project_id, data (file), mode ('single' or 'separate'),
+    optional format ('csv' or 'jsonl') and filename_pattern for separate mode.
+    """
+    try:
+        project_id = request.form.get('project_id')
+        if not project_id:
+            return jsonify({'error': 'Project id is required'}), 400
+        
+        if 'data' not in request.files:
+            return jsonify({'error': 'No data file provided'}), 400
+        
+        mode = request.form.get('mode', 'single')
+        if mode not in ['single', 'separate']:
+            return jsonify({'error': 'Mode must be "single" or "separate"'}), 400
+        
+        data_file = request.files['data']
+        data_format = request.form.get('format') or detect_data_format(data_file.filename)
+        if data_format not in ['csv', 'jsonl']:
+            return jsonify({'error': 'Format must be "csv" or "jsonl"'}), 400
+        
+        project = autosave.load(project_id)
+        if project is None:
+            return jsonify({'error': 'Project not found'}), 404
+        
+        print(f"=== Mail Merge: project {project_id}, mode={mode}, format={data_format} ===")
+        
+        # Results can be large, keep them on disk rather than in memory
+        output = tempfile.TemporaryFile()
+        
+        # Parse the template document once for all rows, reading it straight from storage
+        with project_store.open_pdf(project) as pdf_file:
+            template = MergeTemplate(PdfReader(pdf_file), project.annotations)
+            rows = iter_rows(data_file.stream, data_format)
+            
+            if mode == 'single':
+                count = merge_to_single_pdf(template, rows, output, max_rows=MAIL_MERGE_SINGLE_MAX_ROWS)
+                mimetype = 'application/pdf'
+                download_name = 'merged_document.pdf'
+            else:
+                count = merge_to_zip(template, rows, output, request.form.get('filename_pattern'))
+                mimetype = 'application/zip'
+                download_name = 'merged_documents.zip'
+        output.seek(0)
+        
+        print(f"Merged {count} rows")
+        annotate(rows=count, pages=len(template.pdf_reader.pages), annotations=len(project.annotations))
+        
+        response = send_file(
+            output,
+            mimetype=mimetype,
             as_attachment=True,
-            download_name='annotated_document.pdf'
+            download_name=download_name
         )
+        response.headers['X-Merged-Rows'] = str(count)
+        return response
     
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        return jsonify({'error': f'Error generating PDF: {str(e)}'}), 500
+        print(f"ERROR in mail merge: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Error running mail merge: {str(e)}'}), 500
 
 @app.route('/api/insert-page', methods=['POST'])
+@admission.limit('insert-page', cost=estimate_render_cost)
+@memory_budget.limit
 def insert_page():
     """Insert an empty page into the PDF at specified position"""
     try:
-        data = request.get_json()
+        try:
+            data = load_request_body()
+        except ValueError as e:
+            return jsonify({'error': f'Invalid request body: {str(e)}'}), 400
         
         if not data:
             return jsonify({'error': 'No JSON data provided'}), 400
             
         # Get required parameters
-        pdf_data = data.get('pdfData')
         page_index = data.get('pageIndex')  # 0-based index where to insert
         position = data.get('position')  # 'before' or 'after'
         
-        if not pdf_data:
+        if not data.get('pdfData'):
             return jsonify({'error': 'PDF data is required'}), 400
             
         if page_index is None:
@@ -766,11 +977,12 @@ def insert_page():
         if position not in ['before', 'after']:
             return jsonify({'error': 'Position must be "before" or "after"'}), 400
         
-        # Decode the PDF data
-        pdf_bytes = base64.b64decode(pdf_data)
+        # Decode the PDF data and drop the base64 string
+        pdf_bytes = take_base64_payload(data, 'pdfData')
         
         # Read the original PDF
         reader = PdfReader(BytesIO(pdf_bytes))
+        annotate(document_bytes=len(pdf_bytes), pages=len(reader.pages))
         writer = PdfWriter()
         
         # Calculate actual insertion index
@@ -817,8 +1029,8 @@ def insert_page():
         writer.write(output_buffer)
         output_buffer.seek(0)
         
-        # Convert to base64 for response
-        modified_pdf_data = base64.b64encode(output_buffer.getvalue()).decode('utf-8')
+        # Convert to base64 for response, straight from the buffer
+        modified_pdf_data = base64.b64encode(output_buffer.getbuffer()).decode('utf-8')
         
         return jsonify({
             'success': True,
@@ -834,6 +1046,64 @@ def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'message': 'PDF Annotation API is running'})
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Queue depths, memory use and cache statistics for monitoring"""
+    return jsonify({
+        'admission': admission.stats(),
+        'memory_budget': memory_budget.stats(),
+        'document_cache': document_cache.stats(),
+        'thumbnails': thumbnails.stats(),
+        'glyph_coverage': GLYPH_COVERAGE.stats(),
+        'overlay_cache': overlay_cache.stats(),
+        'output_cache': output_cache.stats(),
+        'search_index': search_index.stats(),
+        'autosave': autosave.stats()
+    })
+
+@app.route('/api/profiles', methods=['GET'])
+def list_profiles():
+    """List stored request profiles (requires the profiling token)"""
+    if not request_profiler.is_authorized():
+        return jsonify({'error': 'Profiling token required'}), 403
+    
+    profiles = request_profiler.list_profiles()
+    return jsonify({
+        'success': True,
+        'profiles': profiles,
+        'count': len(profiles)
+    })
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """
+    Download a stored profile as a pstats file (open with snakeviz or pstats),
+    or as a text report with ?format=text&sort=cumulative|tottime.
+    """
+    if not request_profiler.is_authorized():
+        return jsonify({'error': 'Profiling token required'}), 403
+    
+    if not request_profiler.is_valid_id(profile_id):
+        return jsonify({'error': 'Profile not found'}), 404
+    
+    try:
+        if request.args.get('format') == 'text':
+            sort = request.args.get('sort', 'cumulative')
+            if sort not in ['cumulative', 'tottime', 'calls']:
+                return jsonify({'error': 'sort must be cumulative, tottime or calls'}), 400
+            report = request_profiler.render_text(profile_id, sort=sort)
+            return report, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+        
+        return send_file(
+            os.path.abspath(request_profiler.profile_path(profile_id)),
+            mimetype='application/octet-stream',
+            as_attachment=True,
+            download_name=f'{profile_id}.prof'
+        )
+    
+    except Exception as e:
+        return jsonify({'error': f'Error reading profile: {str(e)}'}), 500
+
 @app.route('/api/available-fonts', methods=['GET'])
 def get_available_fonts():
     """Get list of available font families from bundled fonts"""
@@ -843,6 +1113,55 @@ def get_available_fonts():
         'count': len(AVAILABLE_FONT_FAMILIES)
     })
 
+# Longest text /api/font-coverage checks
+FONT_COVERAGE_MAX_TEXT = 10000
+
+@app.route('/api/font-coverage', methods=['GET'])
+def font_coverage():
+    """
+    Report which font families can draw a string.
+    Query parameters: text, and optionally font_family (with bold, italic) to
+    also get the runs the renderer would draw with its fallback fonts.
+    """
+    try:
+        text = request.args.get('text', '')
+        if not text:
+            return jsonify({'error': 'text is required'}), 400
+        if len(text) > FONT_COVERAGE_MAX_TEXT:
+            return jsonify({'error': f'text is limited to {FONT_COVERAGE_MAX_TEXT} characters'}), 400
+        
+        families = []
+        for family in AVAILABLE_FONT_FAMILIES:
+            coverage = GLYPH_COVERAGE.coverage(map_font_family(family))
+            missing = coverage.missing(text) if coverage is not None else []
+            families.append({'family': family, 'covers': not missing, 'missing': missing})
+        
+        response = {
+            'success': True,
+            'text': text,
+            'covering_families': [entry['family'] for entry in families if entry['covers']],
+            'families': families
+        }
+        
+        font_family = request.args.get('font_family')
+        if font_family:
+            bold = request.args.get('bold', 'false').lower() == 'true'
+            italic = request.args.get('italic', 'false').lower() == 'true'
+            fonts = fallback_fonts(map_font_family(font_family, bold, italic), bold, italic)
+            coverages = [GLYPH_COVERAGE.coverage(font) for font in fonts]
+            response['font_family'] = font_family
+            response['runs'] = [{'font': font, 'text': run} for font, run in GLYPH_COVERAGE.split_runs(text, fonts)]
+            # Characters no font in the fallback chain can draw
+            response['uncovered'] = [
+                char for char in dict.fromkeys(text)
+                if not char.isspace() and not any(coverage and coverage.covers(char) for coverage in coverages)
+            ]
+        
+        return jsonify(response)
+    
+    except Exception as e:
+        return jsonify({'error': f'Error checking font coverage: {str(e)}'}), 500
+
 @app.route('/api/fonts/<path:font_family>', methods=['GET'])
 def get_font_file(font_family):
     """Serve font files for web use"""
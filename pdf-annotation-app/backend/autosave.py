@@ -0,0 +1,280 @@
+"""
+Write-behind buffer for frequent annotation saves.
+
+While someone is typing, the editor may save every second or two. Each
+save used to rewrite the whole project file. With the buffer, a save
+only replaces the project's annotations in memory and marks it dirty;
+a background thread writes dirty projects once they have been dirty for
+flush_interval seconds, so a burst of saves becomes a single write.
+
+Durability modes (AUTOSAVE_DURABILITY):
+
+- 'interval' (default): written at most flush_interval seconds after the
+  first unsaved change
+- 'immediate': every save is written straight through (no buffering)
+- 'commit': written only on an explicit commit or at shutdown
+
+Pending changes are also flushed on SIGTERM and at interpreter exit. A
+hard crash (SIGKILL, power loss) loses at most the changes not yet
+flushed, which is the trade-off the interval bounds.
+
+Writes of a project happen under its project store lock, the same lock a
+full save holds while it replaces the project. discard(), called by full
+saves, takes that lock too, so a write that was already under way has
+either finished or is cancelled; it can never land after the full save.
+
+stats() reports saves received, writes performed and the bytes the
+clients sent versus the bytes written, i.e. the write amplification.
+"""
+import atexit
+import copy
+import json
+import os
+import signal
+import threading
+import time
+
+DURABILITY_MODES = ('interval', 'immediate', 'commit')
+
+
+class PendingProject:
+    """A project with changes that have not been written yet"""
+
+    def __init__(self, project):
+        self.project = project
+        self.dirty_since = time.monotonic()
+        self.saves = 0
+        self.generation = 0
+
+
+class WriteBehindBuffer:
+    """Coalesces annotation saves per project and writes them behind the request"""
+
+    def __init__(self, project_store, flush_interval=5.0, durability='interval', on_flush=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Durability must be one of {', '.join(DURABILITY_MODES)}")
+        self.project_store = project_store
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.on_flush = on_flush
+        self.saves_received = 0
+        self.bytes_received = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.flush_errors = 0
+        self.coalesced_saves = 0
+        self._generation = 0
+        self._pending = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._worker = None
+
+    @classmethod
+    def from_environment(cls, project_store, on_flush=None):
+        return cls(
+            project_store,
+            flush_interval=float(os.environ.get('AUTOSAVE_FLUSH_INTERVAL', 5)),
+            durability=os.environ.get('AUTOSAVE_DURABILITY', 'interval'),
+            on_flush=on_flush,
+        )
+
+    def start(self):
+        """Start the background flusher (not needed in 'immediate' mode)"""
+        if self.durability == 'interval' and self._worker is None:
+            self._worker = threading.Thread(target=self._run, name='autosave-flusher', daemon=True)
+            self._worker.start()
+
+    def install_shutdown_hooks(self):
+        """Flush pending changes at exit and on SIGTERM, then let SIGTERM do what it did before"""
+        atexit.register(self.shutdown)
+        try:
+            previous = signal.getsignal(signal.SIGTERM)
+
+            def handle_sigterm(signum, frame):
+                print("SIGTERM received, flushing pending project saves")
+                self.shutdown()
+                signal.signal(signal.SIGTERM, previous if previous is not None else signal.SIG_DFL)
+                if callable(previous):
+                    previous(signum, frame)
+                else:
+                    os.kill(os.getpid(), signal.SIGTERM)
+
+            signal.signal(signal.SIGTERM, handle_sigterm)
+        except ValueError:
+            # Signal handlers can only be installed from the main thread
+            print("WARNING: autosave could not install a SIGTERM handler (not in main thread)")
+
+    def stage(self, project_id, annotations, metadata=None, payload_size=None):
+        """
+        Record new annotations (and optionally metadata) for a project.
+        Returns True if the change was written immediately, False if it is pending.
+        Raises KeyError if the project doesn't exist.
+        """
+        if payload_size is None:
+            payload_size = len(json.dumps(annotations))
+
+        with self._lock:
+            staged = self._apply(project_id, None, annotations, metadata, payload_size)
+        if not staged:
+            # Nothing buffered to build on: load the stored project outside the buffer lock. The
+            # project lock keeps a full save from replacing it between the load and the staging.
+            with self.project_store.lock(project_id):
+                project = self.project_store.load(project_id)
+                if project is None:
+                    raise KeyError(project_id)
+                with self._lock:
+                    self._apply(project_id, project, annotations, metadata, payload_size)
+
+        if self.durability == 'immediate':
+            self.flush(project_id)
+            return True
+        return False
+
+    def _apply(self, project_id, loaded, annotations, metadata, payload_size):
+        """
+        Stage changes on the pending project, else on a copy of the one being
+        written, else on loaded. Returns False if there was nothing to build on.
+        Called with the buffer lock held.
+        """
+        pending = self._pending.get(project_id)
+        if pending is None:
+            writing = self._in_flight.get(project_id)
+            if writing is not None:
+                # Build on the version being written, which the store doesn't have yet
+                project = copy.copy(writing.project)
+                project.metadata = dict(writing.project.metadata)
+            elif loaded is not None:
+                project = loaded
+            else:
+                return False
+            pending = PendingProject(project)
+            self._pending[project_id] = pending
+        pending.project.annotations = annotations
+        if metadata:
+            pending.project.metadata.update(metadata)
+        pending.saves += 1
+        self._generation += 1
+        pending.generation = self._generation
+        self.saves_received += 1
+        self.bytes_received += payload_size
+        return True
+
+    def _buffered(self, project_id):
+        """The newest PendingProject of a project, pending or being written. Called with the buffer lock held."""
+        return self._pending.get(project_id) or self._in_flight.get(project_id)
+
+    def get(self, project_id):
+        """The project including unsaved changes, or None if it has none pending"""
+        with self._lock:
+            pending = self._buffered(project_id)
+            return pending.project if pending is not None else None
+
+    def load(self, project_id):
+        """Load a project as the editor last saved it, pending changes included"""
+        return self.get(project_id) or self.project_store.load(project_id)
+
+    def revision(self, project_id):
+        """
+        Like ProjectStore.revision(), but also changes whenever changes are
+        staged, for caches of data derived from load(). None if the project doesn't exist.
+        """
+        with self._lock:
+            pending = self._buffered(project_id)
+            generation = pending.generation if pending is not None else 0
+        stored = self.project_store.revision(project_id)
+        if stored is None and pending is None:
+            return None
+        return stored, generation
+
+    def discard(self, project_id):
+        """
+        Drop pending changes, e.g. because a full save replaces them. A write
+        of the project that is under way is waited for; one not yet started is cancelled.
+        """
+        with self.project_store.lock(project_id):
+            with self._lock:
+                self._pending.pop(project_id, None)
+                self._in_flight.pop(project_id, None)
+
+    def flush(self, project_id=None, older_than=None):
+        """
+        Write pending projects: one project, or all of them; with older_than,
+        only those dirty for at least that many seconds. Returns the number written.
+        """
+        with self._flush_lock:
+            now = time.monotonic()
+            with self._lock:
+                if project_id is not None:
+                    ids = [project_id] if project_id in self._pending else []
+                else:
+                    ids = [pid for pid, pending in self._pending.items()
+                           if older_than is None or now - pending.dirty_since >= older_than]
+                batch = [(pid, self._pending.pop(pid)) for pid in ids]
+                for pid, pending in batch:
+                    self._in_flight[pid] = pending
+
+            written = 0
+            for pid, pending in batch:
+                with self.project_store.lock(pid):
+                    with self._lock:
+                        cancelled = self._in_flight.get(pid) is not pending
+                    if cancelled:
+                        # Discarded by a full save, which has written a newer version
+                        continue
+                    try:
+                        nbytes = self.project_store.save(pending.project)
+                    except Exception as e:
+                        print(f"ERROR flushing project {pid}: {e}")
+                        with self._lock:
+                            del self._in_flight[pid]
+                            self.flush_errors += 1
+                            # Keep the changes unless newer ones (built on top of them) arrived meanwhile
+                            self._pending.setdefault(pid, pending)
+                        continue
+                    with self._lock:
+                        del self._in_flight[pid]
+                written += 1
+                with self._lock:
+                    self.writes += 1
+                    self.coalesced_saves += pending.saves - 1
+                    self.bytes_written += nbytes or 0
+                if self.on_flush:
+                    self.on_flush(pid)
+            return written
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(max(self.flush_interval / 2, 0.05))
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            self.flush(older_than=self.flush_interval)
+
+    def shutdown(self):
+        """Stop the flusher and write everything still pending"""
+        self._stopped = True
+        self._wakeup.set()
+        flushed = self.flush()
+        if flushed:
+            print(f"Flushed {flushed} pending project saves")
+
+    def stats(self):
+        with self._lock:
+            oldest = min((pending.dirty_since for pending in self._pending.values()), default=None)
+            return {
+                'durability': self.durability,
+                'flush_interval': self.flush_interval,
+                'dirty_projects': len(self._pending),
+                'oldest_dirty_seconds': round(time.monotonic() - oldest, 1) if oldest is not None else 0,
+                'saves_received': self.saves_received,
+                'writes': self.writes,
+                'coalesced_saves': self.coalesced_saves,
+                'bytes_received': self.bytes_received,
+                'bytes_written': self.bytes_written,
+                'write_amplification': round(self.bytes_written / self.bytes_received, 3)
+                if self.bytes_received else None,
+                'flush_errors': self.flush_errors,
+            }
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Headless batch rendering of saved projects to annotated PDFs.
+
+Renders project files with the same engine as /api/generate-pdf
+(renderer.generate_annotated_pdf), without the HTTP round trip and its
+JSON and base64 encoding. Project files are rendered in a pool of worker
+processes; each output is written to a temp file and renamed into place,
+so an interrupted run never leaves a partial PDF behind. Running the
+same command again resumes it: outputs newer than their project file are
+skipped.
+
+The parent process only lists files and hands them out. The renderer,
+pypdf and reportlab are imported by the workers on their first job, and
+fonts are registered only when a page with annotations is drawn.
+
+Usage:
+    python batch_render.py ../projects
+    python batch_render.py project_<id>.pkl ... --output-dir out/ [--jobs N]
+    python batch_render.py ../projects --force --optimize --overlay-cache
+    python batch_render.py ../projects --image-dpi 150 [--image-quality 75] [--image-format jpeg]
+
+A project whose PDF lives in the blob store needs the store it was saved
+in (--projects, default PROJECTS_FOLDER); older projects that embed the
+PDF or keep it next to the project file are rendered on their own.
+"""
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from project_store import DEFAULT_PROJECTS_FOLDER, LOCK_DIR_NAME, TEMP_PREFIX
+
+OUTPUT_SUFFIX = '.annotated.pdf'
+
+# Jobs handed to the pool ahead of the workers, per worker
+QUEUE_DEPTH = 4
+
+
+def find_project_files(paths):
+    """Project files among paths; directories are searched recursively"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if d != LOCK_DIR_NAME and not d.startswith('.'))
+                found.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.endswith('.pkl') and not name.startswith(TEMP_PREFIX))
+        elif os.path.isfile(path):
+            found.append(path)
+        else:
+            print(f"  Warning: {path} does not exist", file=sys.stderr)
+    return found
+
+def output_path_for(project_path, output_dir=None):
+    name = os.path.splitext(os.path.basename(project_path))[0] + OUTPUT_SUFFIX
+    return os.path.join(output_dir or os.path.dirname(project_path), name)
+
+def is_up_to_date(project_path, output_path):
+    try:
+        return os.path.getmtime(output_path) >= os.path.getmtime(project_path)
+    except OSError:
+        return False
+
+
+# Per worker process state, set up on the first job
+_stores = {}
+_overlay_cache = None
+
+def _open_store(folder):
+    from project_store import FilesystemBackend, ProjectStore
+
+    if folder not in _stores:
+        _stores[folder] = ProjectStore(FilesystemBackend(folder)) if os.path.isdir(folder) else None
+    return _stores[folder]
+
+def _open_pdf(project, project_path, projects_folder):
+    """Binary file object with the project's PDF"""
+    from project_store import ProjectStore
+
+    if getattr(project, 'pdf_sha256', None):
+        store = _open_store(projects_folder)
+        if store is None:
+            raise FileNotFoundError(f'Project store {projects_folder} not found')
+        return store.open_pdf(project)
+    if getattr(project, 'pdf_data', None):
+        return io.BytesIO(base64.b64decode(project.pdf_data))
+    # Flat layout of older versions: the PDF is a file next to the project
+    return open(os.path.join(os.path.dirname(project_path), ProjectStore.legacy_pdf_key(project.project_id)), 'rb')
+
+def _write_atomic(path, output):
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix='.pdf', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(output.getbuffer())
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+def render_project_file(project_path, output_path, projects_folder, optimize=False, overlay_cache=False, verbose=False,
+                        image_options=None):
+    """Render one project file to output_path. Runs in a worker process."""
+    global _overlay_cache
+    from pypdf import PdfReader
+
+    from project_store import load_project_bytes
+    from renderer import generate_annotated_pdf
+
+    if overlay_cache and _overlay_cache is None:
+        from overlay_cache import RenderCache
+        _overlay_cache = RenderCache.from_environment('overlays', memory_mb=64, disk_mb=512)
+
+    start_time = time.perf_counter()
+    with open(project_path, 'rb') as f:
+        project = load_project_bytes(f.read())
+
+    # The renderer reports every page; keep that out of the batch output unless asked for
+    log = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with log, _open_pdf(project, project_path, projects_folder) as pdf_file:
+        pdf_reader = PdfReader(pdf_file)
+        output, stats = generate_annotated_pdf(pdf_reader, project.annotations, optimize,
+                                               _overlay_cache if overlay_cache else None, image_options)
+        page_count = len(pdf_reader.pages)
+
+    _write_atomic(output_path, output)
+    return {
+        'project': project_path,
+        'output': output_path,
+        'pages': page_count,
+        'annotations': len(project.annotations),
+        'bytes': output.getbuffer().nbytes,
+        'images_replaced': stats['images']['replaced'] if stats['images'] else 0,
+        'seconds': round(time.perf_counter() - start_time, 3),
+    }
+
+
+def run_batch(jobs, workers, optimize=False, overlay_cache=False, verbose=False, projects_folder=DEFAULT_PROJECTS_FOLDER,
+              image_options=None):
+    """
+    Render (project_path, output_path) jobs in a process pool.
+    Returns a report with the rendered and failed projects.
+    """
+    report = {'rendered': [], 'failed': [], 'interrupted': False}
+    pending = iter(jobs)
+    in_flight = {}
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            # Keep a bounded number of jobs queued, so an interrupted run has little to abandon
+            while len(in_flight) < workers * QUEUE_DEPTH:
+                job = next(pending, None)
+                if job is None:
+                    break
+                project_path, output_path = job
+                future = executor.submit(render_project_file, project_path, output_path, projects_folder,
+                                         optimize, overlay_cache, verbose, image_options)
+                in_flight[future] = project_path
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                project_path = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"FAILED {project_path}: {e}", file=sys.stderr)
+                    report['failed'].append({'project': project_path, 'error': str(e)})
+                else:
+                    print(f"Rendered {result['output']} ({result['pages']} pages, "
+                          f"{result['annotations']} annotations, {result['seconds']:.2f}s)")
+                    report['rendered'].append(result)
+    except KeyboardInterrupt:
+        report['interrupted'] = True
+        print("Interrupted; finished outputs are kept, run again to resume", file=sys.stderr)
+        executor.shutdown(wait=True, cancel_futures=True)
+        return report
+    executor.shutdown()
+    return report
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Render saved projects to annotated PDFs')
+    parser.add_argument('paths', nargs='+', help='Project files (.pkl) or directories to search for them')
+    parser.add_argument('--output-dir', help='Write outputs here instead of next to each project file')
+    parser.add_argument('--projects', default=DEFAULT_PROJECTS_FOLDER,
+                        help='Project store holding the PDF blobs (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes (default: %(default)s)')
+    parser.add_argument('--force', action='store_true', help='Re-render projects whose output is up to date')
+    parser.add_argument('--optimize', action='store_true', help='Optimize each output like generate-pdf optimize=true')
+    parser.add_argument('--overlay-cache', action='store_true',
+                        help="Reuse and fill the server's on-disk overlay cache (RENDER_CACHE_FOLDER)")
+    parser.add_argument('--image-dpi', type=int,
+                        help='Downsample page images to this resolution (default: keep images as they are)')
+    parser.add_argument('--image-quality', type=int, help='JPEG quality of downsampled images, 1-95')
+    parser.add_argument('--image-format', help='Encoding of downsampled images: jpeg (default) or flate')
+    parser.add_argument('--verbose', action='store_true', help="Show the renderer's per-page output")
+    parser.add_argument('--json', action='store_true', help='Also print the report as JSON')
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    image_options = None
+    if args.image_dpi:
+        from image_optimize import normalize_image_options
+
+        try:
+            image_options = normalize_image_options(args.image_dpi, args.image_quality, args.image_format)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = []
+    skipped = 0
+    for project_path in find_project_files(args.paths):
+        output_path = output_path_for(project_path, args.output_dir)
+        if not args.force and is_up_to_date(project_path, output_path):
+            skipped += 1
+        else:
+            jobs.append((project_path, output_path))
+    print(f"{len(jobs)} projects to render, {skipped} up to date")
+
+    start_time = time.perf_counter()
+    report = run_batch(jobs, max(1, args.jobs), args.optimize, args.overlay_cache, args.verbose,
+                       os.path.abspath(args.projects), image_options)
+    report['skipped'] = skipped
+    report['seconds'] = round(time.perf_counter() - start_time, 3)
+
+    print(f"Rendered {len(report['rendered'])}, failed {len(report['failed'])}, skipped {skipped} "
+          f"in {report['seconds']:.1f}s")
+    if args.json:
+        print(json.dumps(report))
+    return 1 if report['failed'] or report['interrupted'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+In-process cache of parsed source documents.
+
+Parsing a PDF is the expensive part of rendering a small preview, so
+parsed readers are kept in a size-bounded LRU keyed by the SHA-256 of
+the document bytes. pypdf readers are not safe to use from several
+threads at once, so every entry carries a lock that callers hold while
+they read pages from it.
+
+With SHARED_DOCUMENT_CACHE_DIR set, a document missing here is looked up
+in the shared cache (shared_cache.py) before it is loaded and parsed, and
+documents added here are added there too, so every worker on the machine
+maps one copy of a document instead of parsing its own.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from pypdf import PdfReader
+
+from shared_cache import SharedDocumentCache
+
+MB = 1024 * 1024
+
+
+def document_hash(pdf_bytes):
+    """Content hash used as the cache key for a document"""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+class CachedDocument:
+    """A parsed document plus the lock that guards access to its reader"""
+
+    def __init__(self, digest, pdf_bytes):
+        self.digest = digest
+        self.size = len(pdf_bytes)
+        self.reader = PdfReader(BytesIO(pdf_bytes))
+        self.page_count = len(self.reader.pages)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_shared(cls, shared_document):
+        """A document opened from its mapping in the shared cache; pages are loaded on first use"""
+        document = cls.__new__(cls)
+        document.digest = shared_document.digest
+        document.size = shared_document.size
+        document.reader = shared_document.open_reader()
+        document.page_count = shared_document.page_count
+        document.lock = threading.Lock()
+        return document
+
+
+class DocumentCache:
+    """LRU of CachedDocument, bounded by entry count and total document bytes"""
+
+    def __init__(self, max_entries=32, max_bytes=256 * MB, shared=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            max_entries=int(os.environ.get('DOCUMENT_CACHE_ENTRIES', 32)),
+            max_bytes=int(float(os.environ.get('DOCUMENT_CACHE_MB', 256)) * MB),
+            shared=SharedDocumentCache.from_environment(),
+        )
+
+    def get(self, digest):
+        """Return the cached document for digest (from this process or the shared cache), or None"""
+        with self._lock:
+            document = self._entries.get(digest)
+            if document is not None:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return document
+            self.misses += 1
+
+        if self.shared is None:
+            return None
+        shared_document = self.shared.get(digest)
+        if shared_document is None:
+            return None
+        return self._insert(CachedDocument.from_shared(shared_document))
+
+    def put(self, pdf_bytes, digest=None):
+        """Parse and cache a document (or return the cached one). Returns the CachedDocument."""
+        digest = digest or document_hash(pdf_bytes)
+        existing = self.get(digest)
+        if existing is not None:
+            return existing
+
+        # Parse outside the lock so other requests aren't held up
+        document = CachedDocument(digest, pdf_bytes)
+        if self.shared is not None:
+            try:
+                document = CachedDocument.from_shared(self.shared.put(digest, pdf_bytes, document.reader))
+            except OSError as e:
+                print(f"  Warning: Could not add {digest[:12]} to the shared document cache: {e}")
+        return self._insert(document)
+
+    def _insert(self, document):
+        digest = document.digest
+        if document.size > self.max_bytes:
+            return document
+
+        with self._lock:
+            if digest in self._entries:
+                return self._entries[digest]
+            self._entries[digest] = document
+            self.total_bytes += document.size
+            while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+        return document
+
+    def get_or_load(self, digest, loader):
+        """Return the cached document for digest, calling loader() for the bytes on a miss"""
+        document = self.get(digest)
+        if document is None:
+            document = self.put(loader(), digest)
+        return document
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
@@ -0,0 +1,190 @@
+"""
+Glyph coverage of the registered fonts, for per-character font fallback.
+
+A font that has no glyph for a character draws nothing for it, so an
+accented name in Pacifico or a CJK word in Arial used to come out with
+blanks. The coverage index records, for every registered font, which
+code points its cmap maps, as a bitset with one bit per code point:
+checking a character is a single byte lookup, cheap enough to do for
+every character of every annotation.
+
+split_runs() uses the index to cut a string into runs, each drawn with
+the first font of a fallback chain that has all of the run's glyphs.
+
+Coverage is extracted from the TrueType cmap when the fonts are
+registered and kept as code point ranges in a JSON file in the render
+cache folder, keyed by font file size and modification time, so an
+unchanged font is not re-scanned on the next start. The 14 standard PDF
+fonts draw text in WinAnsi encoding; their coverage is that character set.
+"""
+import json
+import os
+import tempfile
+
+# Code points the built-in Helvetica/Times/Courier fonts can draw
+WINANSI_CODEPOINTS = frozenset(
+    ord(bytes([byte]).decode('cp1252')) for byte in range(32, 256)
+    if byte not in (0x81, 0x8D, 0x8F, 0x90, 0x9D))
+
+STANDARD_FONT_PREFIXES = ('Helvetica', 'Times-', 'Courier')
+
+COVERAGE_CACHE_VERSION = 1
+
+
+def codepoint_ranges(codepoints):
+    """Sorted inclusive [start, end] ranges of a collection of code points"""
+    ranges = []
+    for cp in sorted(set(codepoints)):
+        if ranges and cp == ranges[-1][1] + 1:
+            ranges[-1][1] = cp
+        else:
+            ranges.append([cp, cp])
+    return ranges
+
+
+class FontCoverage:
+    """Set of code points a font has glyphs for, stored as a bitset"""
+
+    __slots__ = ('bits', 'count', 'printable_ascii')
+
+    def __init__(self, bits, count):
+        self.bits = bits
+        self.count = count
+        # Most annotation text is plain ASCII; when the font has all of it, no per-character check is needed
+        self.printable_ascii = all(self.covers(chr(cp)) for cp in range(0x20, 0x7F))
+
+    @classmethod
+    def from_codepoints(cls, codepoints):
+        codepoints = [cp for cp in codepoints if 0 <= cp <= 0x10FFFF]
+        bits = bytearray((max(codepoints, default=0) >> 3) + 1)
+        for cp in codepoints:
+            bits[cp >> 3] |= 1 << (cp & 7)
+        return cls(bits, len(set(codepoints)))
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        return cls.from_codepoints(cp for start, end in ranges for cp in range(start, end + 1))
+
+    def covers(self, char):
+        cp = ord(char)
+        index = cp >> 3
+        return index < len(self.bits) and bool(self.bits[index] & (1 << (cp & 7)))
+
+    def covers_text(self, text):
+        """True if every character of text other than whitespace has a glyph"""
+        if self.printable_ascii and text.isascii():
+            return True
+        covers = self.covers
+        return all(covers(char) for char in text if not char.isspace())
+
+    def missing(self, text):
+        """Characters of text (other than whitespace) without a glyph, in order of appearance"""
+        seen = []
+        for char in text:
+            if not char.isspace() and not self.covers(char) and char not in seen:
+                seen.append(char)
+        return seen
+
+
+WINANSI_COVERAGE = FontCoverage.from_codepoints(WINANSI_CODEPOINTS)
+
+
+class GlyphCoverageIndex:
+    """Coverage of every registered font, keyed by registered font name"""
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.fonts = {}
+        self._cached = self._read_cache()
+        self._entries = {}
+        self._dirty = False
+
+    def _read_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != COVERAGE_CACHE_VERSION:
+                return {}
+            return data.get('fonts', {})
+        except (OSError, ValueError) as e:
+            print(f"  Warning: Ignoring unreadable glyph coverage cache: {e}")
+            return {}
+
+    def add_ttfont(self, name, path, font):
+        """Index a reportlab TTFont registered as name from the file at path"""
+        stat = os.stat(path)
+        signature = f'{stat.st_size}:{stat.st_mtime_ns}'
+        cached = self._cached.get(name)
+        if cached and cached.get('signature') == signature:
+            entry = cached
+        else:
+            entry = {'signature': signature, 'ranges': codepoint_ranges(font.face.charToGlyph)}
+            self._dirty = True
+        coverage = FontCoverage.from_ranges(entry['ranges'])
+        self.fonts[name] = coverage
+        self._entries[name] = entry
+        return coverage
+
+    def save(self):
+        """Write the coverage of the indexed fonts to the cache file, if anything changed"""
+        if not self.cache_path or not (self._dirty or set(self._cached) != set(self._entries)):
+            return
+        try:
+            directory = os.path.dirname(self.cache_path) or '.'
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'version': COVERAGE_CACHE_VERSION, 'fonts': self._entries}, f)
+            os.replace(temp_path, self.cache_path)
+            self._cached = dict(self._entries)
+            self._dirty = False
+        except OSError as e:
+            print(f"  Warning: Failed to write glyph coverage cache: {e}")
+
+    def coverage(self, font_name):
+        """Coverage of a registered or standard font; None if the font is unknown"""
+        coverage = self.fonts.get(font_name)
+        if coverage is None and font_name.startswith(STANDARD_FONT_PREFIXES):
+            return WINANSI_COVERAGE
+        return coverage
+
+    def split_runs(self, text, fonts):
+        """
+        Split text into (font, substring) runs. Each character is drawn with the
+        first font in fonts that covers it; whitespace stays in the current run,
+        and characters no font covers stay with the first font.
+        """
+        if not text or not fonts:
+            return [(fonts[0] if fonts else None, text)]
+        coverages = [(font, self.coverage(font)) for font in fonts]
+        primary, primary_coverage = coverages[0]
+        if primary_coverage is None or primary_coverage.covers_text(text):
+            return [(primary, text)]
+
+        runs = []
+        current_font = primary
+        current = []
+        for char in text:
+            font = current_font
+            if not char.isspace():
+                font = primary
+                for candidate, coverage in coverages:
+                    if coverage is not None and coverage.covers(char):
+                        font = candidate
+                        break
+            if font != current_font and current:
+                runs.append((current_font, ''.join(current)))
+                current = []
+            current_font = font
+            current.append(char)
+        if current:
+            runs.append((current_font, ''.join(current)))
+        return runs
+
+    def stats(self):
+        return {
+            'fonts': len(self.fonts),
+            'bitset_bytes': sum(len(coverage.bits) for coverage in self.fonts.values()),
+        }
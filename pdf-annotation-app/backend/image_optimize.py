@@ -0,0 +1,238 @@
+"""
+Image downsampling and recompression for exported PDFs.
+
+Scanned sources often carry 300-600 DPI lossless page images, which the
+export copies unchanged. downsample_images() rewrites the image XObjects
+of a PdfWriter before it is written:
+
+- the pixel budget of an image is the size of the largest page showing it
+  (long side, in inches) times the target DPI; larger images are scaled
+  down to it. Images drawn smaller than the page keep some surplus
+  resolution, but nothing is ever scaled below what the page can show.
+- images are re-encoded as JPEG (or Flate, for line art that JPEG would
+  smear) and only replaced when the result is smaller
+- an image used by many pages, or stored several times with identical
+  content, is processed once
+
+Decoding, resampling and encoding run in a thread pool: Pillow releases
+the GIL for that work, so images are processed on several cores without
+copying them to other processes. The annotation overlays contain no
+images and come out unchanged.
+
+Masks, bilevel and 16-bit images, CMYK and images in filters Pillow
+can't decode (JBIG2, CCITT, JPX) are left as they are.
+"""
+import hashlib
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+from pypdf.filters import _xobj_to_image
+from pypdf.generic import ArrayObject, IndirectObject, NameObject, NumberObject, StreamObject
+
+DEFAULT_IMAGE_DPI = 150
+MIN_IMAGE_DPI = 36
+MAX_IMAGE_DPI = 1200
+DEFAULT_IMAGE_QUALITY = 75
+IMAGE_FORMATS = ('jpeg', 'flate')
+
+# Threads that decode, resample and encode images (IMAGE_OPTIMIZE_WORKERS)
+IMAGE_OPTIMIZE_WORKERS = int(os.environ.get('IMAGE_OPTIMIZE_WORKERS', os.cpu_count() or 1))
+
+# Images whose stream is smaller than this are not worth re-encoding
+MIN_IMAGE_BYTES = 16 * 1024
+
+LOSSY_FILTERS = {'/DCTDecode', '/JPXDecode'}
+UNSUPPORTED_FILTERS = {'/JBIG2Decode', '/CCITTFaxDecode', '/JPXDecode'}
+
+# Entries describing the encoding, replaced when an image is re-encoded
+ENCODING_KEYS = {'/Filter', '/DecodeParms', '/Length', '/Width', '/Height', '/ColorSpace', '/BitsPerComponent'}
+
+
+def normalize_image_options(dpi=None, quality=None, image_format=None):
+    """Validated image options; raises ValueError for values out of range"""
+    dpi = int(dpi if dpi is not None else DEFAULT_IMAGE_DPI)
+    quality = int(quality if quality is not None else DEFAULT_IMAGE_QUALITY)
+    image_format = (image_format or 'jpeg').lower()
+    if not MIN_IMAGE_DPI <= dpi <= MAX_IMAGE_DPI:
+        raise ValueError(f'Image DPI must be between {MIN_IMAGE_DPI} and {MAX_IMAGE_DPI}')
+    if not 1 <= quality <= 95:
+        raise ValueError('Image quality must be between 1 and 95')
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Image format must be one of {', '.join(IMAGE_FORMATS)}")
+    return {'dpi': dpi, 'quality': quality, 'image_format': image_format}
+
+def _filters(xobject):
+    filters = xobject.get('/Filter')
+    if filters is None:
+        return []
+    filters = filters.get_object()
+    return [str(f) for f in filters] if isinstance(filters, ArrayObject) else [str(filters)]
+
+def _output_colorspace(xobject):
+    """(PIL mode, /ColorSpace to write) for an image, or None if its color space isn't handled"""
+    colorspace = xobject.get('/ColorSpace')
+    colorspace = colorspace.get_object() if colorspace is not None else None
+    if colorspace == '/DeviceRGB':
+        return 'RGB', colorspace
+    if colorspace == '/DeviceGray':
+        return 'L', colorspace
+    if isinstance(colorspace, ArrayObject) and colorspace:
+        family = colorspace[0]
+        if family == '/ICCBased':
+            components = colorspace[1].get_object().get('/N')
+            if components in (1, 3):
+                # The samples stay in the profile's space, so the profile is kept
+                return ('L' if components == 1 else 'RGB'), colorspace
+        elif family == '/Indexed':
+            return 'RGB', NameObject('/DeviceRGB')
+    return None
+
+def _is_indexed(xobject):
+    colorspace = xobject['/ColorSpace'].get_object()
+    return isinstance(colorspace, ArrayObject) and colorspace[0] == '/Indexed'
+
+def _is_candidate(xobject):
+    if set(_filters(xobject)) & UNSUPPORTED_FILTERS:
+        return False
+    if xobject.get('/ImageMask') or '/Mask' in xobject or '/Decode' in xobject:
+        return False
+    if xobject.get('/BitsPerComponent', 8) != 8:
+        return False
+    return len(xobject._data) >= MIN_IMAGE_BYTES and _output_colorspace(xobject) is not None
+
+def _page_pixel_limit(page, dpi):
+    """Pixels along the long side that a full-page image needs at dpi"""
+    box = page.mediabox
+    return max(float(box.width), float(box.height)) / 72 * dpi
+
+def _collect_images(resources, limit, limits, visited):
+    """Record the pixel limit of the images in resources, including those inside forms"""
+    if resources is None:
+        return
+    xobjects = resources.get_object().get('/XObject')
+    if xobjects is None:
+        return
+    for ref in xobjects.get_object().values():
+        if not isinstance(ref, IndirectObject):
+            continue
+        xobject = ref.get_object()
+        subtype = xobject.get('/Subtype')
+        if subtype == '/Image':
+            limits[ref.idnum] = max(limits.get(ref.idnum, 0), limit)
+        elif subtype == '/Form' and ref.idnum not in visited:
+            visited.add(ref.idnum)
+            _collect_images(xobject.get('/Resources'), limit, limits, visited)
+
+def _content_key(xobject, limit):
+    """Identical images with the same pixel limit get the same key"""
+    buffer = BytesIO()
+    xobject.write_to_stream(buffer)
+    return hashlib.sha256(buffer.getvalue() + str(round(limit)).encode()).digest()
+
+def _decode(xobject, mode, size):
+    """PIL image of an image XObject; JPEGs are decoded at reduced size when that still covers size"""
+    if _filters(xobject)[-1:] == ['/DCTDecode']:
+        # get_data() undoes any filters before DCTDecode and leaves the JPEG
+        image = Image.open(BytesIO(xobject.get_data()))
+        image.draft(image.mode if image.mode in ('L', 'RGB') else 'RGB', size)
+        return image
+    if not _is_indexed(xobject):
+        # 8-bit gray or RGB samples: much faster than pypdf's general image conversion
+        samples = xobject.get_data()
+        image_size = (int(xobject['/Width']), int(xobject['/Height']))
+        if len(samples) == image_size[0] * image_size[1] * len(mode):
+            return Image.frombuffer(mode, image_size, samples, 'raw', mode, 0, 1)
+    return _xobj_to_image(xobject)[2]
+
+def recompress_image(xobject, limit, quality=DEFAULT_IMAGE_QUALITY, image_format='jpeg'):
+    """
+    Downsample an image XObject to at most limit pixels along its long side
+    and re-encode it. Returns (data, filter, (width, height), colorspace), or
+    None when the result would not be smaller.
+    """
+    width, height = int(xobject['/Width']), int(xobject['/Height'])
+    mode, colorspace = _output_colorspace(xobject)
+    scale = min(1.0, limit / max(width, height))
+    lossy_source = bool(set(_filters(xobject)[-1:]) & LOSSY_FILTERS)
+    if scale >= 1 and (image_format == 'flate' or lossy_source):
+        # Full resolution and re-encoding can't do better than the source
+        return None
+
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    image = _decode(xobject, mode, size)
+    if image.mode != mode:
+        image = image.convert(mode)
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS)
+
+    if image_format == 'jpeg':
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        data, image_filter = output.getvalue(), '/DCTDecode'
+    else:
+        data, image_filter = zlib.compress(image.tobytes(), 6), '/FlateDecode'
+
+    if len(data) >= len(xobject._data):
+        return None
+    return data, image_filter, image.size, colorspace
+
+def _replacement(xobject, result):
+    data, image_filter, (width, height), colorspace = result
+    stream = StreamObject()
+    for key, value in xobject.items():
+        if key not in ENCODING_KEYS:
+            stream[NameObject(key)] = value
+    stream.update({
+        NameObject('/Filter'): NameObject(image_filter),
+        NameObject('/Width'): NumberObject(width),
+        NameObject('/Height'): NumberObject(height),
+        NameObject('/ColorSpace'): colorspace,
+        NameObject('/BitsPerComponent'): NumberObject(8),
+    })
+    stream._data = data
+    return stream
+
+def downsample_images(pdf_writer, dpi=DEFAULT_IMAGE_DPI, quality=DEFAULT_IMAGE_QUALITY, image_format='jpeg',
+                      workers=None):
+    """
+    Downsample and re-encode the images of pdf_writer's pages in place.
+    Returns stats: images seen, replaced, unchanged and bytes before/after.
+    """
+    limits = {}
+    for page in pdf_writer.pages:
+        _collect_images(page.get('/Resources'), _page_pixel_limit(page, dpi), limits, set())
+
+    # One job per distinct image content; every object with that content gets the result
+    jobs = {}
+    for idnum, limit in limits.items():
+        xobject = pdf_writer._objects[idnum - 1]
+        if _is_candidate(xobject):
+            key = _content_key(xobject, limit)
+            jobs.setdefault(key, (xobject, limit, []))[2].append(idnum)
+
+    def run(job):
+        xobject, limit, idnums = job
+        try:
+            return recompress_image(xobject, limit, quality, image_format)
+        except Exception as e:
+            print(f"  Warning: Leaving image {idnums[0]} unchanged: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers or IMAGE_OPTIMIZE_WORKERS)) as executor:
+        results = list(executor.map(run, jobs.values()))
+
+    stats = {'images': len(limits), 'distinct': len(jobs), 'replaced': 0, 'bytes_before': 0, 'bytes_after': 0}
+    for (xobject, limit, idnums), result in zip(jobs.values(), results):
+        if result is None:
+            continue
+        for idnum in idnums:
+            replacement = _replacement(pdf_writer._objects[idnum - 1], result)
+            stats['bytes_before'] += len(pdf_writer._objects[idnum - 1]._data)
+            stats['bytes_after'] += len(replacement._data)
+            pdf_writer._objects[idnum - 1] = replacement
+            stats['replaced'] += 1
+    stats['unchanged'] = stats['images'] - stats['replaced']
+    return stats
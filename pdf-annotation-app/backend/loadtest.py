@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+"""
+Load generator that simulates concurrent editor sessions.
+
+Each virtual editor replays a session script (upload, a few saves while
+annotations are added, insert-page, previews, generate) with think time
+between steps, either in-process through Flask's test client or against
+a running server over HTTP. A session saves its document once as a
+project and then keeps saving that project: annotation-only saves go to
+/api/save-annotations, and the document is saved in full again only after
+it changed (insert-page). In-process runs use a temporary project folder
+that is removed afterwards. The run is summarized as a JSON report with
+per-step throughput, latency percentiles, error and rejection (429)
+rates, plus resident memory sampled over time.
+
+Usage:
+    python loadtest.py run --pdf ../../test.pdf --sessions 20 --concurrency 5 --output run.json
+    python loadtest.py run --target http://localhost:5001 --server-pid 1234 --pdf doc.pdf
+    python loadtest.py run --script my_session.json ...
+    python loadtest.py compare baseline.json run.json [--max-regression 0.1]
+
+A script file is a JSON list of steps such as
+    [{"action": "upload"}, {"action": "save", "repeat": 3}, {"action": "generate"}]
+with actions upload, load, save, insert_page, preview, generate, search.
+"""
+import argparse
+import base64
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+DEFAULT_SCRIPT = [
+    {'action': 'upload'},
+    {'action': 'save', 'repeat': 3, 'add_annotations': 2},
+    {'action': 'preview', 'repeat': 3},
+    {'action': 'insert_page'},
+    {'action': 'save'},
+    {'action': 'generate'},
+]
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+# --- Transports -------------------------------------------------------------
+
+class TestClientTransport:
+    """Calls the app in-process through Flask's test client, with projects in a temporary folder"""
+
+    def __init__(self):
+        # Set before the app is imported, which is when the project store is opened
+        self.projects_folder = tempfile.mkdtemp(prefix='loadtest-projects-')
+        os.environ['PROJECTS_FOLDER'] = self.projects_folder
+        import app as backend
+        self.backend = backend
+        self.app = backend.app
+
+    def close(self):
+        """Write what the background threads still hold, then remove the temporary projects"""
+        self.backend.autosave.shutdown()
+        self.backend.search_index.wait()
+        shutil.rmtree(self.projects_folder, ignore_errors=True)
+
+    def request(self, method, path, json_body=None, files=None):
+        client = self.app.test_client()
+        if files:
+            response = client.open(path, method=method, data=files, content_type='multipart/form-data')
+        else:
+            response = client.open(path, method=method, json=json_body)
+        return response.status_code, response.get_data(), dict(response.headers)
+
+
+class HttpTransport:
+    """Calls a running server over HTTP"""
+
+    def __init__(self, base_url, timeout=120):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, json_body=None, files=None):
+        headers = {}
+        if files:
+            boundary = uuid.uuid4().hex
+            body = b''
+            for name, (stream, filename) in files.items():
+                body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                         f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n').encode()
+                body += stream.read() + b'\r\n'
+            body += f'--{boundary}--\r\n'.encode()
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        elif json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        else:
+            body = None
+
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.status, response.read(), dict(response.headers)
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), dict(e.headers)
+
+    def close(self):
+        pass
+
+
+# --- Memory sampling --------------------------------------------------------
+
+def read_rss(pid):
+    """Resident set size of a process in bytes, or None if it can't be read"""
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+class RssSampler(threading.Thread):
+    """Samples a process's RSS at a fixed interval until stopped"""
+
+    def __init__(self, pid, interval, started):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.started = started
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = read_rss(self.pid)
+            if rss is not None:
+                self.samples.append({'t': round(time.perf_counter() - self.started, 3), 'rss_bytes': rss})
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+# --- Editor sessions --------------------------------------------------------
+
+def random_annotation(page, index):
+    return {
+        'id': uuid.uuid4().hex[:9],
+        'type': 'text',
+        'page': page,
+        'x': random.uniform(20, 450),
+        'y': random.uniform(20, 700),
+        'width': 150,
+        'height': 24,
+        'value': f'Load test note {index}',
+        'fontSize': 12,
+        'created_at': datetime.now().isoformat(),
+    }
+
+class EditorSession:
+    """One virtual editor working on its own copy of the document"""
+
+    def __init__(self, transport, pdf_bytes, pdf_name, think_time, record):
+        self.transport = transport
+        self.pdf_bytes = pdf_bytes
+        self.pdf_name = pdf_name
+        self.pdf_data = base64.b64encode(pdf_bytes).decode('utf-8')
+        self.think_time = think_time
+        self.record = record
+        self.document_hash = None
+        self.project_id = None
+        self.pdf_saved = False
+        self.num_pages = 1
+        self.annotations = []
+
+    def call(self, step, method, path, json_body=None, files=None):
+        start = time.perf_counter()
+        try:
+            status, body, headers = self.transport.request(method, path, json_body, files)
+        except Exception as e:
+            status, body, headers = 0, str(e).encode(), {}
+        self.record(step, start, time.perf_counter() - start, status, len(body))
+        if status == 200 and headers.get('Content-Type', '').startswith('application/json'):
+            return status, json.loads(body), headers
+        return status, None, headers
+
+    def add_annotations(self, count):
+        for _ in range(count):
+            page = random.randrange(self.num_pages)
+            self.annotations.append(random_annotation(page, len(self.annotations)))
+
+    def run_step(self, step):
+        action = step['action']
+        if step.get('add_annotations'):
+            self.add_annotations(step['add_annotations'])
+
+        if action == 'upload':
+            status, data, _ = self.call(action, 'POST', '/api/upload-pdf',
+                                        files={'file': (BytesIO(self.pdf_bytes), self.pdf_name)})
+            if data:
+                self.document_hash = data.get('document_hash')
+                self.num_pages = data.get('num_pages', 1)
+        elif action == 'save':
+            if self.project_id and self.pdf_saved:
+                # The stored document is current, so only the annotations are sent
+                self.call('save_annotations', 'POST', '/api/save-annotations', {
+                    'project_id': self.project_id,
+                    'annotations': self.annotations,
+                })
+            else:
+                body = {
+                    'pdf_filename': self.pdf_name,
+                    'pdf_data': self.pdf_data,
+                    'annotations': self.annotations,
+                    'metadata': {'source': 'loadtest'},
+                }
+                if self.project_id:
+                    body['project_id'] = self.project_id
+                status, data, _ = self.call(action, 'POST', '/api/save-project', body)
+                if data:
+                    self.project_id = data.get('project_id')
+                    self.pdf_saved = True
+        elif action == 'load':
+            if self.project_id:
+                self.call(action, 'GET', f'/api/load-project/{self.project_id}')
+        elif action == 'insert_page':
+            status, data, _ = self.call(action, 'POST', '/api/insert-page', {
+                'pdfData': self.pdf_data,
+                'pageIndex': random.randrange(self.num_pages),
+                'position': 'after',
+            })
+            if data and data.get('pdfData'):
+                self.pdf_data = data['pdfData']
+                self.num_pages += 1
+                self.document_hash = None
+                self.pdf_saved = False
+        elif action == 'preview':
+            page = step.get('page', random.randrange(self.num_pages))
+            body = {'page': page, 'annotations': self.annotations}
+            if self.document_hash:
+                body['document_hash'] = self.document_hash
+            else:
+                body['pdf_data'] = self.pdf_data
+            status, _, headers = self.call(action, 'POST', '/api/preview-pdf', body)
+            if status == 200:
+                self.document_hash = headers.get('X-Document-Hash', self.document_hash)
+        elif action == 'generate':
+            self.call(action, 'POST', '/api/generate-pdf', {
+                'pdf_data': self.pdf_data,
+                'annotations': self.annotations,
+                'optimize': step.get('optimize', False),
+            })
+        elif action == 'search':
+            query = urllib.parse.urlencode({'q': step.get('query', 'note')})
+            self.call(action, 'GET', f'/api/search?{query}')
+        else:
+            raise ValueError(f'Unknown action: {action}')
+
+    def run(self, script):
+        for step in script:
+            for _ in range(step.get('repeat', 1)):
+                self.run_step(step)
+                if self.think_time:
+                    time.sleep(random.uniform(0.5, 1.5) * self.think_time)
+
+
+# --- Reporting --------------------------------------------------------------
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def summarize(records, wall_seconds):
+    latencies = sorted(r['latency'] for r in records)
+    errors = sum(1 for r in records if r['status'] != 200 and r['status'] != 429)
+    rejected = sum(1 for r in records if r['status'] == 429)
+    summary = {
+        'requests': len(records),
+        'errors': errors,
+        'rejected': rejected,
+        'error_rate': round(errors / len(records), 4) if records else 0,
+        'rejection_rate': round(rejected / len(records), 4) if records else 0,
+        'throughput_rps': round(len(records) / wall_seconds, 2) if wall_seconds else 0,
+        'bytes_received': sum(r['bytes'] for r in records),
+    }
+    if latencies:
+        summary['latency_ms'] = {
+            'min': round(latencies[0] * 1000, 2),
+            'mean': round(sum(latencies) / len(latencies) * 1000, 2),
+            'max': round(latencies[-1] * 1000, 2),
+        }
+        for pct in PERCENTILES:
+            summary['latency_ms'][f'p{pct}'] = round(percentile(latencies, pct) * 1000, 2)
+    return summary
+
+def build_report(args, script, records, wall_seconds, rss_samples):
+    steps = {}
+    for record in records:
+        steps.setdefault(record['step'], []).append(record)
+
+    report = {
+        'created_at': datetime.now().isoformat(),
+        'config': {
+            'target': args.target,
+            'pdf': os.path.basename(args.pdf),
+            'sessions': args.sessions,
+            'concurrency': args.concurrency,
+            'think_time': args.think_time,
+            'script': script,
+        },
+        'wall_seconds': round(wall_seconds, 3),
+        'sessions_per_second': round(args.sessions / wall_seconds, 3) if wall_seconds else 0,
+        'overall': summarize(records, wall_seconds),
+        'steps': {name: summarize(step_records, wall_seconds) for name, step_records in sorted(steps.items())},
+        'rss': None,
+    }
+    if rss_samples:
+        values = [sample['rss_bytes'] for sample in rss_samples]
+        report['rss'] = {
+            'start_bytes': values[0],
+            'peak_bytes': max(values),
+            'end_bytes': values[-1],
+            'samples': rss_samples,
+        }
+    return report
+
+def format_ms(value):
+    return f"{value:.1f}" if value is not None else '-'
+
+def print_summary(report):
+    print(f"\n{report['config']['sessions']} sessions, concurrency {report['config']['concurrency']}, "
+          f"{report['wall_seconds']:.1f}s wall, {report['overall']['throughput_rps']} req/s")
+    print(f"{'step':<18}{'reqs':>6}{'err%':>7}{'429%':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, summary in list(report['steps'].items()) + [('overall', report['overall'])]:
+        latency = summary.get('latency_ms', {})
+        print(f"{name:<18}{summary['requests']:>6}{summary['error_rate'] * 100:>7.1f}{summary['rejection_rate'] * 100:>7.1f}"
+              f"{format_ms(latency.get('p50')):>9}{format_ms(latency.get('p95')):>9}"
+              f"{format_ms(latency.get('p99')):>9}{format_ms(latency.get('max')):>9}")
+    if report['rss']:
+        print(f"RSS: start {report['rss']['start_bytes'] / 1048576:.0f} MB, "
+              f"peak {report['rss']['peak_bytes'] / 1048576:.0f} MB, end {report['rss']['end_bytes'] / 1048576:.0f} MB")
+
+
+# --- Commands ---------------------------------------------------------------
+
+def command_run(args):
+    with open(args.pdf, 'rb') as f:
+        pdf_bytes = f.read()
+
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, encoding='utf-8') as f:
+            script = json.load(f)
+
+    if args.target == 'testclient':
+        transport = TestClientTransport()
+        pid = os.getpid()
+    else:
+        transport = HttpTransport(args.target)
+        pid = args.server_pid
+
+    records = []
+    records_lock = threading.Lock()
+    started = time.perf_counter()
+
+    def record(step, start, latency, status, nbytes):
+        with records_lock:
+            records.append({'step': step, 'start': start - started, 'latency': latency,
+                            'status': status, 'bytes': nbytes})
+
+    def run_session(_):
+        EditorSession(transport, pdf_bytes, os.path.basename(args.pdf), args.think_time, record).run(script)
+
+    sampler = RssSampler(pid, args.rss_interval, started) if pid else None
+    if sampler:
+        sampler.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(run_session, range(args.sessions)))
+    finally:
+        wall_seconds = time.perf_counter() - started
+        if sampler:
+            sampler.stop()
+        transport.close()
+
+    report = build_report(args, script, records, wall_seconds, sampler.samples if sampler else [])
+    print_summary(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    return 1 if report['overall']['errors'] else 0
+
+def _relative_change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return (after - before) / before
+
+def command_compare(args):
+    """Compare two reports; exit non-zero if p95 latency or error rate regressed beyond the threshold"""
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+
+    regressions = []
+    print(f"{'step':<18}{'metric':<16}{'baseline':>12}{'candidate':>12}{'change':>10}")
+    names = sorted(set(baseline['steps']) | set(candidate['steps'])) + ['overall']
+    for name in names:
+        before = baseline['overall'] if name == 'overall' else baseline['steps'].get(name)
+        after = candidate['overall'] if name == 'overall' else candidate['steps'].get(name)
+        if before is None or after is None:
+            print(f"{name:<18}only in {'candidate' if before is None else 'baseline'}")
+            continue
+
+        metrics = [('p50_ms', before.get('latency_ms', {}).get('p50'), after.get('latency_ms', {}).get('p50'), True),
+                   ('p95_ms', before.get('latency_ms', {}).get('p95'), after.get('latency_ms', {}).get('p95'), True),
+                   ('p99_ms', before.get('latency_ms', {}).get('p99'), after.get('latency_ms', {}).get('p99'), False),
+                   ('throughput_rps', before['throughput_rps'], after['throughput_rps'], False),
+                   ('error_rate', before['error_rate'], after['error_rate'], False)]
+        for metric, old, new, gated in metrics:
+            change = _relative_change(old, new)
+            change_text = f"{change * 100:+.1f}%" if change is not None else '-'
+            print(f"{name:<18}{metric:<16}{str(old):>12}{str(new):>12}{change_text:>10}")
+            if gated and change is not None and change > args.max_regression:
+                regressions.append(f"{name} {metric} {change * 100:+.1f}%")
+        if after['error_rate'] > before['error_rate']:
+            regressions.append(f"{name} error_rate {before['error_rate']} -> {after['error_rate']}")
+
+    if baseline.get('rss') and candidate.get('rss'):
+        change = _relative_change(baseline['rss']['peak_bytes'], candidate['rss']['peak_bytes'])
+        # A baseline peak of 0 has no relative change
+        change_text = f"{change * 100:+.1f}%" if change is not None else '-'
+        print(f"{'rss':<18}{'peak_mb':<16}{baseline['rss']['peak_bytes'] / 1048576:>12.0f}"
+              f"{candidate['rss']['peak_bytes'] / 1048576:>12.0f}{change_text:>10}")
+        if change is not None and change > args.max_regression:
+            regressions.append(f"peak RSS {change * 100:+.1f}%")
+
+    if regressions:
+        print("\nRegressions beyond threshold:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("\nNo regressions beyond threshold")
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Simulate concurrent editor sessions against the backend')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run a load test')
+    run_parser.add_argument('--pdf', required=True, help='PDF each virtual editor works on')
+    run_parser.add_argument('--target', default='testclient',
+                            help="'testclient' (in-process) or a server URL such as http://localhost:5001")
+    run_parser.add_argument('--sessions', type=int, default=10, help='Number of editor sessions (default: %(default)s)')
+    run_parser.add_argument('--concurrency', type=int, default=4, help='Sessions running at once (default: %(default)s)')
+    run_parser.add_argument('--think-time', type=float, default=0.2,
+                            help='Average pause between steps in seconds (default: %(default)s)')
+    run_parser.add_argument('--script', help='JSON session script (default: built-in editor session)')
+    run_parser.add_argument('--server-pid', type=int, help='PID of the server to sample RSS from (HTTP target)')
+    run_parser.add_argument('--rss-interval', type=float, default=0.5, help='Seconds between RSS samples')
+    run_parser.add_argument('--output', help='Write the JSON report to this file')
+    run_parser.set_defaults(handler=command_run)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--max-regression', type=float, default=0.1,
+                                help='Allowed relative p50/p95 latency increase (default: %(default)s)')
+    compare_parser.set_defaults(handler=command_compare)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
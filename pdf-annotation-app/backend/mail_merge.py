@@ -0,0 +1,185 @@
+"""
+Data-driven mail merge: one template project rendered once per data row.
+
+Annotation values in the template may contain placeholders such as
+{{name}}. Rows come from a CSV file (header row = field names) or a
+JSON-lines file (one object per line) and are consumed as a stream.
+
+In separate mode every row's document is written and released before the
+next row is read, so memory does not grow with the number of rows (apart
+from the zip's central directory, one small entry per file). In single
+mode all rows become pages of one PDF, which pypdf can only write once the
+last page has been added: memory grows with the row count, so the caller
+caps it (max_rows) and larger merges should use separate mode.
+
+The source PDF is parsed once. Every output page is a shallow copy of the
+source page, so content streams, images and fonts of the original are
+shared by all copies instead of being duplicated per row. Pages whose
+annotations contain no placeholders get a single overlay that is reused
+for every row.
+"""
+import csv
+import io
+import json
+import re
+import zipfile
+
+from pypdf import PdfWriter
+
+from renderer import add_annotated_page, build_overlay_page, group_annotations_by_page, make_overlay_form
+
+PLACEHOLDER_PATTERN = re.compile(r'\{\{\s*([^{}]+?)\s*\}\}')
+
+# Characters that are not allowed in generated file names
+UNSAFE_FILENAME_CHARS = re.compile(r'[^A-Za-z0-9._ -]+')
+
+
+def fill_placeholders(text, row):
+    """Replace {{field}} placeholders with values from row (missing fields become empty)"""
+    def replace(match):
+        value = row.get(match.group(1), '')
+        return '' if value is None else str(value)
+    return PLACEHOLDER_PATTERN.sub(replace, text)
+
+def has_placeholders(text):
+    """Check whether a string contains at least one {{field}} placeholder"""
+    return bool(PLACEHOLDER_PATTERN.search(text or ''))
+
+def detect_data_format(filename):
+    """Guess the data source format from its file name"""
+    lower = (filename or '').lower()
+    if lower.endswith('.jsonl') or lower.endswith('.ndjson'):
+        return 'jsonl'
+    return 'csv'
+
+def iter_rows(stream, data_format='csv', encoding='utf-8-sig'):
+    """
+    Yield one dict per data row from a binary stream.
+    Rows are read lazily, so arbitrarily large sources use constant memory.
+    """
+    text_stream = io.TextIOWrapper(stream, encoding=encoding, newline='')
+    try:
+        if data_format == 'jsonl':
+            for line_num, line in enumerate(text_stream, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError(f'Line {line_num} is not a JSON object')
+                yield row
+        elif data_format == 'csv':
+            for row in csv.DictReader(text_stream):
+                yield row
+        else:
+            raise ValueError(f'Unsupported data format: {data_format}')
+    finally:
+        # Don't close the underlying stream, it belongs to the caller
+        text_stream.detach()
+
+
+class MergeTemplate:
+    """
+    A parsed template document ready to be rendered for many rows.
+    Static per-page overlays are built once and shared by all rows.
+    """
+
+    def __init__(self, pdf_reader, annotations):
+        self.pdf_reader = pdf_reader
+        self.pages = list(pdf_reader.pages)
+        self.page_sizes = [(float(p.mediabox.width), float(p.mediabox.height)) for p in self.pages]
+        self.annotations_by_page = group_annotations_by_page(annotations)
+        self.dynamic_pages = set()
+        self._static_overlays = {}
+        # Overlay forms belong to one writer; reused while rows go to the same writer
+        self._forms_writer = None
+        self._static_forms = {}
+
+        for page_num, page_annotations in self.annotations_by_page.items():
+            if any(has_placeholders(str(ann.get('value', ''))) for ann in page_annotations):
+                self.dynamic_pages.add(page_num)
+
+    def _fill_annotations(self, page_num, row):
+        filled = []
+        for ann in self.annotations_by_page[page_num]:
+            value = str(ann.get('value', ''))
+            if has_placeholders(value):
+                ann = dict(ann, value=fill_placeholders(value, row))
+            filled.append(ann)
+        return filled
+
+    def _static_form(self, page_num, pdf_writer):
+        if self._forms_writer is not pdf_writer:
+            self._forms_writer = pdf_writer
+            self._static_forms = {}
+
+        if page_num not in self._static_forms:
+            if page_num not in self._static_overlays:
+                page_width, page_height = self.page_sizes[page_num]
+                self._static_overlays[page_num] = build_overlay_page(
+                    self.annotations_by_page[page_num], page_width, page_height)
+            self._static_forms[page_num] = make_overlay_form(pdf_writer, self._static_overlays[page_num])
+        return self._static_forms[page_num]
+
+    def render_row(self, row, pdf_writer):
+        """Append one filled-in copy of the template to pdf_writer"""
+        for page_num, page in enumerate(self.pages):
+            if page_num not in self.annotations_by_page:
+                add_annotated_page(pdf_writer, page)
+            elif page_num in self.dynamic_pages:
+                add_annotated_page(pdf_writer, page, self._fill_annotations(page_num, row))
+            else:
+                add_annotated_page(pdf_writer, page, overlay_form=self._static_form(page_num, pdf_writer))
+
+
+def output_filename(pattern, row, index):
+    """Build a safe file name for one merged document"""
+    if pattern:
+        name = fill_placeholders(pattern, row)
+    else:
+        name = ''
+    name = UNSAFE_FILENAME_CHARS.sub('_', name).strip(' ._')
+    if not name:
+        name = f'document_{index:06d}'
+    if not name.lower().endswith('.pdf'):
+        name += '.pdf'
+    return name
+
+def merge_to_single_pdf(template, rows, output_stream, max_rows=None):
+    """
+    Render every row into one concatenated PDF. Returns the number of rows rendered.
+    The whole document is held until it is written, so more than max_rows rows
+    raise ValueError before anything is written.
+    """
+    pdf_writer = PdfWriter()
+    count = 0
+    for row in rows:
+        if max_rows is not None and count >= max_rows:
+            raise ValueError(f'A single merged PDF is limited to {max_rows} rows, use separate mode for more')
+        template.render_row(row, pdf_writer)
+        count += 1
+    pdf_writer.write(output_stream)
+    return count
+
+def merge_to_zip(template, rows, output_stream, filename_pattern=None):
+    """
+    Render every row into its own PDF and stream them into a zip archive.
+    Each document is written and released before the next row is read.
+    Returns the number of rows rendered.
+    """
+    count = 0
+    with zipfile.ZipFile(output_stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for row in rows:
+            count += 1
+            name = output_filename(filename_pattern, row, count)
+            # The archive already keeps an entry per file name, check against that instead of a second set
+            while name in archive.NameToInfo:
+                name = f'{name[:-4]}_{count:06d}.pdf'
+
+            pdf_writer = PdfWriter()
+            template.render_row(row, pdf_writer)
+            # pypdf needs a seekable stream to compute xref offsets
+            document = io.BytesIO()
+            pdf_writer.write(document)
+            archive.writestr(name, document.getbuffer())
+    return count
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the PDF annotation backend.
+
+Usage:
+    python manage.py migrate-layout
+    python manage.py gc [--dry-run] [--grace-seconds N]
+    python manage.py migrate-pdfs
+    python manage.py reindex [--force]
+    python manage.py export OUTPUT [--project ID ...] [--gzip]
+    python manage.py import BUNDLE [--workers N] [--overwrite]
+"""
+import argparse
+import contextlib
+import json
+import sys
+
+from project_bundle import BundleError, import_bundle, write_bundle
+from project_store import DEFAULT_PROJECTS_FOLDER, LayoutMigrationRequired, open_project_store
+from search_index import open_search_index
+
+
+def format_size(num_bytes):
+    size = float(num_bytes)
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def command_gc(store, args):
+    """Remove PDF blobs that no project refers to"""
+    report = store.collect_garbage(dry_run=args.dry_run, grace_seconds=args.grace_seconds)
+    action = "Would delete" if args.dry_run else "Deleted"
+    print(f"Blobs scanned: {report['blobs']} ({report['live_blobs']} in use)")
+    print(f"{action} {report['deleted_blobs']} orphaned blobs, reclaiming {format_size(report['reclaimed_bytes'])}")
+    if report['repaired_refcounts']:
+        print(f"Repaired {report['repaired_refcounts']} reference counts")
+    if args.json:
+        print(json.dumps(report))
+    return 0
+
+def command_migrate_layout(store, args):
+    """Move project files of the old flat layout into their shard directories"""
+    # The files were moved when the store was opened
+    print(f"{store.backend.root} uses the sharded layout")
+    return 0
+
+def command_migrate_pdfs(store, args):
+    """Move PDFs embedded in older project files into the deduplicated blob store"""
+    migrated = 0
+    for key, project in store.iter_projects():
+        if getattr(project, 'pdf_sha256', None):
+            continue
+        try:
+            store.migrate_pdf(project)
+            migrated += 1
+        except Exception as e:
+            print(f"  Warning: Failed to migrate {key}: {e}")
+    print(f"Migrated {migrated} projects to the blob store")
+    return 0
+
+def command_reindex(store, args):
+    """Bring the full-text search index up to date with the saved projects"""
+    index = open_search_index(args.projects, store)
+    indexed, removed = index.reindex_all(force=args.force)
+    stats = index.stats()
+    print(f"Indexed {indexed} projects, removed {removed} deleted projects")
+    print(f"Search index: {stats['projects']} projects, {stats['entries']} entries")
+    return 0
+
+def command_export(store, args):
+    """Write projects and their PDFs to a bundle file ('-' for stdout)"""
+    if args.output == '-':
+        output = sys.stdout.buffer
+        # Progress messages go to stderr so they don't end up inside the bundle
+        with contextlib.redirect_stdout(sys.stderr):
+            written = write_bundle(store, output, args.project or None, args.gzip)
+    else:
+        with open(args.output, 'wb') as output:
+            written = write_bundle(store, output, args.project or None, args.gzip)
+    print(f"Wrote {format_size(written)} to {args.output}", file=sys.stderr)
+    return 0
+
+def command_import(store, args):
+    """Restore projects from a bundle file ('-' for stdin)"""
+    try:
+        if args.bundle == '-':
+            report = import_bundle(store, sys.stdin.buffer, workers=args.workers, overwrite=args.overwrite)
+        else:
+            with open(args.bundle, 'rb') as bundle:
+                report = import_bundle(store, bundle, workers=args.workers, overwrite=args.overwrite)
+    except BundleError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    print(f"Projects: {report['projects_imported']} imported, {report['projects_skipped']} already present, "
+          f"{report['projects_failed']} failed")
+    print(f"PDFs: {report['pdfs_imported']} imported, {report['pdfs_existing']} already present, "
+          f"{report['pdfs_failed']} failed")
+    if report['projects_imported']:
+        print("Run 'manage.py reindex' to make the imported projects searchable")
+    if args.json:
+        print(json.dumps(report))
+    return 0 if report['complete'] and not report['projects_failed'] else 1
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='PDF annotation backend maintenance')
+    parser.add_argument('--projects', default=DEFAULT_PROJECTS_FOLDER,
+                        help='Project storage folder (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    layout_parser = subparsers.add_parser('migrate-layout', help='Move flat-layout project files into shard directories')
+    layout_parser.set_defaults(handler=command_migrate_layout)
+
+    gc_parser = subparsers.add_parser('gc', help='Delete orphaned PDF blobs and report reclaimed space')
+    gc_parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+    gc_parser.add_argument('--grace-seconds', type=int, default=3600,
+                           help='Keep unreferenced blobs younger than this (default: %(default)s)')
+    gc_parser.add_argument('--json', action='store_true', help='Also print the report as JSON')
+    gc_parser.set_defaults(handler=command_gc)
+
+    migrate_parser = subparsers.add_parser('migrate-pdfs', help='Move embedded PDFs into the blob store')
+    migrate_parser.set_defaults(handler=command_migrate_pdfs)
+
+    reindex_parser = subparsers.add_parser('reindex', help='Update the full-text search index')
+    reindex_parser.add_argument('--force', action='store_true', help='Re-index projects that look unchanged')
+    reindex_parser.set_defaults(handler=command_reindex)
+
+    export_parser = subparsers.add_parser('export', help='Write projects to a streaming bundle')
+    export_parser.add_argument('output', help="Bundle file to write, or '-' for stdout")
+    export_parser.add_argument('--project', action='append', metavar='ID',
+                               help='Export only this project (repeatable, default: all)')
+    export_parser.add_argument('--gzip', action='store_true', help='Compress the bundle')
+    export_parser.set_defaults(handler=command_export)
+
+    import_parser = subparsers.add_parser('import', help='Restore projects from a bundle')
+    import_parser.add_argument('bundle', help="Bundle file to read, or '-' for stdin")
+    import_parser.add_argument('--workers', type=int, default=8,
+                               help='Parallel writers (default: %(default)s)')
+    import_parser.add_argument('--overwrite', action='store_true', help='Replace projects that already exist')
+    import_parser.add_argument('--json', action='store_true', help='Also print the report as JSON')
+    import_parser.set_defaults(handler=command_import)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        store = open_project_store(args.projects, migrate=args.command == 'migrate-layout')
+    except LayoutMigrationRequired as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return args.handler(store, args)
+
+if __name__ == '__main__':
+    sys.exit(main())
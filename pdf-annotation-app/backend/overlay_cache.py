@@ -0,0 +1,207 @@
+"""
+Two-tier (memory + disk) cache for rendered overlays and finished PDFs.
+
+Drawing overlays with reportlab dominates generate_pdf, and most of the
+pages in a large document are unchanged between two exports. Rendered
+per-page overlays are cached under a key built from the page geometry,
+the page's annotation list and the font table version (see
+renderer.overlay_cache_key), and whole generated documents under the
+document hash plus the annotation hash.
+
+Both tiers are LRUs bounded by total bytes. The memory tier is an
+OrderedDict; the disk tier stores one file per entry and uses file
+mtimes (touched on every hit) to decide what to evict. Entries are
+written atomically, and a file that turns out to be unreadable is
+treated as a miss by the caller and dropped with discard().
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+MB = 1024 * 1024
+DEFAULT_CACHE_FOLDER = os.environ.get('RENDER_CACHE_FOLDER', '../cache')
+
+# Evict down to this fraction of the disk limit, so eviction scans are rare
+DISK_EVICT_TARGET = 0.9
+
+
+def hash_json(value):
+    """Stable hash of a JSON-serializable value (dict key order does not matter)"""
+    encoded = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """Byte-valued LRU cache kept in memory and, optionally, on disk"""
+
+    def __init__(self, directory=None, memory_bytes=64 * MB, disk_bytes=1024 * MB, suffix='.pdf'):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = 0
+        self._lock = threading.Lock()
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._disk_used = sum(size for _, size, _ in self._scan_disk())
+
+    @classmethod
+    def from_environment(cls, name, memory_mb=64, disk_mb=1024, suffix='.pdf'):
+        """
+        Cache stored under RENDER_CACHE_FOLDER/<name>. Limits come from
+        <NAME>_CACHE_MEMORY_MB and <NAME>_CACHE_DISK_MB; a disk limit of 0
+        keeps the cache in memory only.
+        """
+        prefix = name.upper()
+        disk_bytes = int(float(os.environ.get(f'{prefix}_CACHE_DISK_MB', disk_mb)) * MB)
+        return cls(
+            directory=os.path.join(DEFAULT_CACHE_FOLDER, name) if disk_bytes > 0 else None,
+            memory_bytes=int(float(os.environ.get(f'{prefix}_CACHE_MEMORY_MB', memory_mb)) * MB),
+            disk_bytes=disk_bytes,
+            suffix=suffix,
+        )
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def _scan_disk(self):
+        """Yield (path, size, mtime) of every entry on disk"""
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(shard_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _remember(self, key, data):
+        """Put data in the memory tier (caller holds the lock)"""
+        if len(data) > self.memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= len(previous)
+        self._memory[key] = data
+        self._memory_used += len(data)
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+
+    def get(self, key):
+        """Return the cached bytes for key, or None"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+
+        if self.directory:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+            except FileNotFoundError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    self._remember(key, data)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        """Store bytes under key in both tiers (bytes are kept as they are, other buffers are copied)"""
+        data = bytes(data)
+        with self._lock:
+            self._remember(key, data)
+
+        if not self.directory or len(data) > self.disk_bytes:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # Sized and replaced under the lock, so concurrent puts of one key count it once
+            with self._lock:
+                try:
+                    replaced = os.path.getsize(path)
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(temp_path, path)
+                self._disk_used += len(data) - replaced
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            over_limit = self._disk_used > self.disk_bytes
+        if over_limit:
+            self._evict_disk()
+
+    def discard(self, key):
+        """Drop an entry, e.g. one whose contents turned out to be unreadable"""
+        with self._lock:
+            data = self._memory.pop(key, None)
+            if data is not None:
+                self._memory_used -= len(data)
+        if self.directory:
+            try:
+                path = self._path(key)
+                size = os.path.getsize(path)
+                os.remove(path)
+                with self._lock:
+                    self._disk_used -= size
+            except FileNotFoundError:
+                pass
+
+    def _evict_disk(self):
+        """Delete the least recently used files until the disk tier is under its target size"""
+        entries = sorted(self._scan_disk(), key=lambda entry: entry[2])
+        used = sum(size for _, size, _ in entries)
+        target = self.disk_bytes * DISK_EVICT_TARGET
+        for path, size, _ in entries:
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+                used -= size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._disk_used = used
+
+    def stats(self):
+        with self._lock:
+            return {
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_used,
+                'disk_bytes': self._disk_used,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
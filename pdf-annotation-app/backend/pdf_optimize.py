@@ -0,0 +1,235 @@
+"""
+Output size optimization for generated PDFs.
+
+Every overlay brings its own copy of the fonts it uses and pypdf writes
+streams exactly as it got them, so annotated documents tend to be much
+larger than their source. optimize_pdf() post-processes a finished PDF:
+
+- drops font, XObject and graphics-state entries a page never uses
+- flate-compresses streams that were stored without a filter
+- merges byte-identical streams (font files, images, ...), font
+  dictionaries, descriptors and arrays such as widths
+- drops objects that are no longer referenced after merging
+
+linearize_pdf() rewrites a PDF for fast web view using the qpdf command
+line tool. qpdf is an optional system package (not a pip dependency);
+without it PDFs are stored as they are.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from io import BytesIO
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, StreamObject
+
+# Dictionary types merged when identical. Other dictionaries (structure elements, optional
+# content groups, outline items, form fields, ...) can be identical yet must stay distinct.
+MERGEABLE_DICT_TYPES = {'/Font', '/FontDescriptor', '/Encoding', '/ExtGState'}
+
+# A linearized file declares it in the first object, within this many bytes of the start
+LINEARIZED_HEADER_BYTES = 1024
+
+logger = logging.getLogger(__name__)
+
+# Content stream operators that reference a named resource, by resource category
+RESOURCE_OPERATORS = {
+    b'Tf': '/Font',
+    b'Do': '/XObject',
+    b'gs': '/ExtGState',
+}
+
+MAX_DEDUP_PASSES = 5
+
+
+def _used_resource_names(page):
+    """Collect the resource names a page's content stream refers to, by category"""
+    used = {category: set() for category in RESOURCE_OPERATORS.values()}
+    contents = page.get_contents()
+    if contents is None:
+        return used
+    for operands, operator in contents.operations:
+        category = RESOURCE_OPERATORS.get(operator)
+        if category and operands and isinstance(operands[0], NameObject):
+            used[category].add(operands[0])
+    return used
+
+def prune_page_resources(page):
+    """
+    Replace a page's resource dictionary with one that only lists the
+    fonts, XObjects and graphics states its content actually uses.
+    Returns the number of entries removed. Shared dictionaries are copied,
+    never modified in place.
+    """
+    resources = page.get('/Resources')
+    if resources is None:
+        return 0
+
+    try:
+        used = _used_resource_names(page)
+    except Exception as e:
+        print(f"  Warning: could not parse page content, keeping resources: {e}")
+        return 0
+
+    resources = DictionaryObject(resources.get_object())
+    removed = 0
+    for category, names in used.items():
+        entries = resources.get(category)
+        if entries is None:
+            continue
+        entries = entries.get_object()
+        kept = DictionaryObject({k: v for k, v in entries.items() if k in names})
+        removed += len(entries) - len(kept)
+        resources[NameObject(category)] = kept
+
+    if removed:
+        page[NameObject('/Resources')] = resources
+    return removed
+
+def compress_streams(pdf_writer):
+    """Flate-compress every stream object stored without a filter. Returns the count."""
+    compressed = 0
+    for i, obj in enumerate(pdf_writer._objects):
+        if isinstance(obj, StreamObject) and '/Filter' not in obj:
+            pdf_writer._objects[i] = obj.flate_encode()
+            compressed += 1
+    return compressed
+
+def _object_key(obj):
+    """
+    Hash the serialized form of a mergeable object (None for others);
+    identical objects get identical keys
+    """
+    if isinstance(obj, StreamObject):
+        pass
+    elif isinstance(obj, DictionaryObject):
+        if obj.get('/Type') not in MERGEABLE_DICT_TYPES:
+            return None
+    elif not isinstance(obj, ArrayObject):
+        return None
+    buffer = BytesIO()
+    obj.write_to_stream(buffer)
+    return hashlib.sha256(buffer.getvalue()).digest()
+
+def _remap_references(obj, mapping, pdf_writer):
+    """Point references to merged duplicates at their surviving copy"""
+    if isinstance(obj, DictionaryObject):
+        items = obj.items()
+    elif isinstance(obj, ArrayObject):
+        items = enumerate(obj)
+    else:
+        return
+    for key, value in list(items):
+        if isinstance(value, IndirectObject):
+            if value.idnum in mapping:
+                obj[key] = IndirectObject(mapping[value.idnum], 0, pdf_writer)
+        else:
+            _remap_references(value, mapping, pdf_writer)
+
+def merge_duplicate_objects(pdf_writer):
+    """
+    Merge identical streams, font dictionaries and arrays. Runs several
+    passes because merging e.g. two font files makes their font
+    descriptors identical as well.
+    Returns the number of objects merged away.
+    """
+    merged = 0
+    for _ in range(MAX_DEDUP_PASSES):
+        seen = {}
+        mapping = {}
+        for i, obj in enumerate(pdf_writer._objects):
+            if obj is None:
+                continue
+            key = _object_key(obj)
+            if key is None:
+                continue
+            idnum = i + 1
+            if key in seen:
+                mapping[idnum] = seen[key]
+            else:
+                seen[key] = idnum
+
+        if not mapping:
+            break
+
+        for obj in pdf_writer._objects:
+            if obj is not None:
+                _remap_references(obj, mapping, pdf_writer)
+        _remap_references(pdf_writer._root_object, mapping, pdf_writer)
+        merged += len(mapping)
+    return merged
+
+def optimize_pdf(pdf_bytes):
+    """
+    Optimize a finished PDF. Returns (optimized_bytes, stats) where stats
+    reports sizes before and after and what was changed. If optimizing
+    does not make the file smaller, the original bytes are returned.
+    """
+    size_before = len(pdf_bytes)
+
+    # Cloning from the root only copies reachable objects
+    pdf_writer = PdfWriter(clone_from=PdfReader(BytesIO(pdf_bytes)))
+
+    pruned = sum(prune_page_resources(page) for page in pdf_writer.pages)
+    compressed = compress_streams(pdf_writer)
+    merged = merge_duplicate_objects(pdf_writer)
+
+    # Merged duplicates are still in the object table; a second clone drops them
+    intermediate = BytesIO()
+    pdf_writer.write(intermediate)
+    intermediate.seek(0)
+    final_writer = PdfWriter(clone_from=PdfReader(intermediate))
+
+    output = BytesIO()
+    final_writer.write(output)
+    optimized = output.getvalue()
+
+    if len(optimized) >= size_before:
+        optimized = pdf_bytes
+
+    stats = {
+        'size_before': size_before,
+        'size_after': len(optimized),
+        'pruned_resources': pruned,
+        'compressed_streams': compressed,
+        'merged_objects': merged,
+    }
+    return optimized, stats
+
+def is_linearized(pdf_bytes):
+    """True if a PDF has a linearization dictionary (it may be stale if the file was edited since)"""
+    return b'/Linearized' in pdf_bytes[:LINEARIZED_HEADER_BYTES]
+
+def linearize_pdf(pdf_bytes):
+    """
+    Linearize a PDF so viewers can show the first page before the whole
+    file has arrived. pypdf cannot do this, so qpdf is used if it is on
+    the PATH. Returns (pdf_bytes, linearized); a PDF that is linearized
+    already is returned as it is, and the input is returned unchanged when
+    qpdf is missing or fails.
+    """
+    if is_linearized(pdf_bytes):
+        return pdf_bytes, True
+
+    qpdf = shutil.which('qpdf')
+    if not qpdf:
+        logger.warning("qpdf not found on PATH, storing PDF without linearization")
+        return pdf_bytes, False
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_path = os.path.join(tmp_dir, 'source.pdf')
+        target_path = os.path.join(tmp_dir, 'linearized.pdf')
+        with open(source_path, 'wb') as f:
+            f.write(pdf_bytes)
+
+        result = subprocess.run([qpdf, '--linearize', source_path, target_path], capture_output=True)
+        # qpdf exits with 3 when it succeeded with warnings
+        if result.returncode not in (0, 3) or not os.path.exists(target_path):
+            logger.warning("qpdf failed to linearize PDF: %s", result.stderr.decode(errors='replace'))
+            return pdf_bytes, False
+
+        with open(target_path, 'rb') as f:
+            return f.read(), True
@@ -0,0 +1,171 @@
+"""
+Opt-in request profiling.
+
+A request is profiled with cProfile when the caller sends the
+X-Profile-Token header (or ?profile_token=) matching PROFILING_TOKEN, or
+when it is picked by random sampling at PROFILE_SAMPLE_RATE (0..1). The
+profile is written to PROFILES_FOLDER as <id>.prof (pstats format) with
+a <id>.json sidecar holding the request metadata: route, status,
+duration, body size and whatever the view recorded with annotate()
+(page and annotation counts, document size).
+
+When neither a token nor a sample rate is configured, install() does not
+register any hooks, so requests pay nothing for the feature.
+"""
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+from datetime import datetime
+
+from flask import g, request
+
+DEFAULT_PROFILES_FOLDER = os.environ.get('PROFILES_FOLDER', '../profiles')
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$')
+
+
+def annotate(**metadata):
+    """Attach metadata (pages, annotations, document_bytes, ...) to the current request's profile, if any"""
+    profile = g.get('profile')
+    if profile is not None:
+        profile['metadata'].update(metadata)
+
+
+class RequestProfiler:
+    """Profiles selected requests and stores the results on disk"""
+
+    def __init__(self, folder, token=None, sample_rate=0.0, max_profiles=200):
+        self.folder = folder
+        self.token = token
+        self.sample_rate = sample_rate
+        self.max_profiles = max_profiles
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            folder=DEFAULT_PROFILES_FOLDER,
+            token=os.environ.get('PROFILING_TOKEN') or None,
+            sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+            max_profiles=int(os.environ.get('PROFILE_MAX_FILES', 200)),
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.token) or self.sample_rate > 0
+
+    def is_authorized(self):
+        """True if the request carries the profiling token"""
+        supplied = request.headers.get('X-Profile-Token') or request.args.get('profile_token')
+        return bool(self.token and supplied) and hmac.compare_digest(supplied, self.token)
+
+    def install(self, app):
+        """Register the request hooks on app, only if profiling is configured"""
+        if not self.enabled:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        print(f"Request profiling enabled (sample rate {self.sample_rate:g}, profiles in {self.folder})")
+
+    def _should_profile(self):
+        if request.path.startswith('/api/profiles'):
+            return False
+        if self.is_authorized():
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _start(self):
+        if not self._should_profile():
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler per process; skip this request
+            return
+        g.profile = {
+            'profiler': profiler,
+            'started': time.perf_counter(),
+            'metadata': {},
+        }
+
+    def _finish(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        profile['profiler'].disable()
+        try:
+            profile_id = self._save(profile, response)
+            response.headers['X-Profile-Id'] = profile_id
+        except Exception as e:
+            print(f"WARNING: could not save request profile: {e}")
+        return response
+
+    def _save(self, profile, response):
+        profile_id = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        metadata = {
+            'id': profile_id,
+            'created_at': datetime.now().isoformat(),
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - profile['started']) * 1000, 1),
+            'request_bytes': request.content_length or 0,
+            'reason': 'token' if self.is_authorized() else 'sampled',
+        }
+        metadata.update(profile['metadata'])
+
+        profile['profiler'].dump_stats(self.profile_path(profile_id))
+        with open(self.metadata_path(profile_id), 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, indent=2)
+        print(f"Saved profile {profile_id} for {request.method} {request.path} ({metadata['duration_ms']} ms)")
+
+        self._prune()
+        return profile_id
+
+    def profile_path(self, profile_id):
+        return os.path.join(self.folder, f'{profile_id}.prof')
+
+    def metadata_path(self, profile_id):
+        return os.path.join(self.folder, f'{profile_id}.json')
+
+    def is_valid_id(self, profile_id):
+        return bool(PROFILE_ID_PATTERN.match(profile_id)) and os.path.exists(self.profile_path(profile_id))
+
+    def list_profiles(self):
+        """Metadata of stored profiles, newest first"""
+        if not os.path.isdir(self.folder):
+            return []
+        profiles = []
+        for filename in sorted(os.listdir(self.folder), reverse=True):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, filename), encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"  Warning: Failed to read profile metadata {filename}: {e}")
+        return profiles
+
+    def render_text(self, profile_id, sort='cumulative', limit=50):
+        """Human-readable pstats report of a stored profile"""
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile_path(profile_id), stream=output)
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def _prune(self):
+        """Keep only the newest max_profiles profiles"""
+        ids = sorted(filename[:-5] for filename in os.listdir(self.folder) if filename.endswith('.prof'))
+        excess = len(ids) - self.max_profiles
+        for profile_id in ids[:max(excess, 0)]:
+            for path in (self.profile_path(profile_id), self.metadata_path(profile_id)):
+                if os.path.exists(path):
+                    os.remove(path)
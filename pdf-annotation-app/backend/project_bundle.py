@@ -0,0 +1,384 @@
+"""
+Streaming project bundles for bulk export and import.
+
+A bundle is a tar stream (optionally gzip-compressed) with this layout:
+
+    bundle.json                      header: format name and version
+    pdfs/<sha256>.pdf                each PDF once, before the first project using it
+    projects/<id>/manifest.json      id, filename, dates, metadata, checksums
+    projects/<id>/annotations.json   the annotations
+    ...
+    bundle-end.json                  trailer: project and PDF counts
+
+PDFs are deduplicated by digest, so a thousand projects annotating the
+same form carry that form once. The manifest records the SHA-256 of the
+annotations file and of the PDF; import recomputes both and rejects a
+project whose data doesn't match. A PDF's file name is its digest and is
+checked the same way. The trailer lets import tell a complete bundle from
+one that was cut off.
+
+Both directions work entry by entry: export writes each project as it is
+read from the store and import stores each entry as it arrives, so memory
+use is bounded by the largest PDF, not by the number of projects. On
+import, the tar stream is read by one thread while blob and project
+writes (each ending in an fsync) run on a thread pool.
+"""
+import hashlib
+import io
+import json
+import re
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from project_store import ProjectData
+
+BUNDLE_FORMAT = 'pdf-annotation-bundle'
+BUNDLE_VERSION = 1
+HEADER_NAME = 'bundle.json'
+TRAILER_NAME = 'bundle-end.json'
+
+PROJECT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+PDF_ENTRY_PATTERN = re.compile(r'^pdfs/([0-9a-f]{64})\.pdf$')
+PROJECT_ENTRY_PATTERN = re.compile(r'^projects/([A-Za-z0-9_-]{1,128})/(manifest|annotations)\.json$')
+
+
+class BundleError(Exception):
+    """Raised when a bundle can't be read at all (wrong format, unsupported version)"""
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _json_bytes(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+class _ChunkSink:
+    """File-like object collecting what tarfile writes, so it can be yielded piecewise"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def _add_bytes(tar, name, data, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    tar.addfile(info, io.BytesIO(data))
+
+def _iter_selected_projects(store, project_ids):
+    if project_ids is None:
+        for _key, project in store.iter_projects():
+            yield project
+        return
+    for project_id in project_ids:
+        project = store.load(project_id)
+        if project is None:
+            print(f"  Warning: Project {project_id} not found, not exported")
+            continue
+        yield project
+
+
+def iter_bundle(store, project_ids=None, compress=False):
+    """
+    Yield the bytes of a bundle with the given projects (default: all of them).
+    Each project is read, written and handed out before the next one is loaded.
+    """
+    sink = _ChunkSink()
+    tar = tarfile.open(fileobj=sink, mode='w|gz' if compress else 'w|')
+    now = int(time.time())
+    exported_pdfs = set()
+    project_count = 0
+
+    _add_bytes(tar, HEADER_NAME, _json_bytes({
+        'format': BUNDLE_FORMAT,
+        'version': BUNDLE_VERSION,
+        'created_at': datetime.now().isoformat(),
+    }), now)
+    yield from sink.drain()
+
+    for project in _iter_selected_projects(store, project_ids):
+        project_id = project.project_id
+        if not PROJECT_ID_PATTERN.match(str(project_id)):
+            print(f"  Warning: Skipping project with unexpected id {project_id!r}")
+            continue
+        try:
+            digest = getattr(project, 'pdf_sha256', None)
+            if digest not in exported_pdfs:
+                if digest:
+                    # Blobs on local disk are copied through in blocks
+                    with store.open_pdf(project) as pdf_file:
+                        info = tarfile.TarInfo(f'pdfs/{digest}.pdf')
+                        info.size = store.blobs.size(digest)
+                        info.mtime = now
+                        tar.addfile(info, pdf_file)
+                else:
+                    # Older layouts keep the PDF in the project; its digest is computed here
+                    pdf_bytes = store.load_pdf(project)
+                    digest = _sha256(pdf_bytes)
+                    if digest not in exported_pdfs:
+                        _add_bytes(tar, f'pdfs/{digest}.pdf', pdf_bytes, now)
+                exported_pdfs.add(digest)
+        except Exception as e:
+            print(f"  Warning: Skipping project {project_id}, its PDF can't be read: {e}")
+            continue
+
+        annotations = _json_bytes(project.annotations)
+        manifest = {
+            'project_id': project_id,
+            'created_at': project.created_at,
+            'pdf_filename': project.pdf_filename,
+            'metadata': project.metadata,
+            'pdf_sha256': digest,
+            'annotations_sha256': _sha256(annotations),
+            'annotation_count': len(project.annotations),
+        }
+        _add_bytes(tar, f'projects/{project_id}/manifest.json', _json_bytes(manifest), now)
+        _add_bytes(tar, f'projects/{project_id}/annotations.json', annotations, now)
+        project_count += 1
+        yield from sink.drain()
+
+    _add_bytes(tar, TRAILER_NAME, _json_bytes({
+        'projects': project_count,
+        'pdfs': len(exported_pdfs),
+    }), now)
+    tar.close()
+    yield from sink.drain()
+    print(f"Exported {project_count} projects with {len(exported_pdfs)} PDFs")
+
+def write_bundle(store, output, project_ids=None, compress=False):
+    """Write a bundle to a binary file object. Returns the number of bytes written."""
+    written = 0
+    for chunk in iter_bundle(store, project_ids, compress):
+        output.write(chunk)
+        written += len(chunk)
+    return written
+
+
+class _BundleImport:
+    """State of one import: pending writes, the PDFs seen so far and the report"""
+
+    def __init__(self, store, workers, overwrite, on_project):
+        self.store = store
+        self.overwrite = overwrite
+        self.on_project = on_project
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bundle-import')
+        # Bounds the entries read ahead of the writers, which bounds memory
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.lock = threading.Lock()
+        self.pdf_writes = {}
+        self.pending_manifests = {}
+        self.report = {
+            'projects_imported': 0,
+            'projects_skipped': 0,
+            'projects_failed': 0,
+            'pdfs_imported': 0,
+            'pdfs_existing': 0,
+            'pdfs_failed': 0,
+            'bytes_read': 0,
+            'complete': False,
+            'errors': [],
+        }
+
+    def error(self, message):
+        print(f"  Warning: {message}")
+        with self.lock:
+            if len(self.report['errors']) < 100:
+                self.report['errors'].append(message)
+
+    def count(self, key):
+        with self.lock:
+            self.report[key] += 1
+
+    def submit(self, task, *args):
+        self.slots.acquire()
+        future = self.executor.submit(task, *args)
+        future.add_done_callback(lambda _future: self.slots.release())
+        return future
+
+    def store_pdf(self, expected_digest, data):
+        digest = _sha256(data)
+        if digest != expected_digest:
+            self.error(f"PDF {expected_digest} failed its checksum (content hashes to {digest})")
+            self.count('pdfs_failed')
+            return False
+        try:
+            if self.store.blobs.retain(digest):
+                self.count('pdfs_existing')
+            else:
+                self.store.blobs.put(data)
+                self.count('pdfs_imported')
+        except Exception as e:
+            self.error(f"PDF {digest} could not be stored: {e}")
+            self.count('pdfs_failed')
+            return False
+        return True
+
+    def store_project(self, manifest, annotations_bytes):
+        project_id = manifest.get('project_id')
+        try:
+            if _sha256(annotations_bytes) != manifest.get('annotations_sha256'):
+                raise ValueError('annotations failed their checksum')
+            annotations = json.loads(annotations_bytes)
+            if not isinstance(annotations, list):
+                raise ValueError('annotations are not a list')
+
+            digest = manifest.get('pdf_sha256')
+            if not isinstance(digest, str) or not DIGEST_PATTERN.match(digest):
+                raise ValueError('manifest has no valid pdf_sha256')
+            pdf_write = self.pdf_writes.get(digest)
+            pdf_ok = pdf_write.result() if pdf_write is not None else self.store.blobs.retain(digest)
+            if not pdf_ok:
+                raise ValueError(f'its PDF {digest} is missing or corrupt')
+
+            project = ProjectData()
+            project.project_id = project_id
+            project.created_at = manifest.get('created_at') or project.created_at
+            project.pdf_filename = manifest.get('pdf_filename') or ''
+            project.metadata = manifest.get('metadata') or {}
+            project.annotations = annotations
+            project.pdf_sha256 = digest
+
+            # on_project runs under the project lock too, so it can drop buffered writes of the old version
+            with self.store.lock(project_id):
+                if not self.overwrite and self.store.load(project_id) is not None:
+                    self.count('projects_skipped')
+                    return
+                self.store.save(project)
+                self.count('projects_imported')
+                if self.on_project:
+                    self.on_project(project_id)
+        except Exception as e:
+            self.error(f"Project {project_id} not imported: {e}")
+            self.count('projects_failed')
+
+    def read_member(self, tar, member):
+        data = tar.extractfile(member).read()
+        with self.lock:
+            self.report['bytes_read'] += len(data)
+        return data
+
+    def run(self, stream):
+        try:
+            tar = tarfile.open(fileobj=stream, mode='r|*')
+        except tarfile.TarError as e:
+            raise BundleError(f'Not a project bundle: {e}')
+
+        trailer = None
+        try:
+            with tar:
+                header_seen = False
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    name = member.name
+
+                    if not header_seen:
+                        if name != HEADER_NAME:
+                            raise BundleError(f'Not a project bundle: first entry is {name}')
+                        try:
+                            header = json.loads(self.read_member(tar, member))
+                        except ValueError as e:
+                            raise BundleError(f'Not a project bundle: unreadable header ({e})')
+                        if not isinstance(header, dict):
+                            raise BundleError('Not a project bundle: header is not an object')
+                        if header.get('format') != BUNDLE_FORMAT:
+                            raise BundleError(f"Not a project bundle: format {header.get('format')!r}")
+                        if header.get('version', 0) > BUNDLE_VERSION:
+                            raise BundleError(f"Bundle version {header.get('version')} is newer than supported")
+                        header_seen = True
+                        continue
+
+                    if name == TRAILER_NAME:
+                        try:
+                            trailer = json.loads(self.read_member(tar, member))
+                        except ValueError as e:
+                            self.error(f"Unreadable bundle trailer: {e}")
+                            continue
+                        if not isinstance(trailer, dict):
+                            self.error("Unreadable bundle trailer: not an object")
+                            trailer = None
+                        continue
+
+                    match = PDF_ENTRY_PATTERN.match(name)
+                    if match:
+                        digest = match.group(1)
+                        self.pdf_writes[digest] = self.submit(self.store_pdf, digest, self.read_member(tar, member))
+                        continue
+
+                    match = PROJECT_ENTRY_PATTERN.match(name)
+                    if not match:
+                        self.error(f"Ignoring unexpected bundle entry {name}")
+                        continue
+                    project_id, kind = match.groups()
+                    if kind == 'manifest':
+                        try:
+                            manifest = json.loads(self.read_member(tar, member))
+                        except ValueError as e:
+                            self.error(f"Project {project_id} not imported: unreadable manifest ({e})")
+                            self.count('projects_failed')
+                            continue
+                        if not isinstance(manifest, dict):
+                            self.error(f"Project {project_id} not imported: manifest is not an object")
+                            self.count('projects_failed')
+                            continue
+                        if manifest.get('project_id') != project_id:
+                            self.error(f"Project {project_id} not imported: manifest names {manifest.get('project_id')!r}")
+                            self.count('projects_failed')
+                            continue
+                        self.pending_manifests[project_id] = manifest
+                    else:
+                        manifest = self.pending_manifests.pop(project_id, None)
+                        if manifest is None:
+                            self.error(f"Project {project_id} not imported: annotations without a manifest")
+                            self.count('projects_failed')
+                            continue
+                        self.submit(self.store_project, manifest, self.read_member(tar, member))
+        except (tarfile.TarError, EOFError, OSError) as e:
+            self.error(f"Bundle is truncated or damaged: {e}")
+        finally:
+            self.executor.shutdown(wait=True)
+
+        for project_id in self.pending_manifests:
+            self.error(f"Project {project_id} not imported: annotations missing")
+            self.report['projects_failed'] += 1
+
+        if trailer is None:
+            self.error("Bundle has no trailer; it was probably cut off")
+        else:
+            seen = sum(self.report[key] for key in ('projects_imported', 'projects_skipped', 'projects_failed'))
+            if seen != trailer.get('projects'):
+                self.error(f"Bundle lists {trailer.get('projects')} projects but {seen} were found")
+            else:
+                self.report['complete'] = True
+        return self.report
+
+
+def import_bundle(store, stream, workers=8, overwrite=False, on_project=None):
+    """
+    Restore the projects of a bundle read from a binary stream.
+    Existing projects are kept unless overwrite is set. on_project(project_id)
+    is called after each project is saved. Returns a report dict; raises
+    BundleError if the stream isn't a bundle.
+    """
+    start_time = time.perf_counter()
+    report = _BundleImport(store, max(1, workers), overwrite, on_project).run(stream)
+    report['seconds'] = round(time.perf_counter() - start_time, 2)
+    print(f"Imported {report['projects_imported']} projects ({report['projects_skipped']} skipped, "
+          f"{report['projects_failed']} failed) and {report['pdfs_imported']} PDFs in {report['seconds']}s")
+    return report
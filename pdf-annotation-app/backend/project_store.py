@@ -0,0 +1,593 @@
+"""
+Crash-safe project storage.
+
+Projects are kept behind a small StorageBackend interface so the local
+filesystem can be swapped for another store (for example an S3-compatible
+object store) without touching the routes. The filesystem backend:
+
+- spreads files over hash-prefix shard directories (ab/cd/<name>) so no
+  single directory grows without limit
+- writes through a temp file, fsync and atomic rename, so a crash never
+  leaves a half-written project behind
+- serializes writers of the same key with an OS-level file lock, kept
+  in the same kind of shard tree under .locks
+
+Stores written by older versions kept every file directly in the folder.
+Those files are invisible to the sharded layout, so open_project_store()
+refuses to open such a store unless asked to migrate it: run
+`manage.py migrate-layout` once (the development server, `python app.py`,
+migrates on its own).
+"""
+import base64
+import hashlib
+import io
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+LOCK_DIR_NAME = '.locks'
+TEMP_PREFIX = '.tmp-'
+
+# Lock held while files of the old flat layout are moved, so concurrent processes don't race
+LAYOUT_LOCK_KEY = 'layout-migration'
+
+DEFAULT_PROJECTS_FOLDER = os.environ.get('PROJECTS_FOLDER', '../projects')
+
+
+class ProjectData:
+    def __init__(self):
+        self.project_id = str(uuid.uuid4())
+        self.created_at = datetime.now().isoformat()
+        self.pdf_data = None  # Only set in projects saved before PDFs moved out of the pickle
+        self.pdf_sha256 = None  # Digest of the PDF in the blob store
+        self.pdf_filename = ""
+        self.annotations = []
+        self.metadata = {}
+
+    def to_dict(self):
+        return {
+            'project_id': self.project_id,
+            'created_at': self.created_at,
+            'pdf_filename': self.pdf_filename,
+            'annotations': self.annotations,
+            'metadata': self.metadata
+        }
+
+
+class ProjectUnpickler(pickle.Unpickler):
+    """
+    Unpickler that only rebuilds ProjectData objects.
+    Projects saved while app.py ran as a script reference __main__.ProjectData;
+    those are mapped to the class defined here.
+    """
+
+    def find_class(self, module, name):
+        if name == 'ProjectData' and module in ('__main__', 'app', 'project_store'):
+            return ProjectData
+        raise pickle.UnpicklingError(f'Refusing to load {module}.{name} from a project file')
+
+
+def load_project_bytes(data):
+    """Unpickle a project from bytes"""
+    return ProjectUnpickler(io.BytesIO(data)).load()
+
+def dump_project_bytes(project):
+    """Pickle a project to bytes"""
+    return pickle.dumps(project, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class StorageBackend:
+    """
+    Minimal key/value interface used by ProjectStore.
+    Keys are relative, '/'-separated names such as 'project_<id>.pkl'.
+    """
+
+    def read(self, key):
+        """Return the bytes stored under key, or raise KeyError"""
+        raise NotImplementedError
+
+    def write(self, key, data):
+        """Store data under key atomically (readers see the old or the new value, never a mix)"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove key if it exists"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def size(self, key):
+        """Size in bytes of the value stored under key"""
+        raise NotImplementedError
+
+    def mtime(self, key):
+        """Last modification time of key as a Unix timestamp"""
+        raise NotImplementedError
+
+    def touch(self, key):
+        """Set the modification time of key to now"""
+        raise NotImplementedError
+
+    def list_keys(self, directory='', suffix=''):
+        """Yield all keys directly inside directory ('' for top level) ending with suffix"""
+        raise NotImplementedError
+
+    def lock(self, key):
+        """
+        Context manager holding an exclusive lock for key across threads and
+        processes. A thread that holds the lock may take it again.
+        """
+        raise NotImplementedError
+
+    def local_path(self, key):
+        """Filesystem path of key if the backend stores it locally, otherwise None"""
+        return None
+
+
+def _fsync_directory(path):
+    # Directory fsync makes the rename itself durable; not supported on Windows
+    if sys.platform == 'win32':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FilesystemBackend(StorageBackend):
+    """Stores each key as a file in a hash-prefix sharded directory tree"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        # Lock paths held by the current thread, with their nesting depth
+        self._held = threading.local()
+
+    @staticmethod
+    def _shard(name):
+        # Shard on the name without extension so all files of one project share a directory
+        stem = name.split('.', 1)[0]
+        digest = hashlib.sha1(stem.encode('utf-8')).hexdigest()
+        return digest[:2], digest[2:4]
+
+    def _path(self, key):
+        directory, name = os.path.split(key)
+        if not name or name.startswith('.') or '..' in key.split('/'):
+            raise ValueError(f'Invalid storage key: {key}')
+        return os.path.join(self.root, directory, *self._shard(name), name)
+
+    def read(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def write(self, key, data):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        _fsync_directory(directory)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def size(self, key):
+        return os.path.getsize(self._path(key))
+
+    def mtime(self, key):
+        return os.path.getmtime(self._path(key))
+
+    def touch(self, key):
+        os.utime(self._path(key))
+
+    def list_keys(self, directory='', suffix=''):
+        base = os.path.join(self.root, directory)
+        if not os.path.isdir(base):
+            return
+        # Files live exactly two shard levels below their key directory
+        for shard1 in sorted(os.listdir(base)):
+            shard1_path = os.path.join(base, shard1)
+            if len(shard1) != 2 or not os.path.isdir(shard1_path):
+                continue
+            for shard2 in os.listdir(shard1_path):
+                shard2_path = os.path.join(shard1_path, shard2)
+                if not os.path.isdir(shard2_path):
+                    continue
+                for filename in os.listdir(shard2_path):
+                    if filename.startswith('.') or not filename.endswith(suffix):
+                        continue
+                    yield f'{directory}/{filename}' if directory else filename
+
+    @contextmanager
+    def lock(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        lock_path = os.path.join(self.root, LOCK_DIR_NAME, digest[:2], digest[2:4], f'{digest}.lock')
+        held = self._held.__dict__.setdefault('paths', {})
+        if lock_path in held:
+            # flock would block on a second open file of the same lock, so nested use is counted here
+            held[lock_path] += 1
+            try:
+                yield
+            finally:
+                held[lock_path] -= 1
+            return
+
+        try:
+            lock_file = open(lock_path, 'a+b')
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            lock_file = open(lock_path, 'a+b')
+        with lock_file:
+            if sys.platform == 'win32':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            held[lock_path] = 1
+            try:
+                yield
+            finally:
+                del held[lock_path]
+                if sys.platform == 'win32':
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def local_path(self, key):
+        return self._path(key)
+
+    def flat_files(self):
+        """Names of the files left in the folder by the old flat layout"""
+        return [name for name in os.listdir(self.root)
+                if not name.startswith('.') and os.path.isfile(os.path.join(self.root, name))]
+
+    def migrate_flat_files(self):
+        """Move files written by the old flat layout into their shard directories"""
+        moved = 0
+        with self.lock(LAYOUT_LOCK_KEY):
+            for name in self.flat_files():
+                old_path = os.path.join(self.root, name)
+                new_path = self._path(name)
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.replace(old_path, new_path)
+                moved += 1
+        if moved:
+            print(f"Moved {moved} project files into sharded directories")
+        return moved
+
+
+class BlobStore:
+    """
+    Content-addressed storage for PDFs with reference counts.
+    Each blob is stored once under its SHA-256 digest, no matter how many
+    projects use it. The counts make the common case cheap; garbage
+    collection recomputes them from the projects, so a count that drifted
+    after a crash is repaired rather than trusted.
+    """
+
+    def __init__(self, backend, directory='blobs'):
+        self.backend = backend
+        self.directory = directory
+
+    def blob_key(self, digest):
+        return f'{self.directory}/{digest}.pdf'
+
+    def refs_key(self, digest):
+        return f'{self.directory}/{digest}.refs'
+
+    def put(self, data):
+        """Store data if it isn't stored yet and return its digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        key = self.blob_key(digest)
+        with self.backend.lock(key):
+            if self.backend.exists(key):
+                # Reused: restart the grace period garbage collection gives new blobs
+                self.backend.touch(key)
+            else:
+                self.backend.write(key, data)
+        return digest
+
+    def retain(self, digest):
+        """
+        Touch a stored blob under its lock, as put() does when data is reused,
+        so garbage collection keeps it for a caller about to reference it.
+        Returns False if the blob isn't stored.
+        """
+        key = self.blob_key(digest)
+        with self.backend.lock(key):
+            if not self.backend.exists(key):
+                return False
+            self.backend.touch(key)
+        return True
+
+    def get(self, digest):
+        return self.backend.read(self.blob_key(digest))
+
+    def exists(self, digest):
+        return self.backend.exists(self.blob_key(digest))
+
+    def path(self, digest):
+        return self.backend.local_path(self.blob_key(digest))
+
+    def size(self, digest):
+        return self.backend.size(self.blob_key(digest))
+
+    def refcount(self, digest):
+        try:
+            return int(self.backend.read(self.refs_key(digest)))
+        except (KeyError, ValueError):
+            return 0
+
+    def _adjust_refcount(self, digest, delta):
+        with self.backend.lock(self.blob_key(digest)):
+            count = max(0, self.refcount(digest) + delta)
+            self.backend.write(self.refs_key(digest), str(count).encode('ascii'))
+            return count
+
+    def incref(self, digest):
+        return self._adjust_refcount(digest, 1)
+
+    def decref(self, digest):
+        return self._adjust_refcount(digest, -1)
+
+    def digests(self):
+        """Yield the digest of every stored blob"""
+        for key in self.backend.list_keys(self.directory, '.pdf'):
+            yield os.path.basename(key)[:-len('.pdf')]
+
+    def delete_unused(self, digest, unused_since):
+        """
+        Delete a blob if, checked again under its lock, its refcount is 0 and it
+        hasn't been stored or reused since unused_since (a Unix timestamp). A
+        save reusing the blob touches it before counting it, so such a blob is
+        kept. Returns the number of bytes freed, or None if the blob was kept.
+        """
+        key = self.blob_key(digest)
+        with self.backend.lock(key):
+            if not self.backend.exists(key) or self.backend.mtime(key) >= unused_since or self.refcount(digest):
+                return None
+            size = self.backend.size(key)
+            self.backend.delete(key)
+            self.backend.delete(self.refs_key(digest))
+        return size
+
+
+class ProjectStore:
+    """Project persistence on top of a StorageBackend, with PDFs deduplicated in a BlobStore"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.blobs = BlobStore(backend)
+
+    @staticmethod
+    def project_key(project_id):
+        return f'project_{project_id}.pkl'
+
+    @staticmethod
+    def legacy_pdf_key(project_id):
+        # Per-project PDF file used before PDFs moved to the blob store
+        return f'project_{project_id}.pdf'
+
+    def lock(self, project_id):
+        return self.backend.lock(self.project_key(project_id))
+
+    def _write_project(self, project):
+        data = dump_project_bytes(project)
+        self.backend.write(self.project_key(project.project_id), data)
+        return len(data)
+
+    def save(self, project, pdf_bytes=None):
+        """
+        Save a project and, if given, its PDF. The PDF blob is written first
+        so a project file never points at a PDF that isn't there yet.
+        Returns the size of the project file written.
+        """
+        with self.lock(project.project_id):
+            previous = self.load(project.project_id)
+            old_digest = getattr(previous, 'pdf_sha256', None) if previous else None
+
+            if pdf_bytes is not None:
+                project.pdf_sha256 = self.blobs.put(pdf_bytes)
+                project.pdf_data = None
+            new_digest = getattr(project, 'pdf_sha256', None)
+
+            if new_digest and new_digest != old_digest:
+                self.blobs.incref(new_digest)
+            written = self._write_project(project)
+            if old_digest and old_digest != new_digest:
+                self.blobs.decref(old_digest)
+            return written
+
+    def load(self, project_id):
+        """Load a project by id, or return None if it doesn't exist"""
+        try:
+            return load_project_bytes(self.backend.read(self.project_key(project_id)))
+        except KeyError:
+            return None
+
+    def revision(self, project_id):
+        """
+        A value that changes whenever the project is saved (mtime and size of
+        its file), for invalidating derived data. None if the project doesn't exist.
+        """
+        key = self.project_key(project_id)
+        try:
+            return (self.backend.mtime(key), self.backend.size(key))
+        except (KeyError, OSError):
+            return None
+
+    def load_pdf(self, project):
+        """
+        Return the raw PDF bytes of a project.
+        Handles the blob store as well as the older layouts: base64 embedded
+        in the pickle, or a separate per-project PDF file.
+        """
+        digest = getattr(project, 'pdf_sha256', None)
+        if digest:
+            return self.blobs.get(digest)
+        if project.pdf_data:
+            return base64.b64decode(project.pdf_data)
+        return self.backend.read(self.legacy_pdf_key(project.project_id))
+
+    def open_pdf(self, project):
+        """
+        Open a project's PDF as a binary file object. Blobs on local disk are
+        opened directly, so readers like pypdf load only what they seek to
+        instead of holding the whole document in memory.
+        """
+        digest = getattr(project, 'pdf_sha256', None)
+        path = self.blobs.path(digest) if digest else None
+        if path:
+            return open(path, 'rb')
+        return io.BytesIO(self.load_pdf(project))
+
+    def migrate_pdf(self, project):
+        """
+        Move a project's PDF from an older layout into the blob store.
+        Returns the (possibly updated) project.
+        """
+        if getattr(project, 'pdf_sha256', None):
+            return project
+        with self.lock(project.project_id):
+            pdf_bytes = self.load_pdf(project)
+            project.pdf_sha256 = self.blobs.put(pdf_bytes)
+            project.pdf_data = None
+            self.blobs.incref(project.pdf_sha256)
+            self._write_project(project)
+            self.backend.delete(self.legacy_pdf_key(project.project_id))
+        return project
+
+    def pdf_path(self, project):
+        """Local path of the project PDF, or None if the backend isn't filesystem based"""
+        return self.blobs.path(project.pdf_sha256)
+
+    def delete(self, project_id):
+        with self.lock(project_id):
+            project = self.load(project_id)
+            self.backend.delete(self.project_key(project_id))
+            self.backend.delete(self.legacy_pdf_key(project_id))
+        digest = getattr(project, 'pdf_sha256', None) if project else None
+        if digest:
+            self.blobs.decref(digest)
+
+    def iter_projects(self):
+        """Yield (key, project) for every readable project; unreadable files are reported and skipped"""
+        for key in self.backend.list_keys(suffix='.pkl'):
+            try:
+                yield key, load_project_bytes(self.backend.read(key))
+            except Exception as e:
+                print(f"WARNING: Skipping unreadable project file {key}: {e}")
+
+    def collect_garbage(self, dry_run=False, grace_seconds=3600):
+        """
+        Delete blobs no project refers to and repair reference counts.
+        Blobs stored or reused within grace_seconds are kept, since a save may
+        have written the blob but not yet the project that refers to it. An
+        unused blob whose count drifted above 0 has the count reset and is
+        deleted by the next collection. Returns a report dict with counts and
+        reclaimed bytes.
+        """
+        live = {}
+        for _, project in self.iter_projects():
+            digest = getattr(project, 'pdf_sha256', None)
+            if digest:
+                live[digest] = live.get(digest, 0) + 1
+
+        report = {'blobs': 0, 'live_blobs': 0, 'deleted_blobs': 0,
+                  'reclaimed_bytes': 0, 'repaired_refcounts': 0, 'dry_run': dry_run}
+        now = time.time()
+
+        for digest in list(self.blobs.digests()):
+            report['blobs'] += 1
+            expected = live.get(digest, 0)
+
+            if expected:
+                report['live_blobs'] += 1
+                if self.blobs.refcount(digest) != expected:
+                    report['repaired_refcounts'] += 1
+                    if not dry_run:
+                        with self.backend.lock(self.blobs.blob_key(digest)):
+                            self.backend.write(self.blobs.refs_key(digest), str(expected).encode('ascii'))
+                continue
+
+            blob_key = self.blobs.blob_key(digest)
+            unused_since = now - grace_seconds
+            if self.backend.mtime(blob_key) >= unused_since:
+                continue
+
+            if self.blobs.refcount(digest):
+                report['repaired_refcounts'] += 1
+                if not dry_run:
+                    with self.backend.lock(blob_key):
+                        # Unless a save has reused the blob since the projects were read
+                        if self.backend.mtime(blob_key) < unused_since:
+                            self.backend.write(self.blobs.refs_key(digest), b'0')
+                continue
+
+            if dry_run:
+                report['deleted_blobs'] += 1
+                report['reclaimed_bytes'] += self.backend.size(blob_key)
+                continue
+            freed = self.blobs.delete_unused(digest, unused_since)
+            if freed is not None:
+                report['deleted_blobs'] += 1
+                report['reclaimed_bytes'] += freed
+
+        return report
+
+
+class LayoutMigrationRequired(RuntimeError):
+    """Raised when a store still has files of the old flat layout that would be invisible"""
+
+
+def open_project_store(folder, migrate=False):
+    """
+    Open the filesystem project store in folder. Files of the old flat layout
+    are moved into shard directories if migrate is set; otherwise they raise
+    LayoutMigrationRequired rather than silently dropping out of the store.
+    """
+    os.makedirs(folder, exist_ok=True)
+    backend = FilesystemBackend(folder)
+    if migrate:
+        backend.migrate_flat_files()
+    else:
+        flat_files = backend.flat_files()
+        if flat_files:
+            raise LayoutMigrationRequired(
+                f"{len(flat_files)} files in {backend.root} use the old flat layout; "
+                f"run 'python manage.py migrate-layout' to move them")
+    return ProjectStore(backend)
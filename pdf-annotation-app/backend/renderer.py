@@ -0,0 +1,780 @@
+"""
+PDF rendering core for the annotation backend.
+
+Holds font registration, CSS-to-reportlab style mapping and the overlay
+drawing used to burn annotations into a PDF. Nothing in here depends on
+Flask, so the same code serves the HTTP routes and offline jobs such as
+mail merge and batch_render.
+
+The bundled fonts are registered on first use rather than on import, so
+a process that only copies pages, or renders pages without annotations,
+never pays for loading them. FONT_FAMILY_MAP, AVAILABLE_FONT_FAMILIES
+and FONT_TABLE_VERSION are still importable; reading one of them
+registers the fonts.
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+from functools import lru_cache
+from io import BytesIO
+
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfbase import pdfmetrics
+from reportlab.lib.colors import HexColor
+from reportlab.pdfgen import canvas
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject
+
+from glyph_coverage import GlyphCoverageIndex
+from overlay_cache import DEFAULT_CACHE_FOLDER, hash_json
+
+# Resource name under which the annotation overlay is attached to a page
+OVERLAY_XOBJECT_NAME = '/AnnotOverlay'
+
+# Bump whenever a drawing change alters rendered output, so cached overlays are not reused
+RENDERER_VERSION = 2
+
+# Families tried, in order, for characters the annotation's font has no glyph for
+# (FONT_FALLBACK_FAMILIES, comma separated; registered font file names work too)
+FALLBACK_FONT_FAMILIES = [
+    name.strip() for name in os.environ.get(
+        'FONT_FALLBACK_FAMILIES', 'Arial,Open Sans,Roboto,Times New Roman,Courier New').split(',')
+    if name.strip()
+]
+
+# Which code points each registered font has glyphs for, filled in by register_system_fonts
+GLYPH_COVERAGE = GlyphCoverageIndex(os.path.join(DEFAULT_CACHE_FOLDER, 'glyph_coverage.json'))
+
+def register_system_fonts():
+    """
+    Register fonts from bundled fonts directory ONLY.
+    Returns a dict mapping font family names to registered font identifiers.
+    Also returns a list of available font families for the frontend.
+    """
+    bundled_fonts_dir = os.path.join(os.path.dirname(__file__), 'fonts')
+    
+    if not os.path.isdir(bundled_fonts_dir):
+        print(f"WARNING: Bundled fonts directory not found: {bundled_fonts_dir}")
+        print("Creating directory. Please add .ttf font files to this directory.")
+        os.makedirs(bundled_fonts_dir, exist_ok=True)
+        return {}, []
+    
+    print(f"Loading bundled fonts from: {bundled_fonts_dir}")
+    
+    # Font family name mappings (display name -> filename patterns)
+    # This maps friendly names to the actual font filenames
+    font_family_patterns = {
+        # Liberation Fonts (core fonts)
+        'Arial': ['liberationsans-regular', 'liberationsans-bold', 'liberationsans-italic', 'liberationsans-bolditalic'],
+        'Times New Roman': ['liberationserif-regular', 'liberationserif-bold', 'liberationserif-italic', 'liberationserif-bolditalic'],
+        'Courier New': ['liberationmono-regular', 'liberationmono-bold', 'liberationmono-italic', 'liberationmono-bolditalic'],
+        
+        # Google Fonts and others
+        'Roboto': ['roboto-variablefont', 'roboto-italic-variablefont'],
+        'Open Sans': ['opensans-variablefont', 'opensans-italic-variablefont'],
+        'Lato': ['lato-regular', 'lato-bold', 'lato-italic', 'lato-bolditalic', 'lato-black', 'lato-blackitalic', 'lato-light', 'lato-lightitalic'],
+        'Merriweather': ['merriweather-variablefont', 'merriweather-italic-variablefont'],
+        'Montserrat': ['montserrat-variablefont', 'montserrat-italic-variablefont'],
+        'Source Code Pro': ['sourcecodepro-variablefont', 'sourcecodepro-italic-variablefont'],
+        'Saira': ['saira-variablefont', 'saira-italic-variablefont'],
+        
+        # Script/Handwriting fonts
+        'Caveat': ['caveat-variablefont'],
+        'Dancing Script': ['dancingscript-variablefont'],
+        'Pacifico': ['pacifico-regular'],
+        'Great Vibes': ['greatvibes-regular'],
+        'Parisienne': ['parisienne-regular'],
+        'Shadows Into Light': ['shadowsintolight-regular'],
+        'Berkshire Swash': ['berkshireswash-regular'],
+        
+        # Signature fonts
+        'Momo Signature': ['momosignature-regular'],
+        'Are You Serious': ['areyouserious-regular'],
+        
+        # Display/Decorative fonts
+        'Lobster': ['lobster-regular', 'lobstertwo-regular', 'lobstertwo-bold', 'lobstertwo-italic', 'lobstertwo-bolditalic'],
+        'Anton': ['anton-regular'],
+        'Fjalla One': ['fjallaone-regular'],
+        'Gravitas One': ['gravitasone-regular'],
+        'Orbitron': ['orbitron-variablefont'],
+        'Michroma': ['michroma-regular'],
+        'Creepster': ['creepster-regular'],
+        'Sixtyfour': ['sixtyfour-regular-variablefont'],
+    }
+
+    registered_fonts = {}  # Maps registered name to font path
+    font_family_map = {}   # Maps font family name to list of registered variants
+    available_families = []  # List of font families available for frontend
+    
+    # Find all font files in bundled directory only
+    font_files_to_scan = []
+    font_files_to_scan.extend(glob.glob(os.path.join(bundled_fonts_dir, "*.ttf")))
+    font_files_to_scan.extend(glob.glob(os.path.join(bundled_fonts_dir, "*.ttc")))
+
+    print(f"Found {len(font_files_to_scan)} font files in bundled directory.")
+
+    # Register fonts and build mapping
+    for font_path in font_files_to_scan:
+        try:
+            filename = os.path.basename(font_path)
+            base_name = os.path.splitext(filename)[0].lower()
+            
+            # Register with the filename as the identifier
+            font = TTFont(filename, font_path)
+            pdfmetrics.registerFont(font)
+            registered_fonts[filename] = font_path
+            GLYPH_COVERAGE.add_ttfont(filename, font_path, font)
+            
+            # Map this file to font families
+            for family_name, patterns in font_family_patterns.items():
+                for pattern in patterns:
+                    if base_name == pattern or base_name.startswith(pattern.split('-')[0]):
+                        if family_name not in font_family_map:
+                            font_family_map[family_name] = []
+                            available_families.append(family_name)
+                        font_family_map[family_name].append(filename)
+                        break
+        except Exception as e:
+            print(f"  Warning: Failed to register {filename}: {e}")
+
+    # Sort available families alphabetically
+    available_families.sort()
+
+    if registered_fonts:
+        print(f"Successfully registered {len(registered_fonts)} bundled font files.")
+        print(f"Available font families: {len(available_families)}")
+        with open('font_mapping.log', 'w', encoding='utf-8') as f:
+            f.write(f"=== Bundled Font Registration ===\n\n")
+            f.write(f"Total registered: {len(registered_fonts)} font files\n")
+            f.write(f"Font families mapped: {len(font_family_map)}\n\n")
+            for family in available_families:
+                files = font_family_map.get(family, [])
+                f.write(f"{family}:\n")
+                for file in files:
+                    f.write(f"  - {file}\n")
+    else:
+        print("WARNING: No fonts were registered. Please add .ttf files to the fonts/ directory.")
+    
+    GLYPH_COVERAGE.save()
+    return font_family_map, available_families
+
+def compute_font_table_version(font_family_map):
+    """
+    Fingerprint of everything that affects how text is drawn: the renderer
+    version, the family -> font name table and the bundled font files.
+    Part of every overlay cache key.
+    """
+    digest = hashlib.sha256(f'renderer-{RENDERER_VERSION}'.encode())
+    digest.update(json.dumps(font_family_map, sort_keys=True).encode())
+    fonts_dir = os.path.join(os.path.dirname(__file__), 'fonts')
+    for path in sorted(glob.glob(os.path.join(fonts_dir, '*.tt[fc]'))):
+        digest.update(f'{os.path.basename(path)}:{os.path.getsize(path)}'.encode())
+    return digest.hexdigest()[:16]
+
+_font_table = None
+_font_table_lock = threading.Lock()
+
+def font_table():
+    """
+    (family map, available families, font table version), registering the
+    bundled fonts on the first call.
+    """
+    global _font_table
+    if _font_table is None:
+        with _font_table_lock:
+            if _font_table is None:
+                font_family_map, available_families = register_system_fonts()
+                _font_table = (font_family_map, available_families, compute_font_table_version(font_family_map))
+    return _font_table
+
+_LAZY_FONT_ATTRIBUTES = ('FONT_FAMILY_MAP', 'AVAILABLE_FONT_FAMILIES', 'FONT_TABLE_VERSION')
+
+def __getattr__(name):
+    if name in _LAZY_FONT_ATTRIBUTES:
+        return font_table()[_LAZY_FONT_ATTRIBUTES.index(name)]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def parse_color(color_str):
+    """Convert CSS color to reportlab color"""
+    if not color_str:
+        return "black"
+    
+    # Handle named colors
+    color_map = {
+        'red': HexColor('#FF0000'),
+        'blue': HexColor('#0000FF'),
+        'green': HexColor('#008000'),
+        'black': HexColor('#000000'),
+        'white': HexColor('#FFFFFF'),
+        'yellow': HexColor('#FFFF00'),
+        'orange': HexColor('#FFA500'),
+        'purple': HexColor('#800080'),
+        'gray': HexColor('#808080'),
+        'grey': HexColor('#808080'),
+        'brown': HexColor('#A52A2A'),
+        'pink': HexColor('#FFC0CB'),
+        'cyan': HexColor('#00FFFF'),
+        'magenta': HexColor('#FF00FF'),
+        'lime': HexColor('#00FF00'),
+        'navy': HexColor('#000080'),
+        'maroon': HexColor('#800000'),
+        'olive': HexColor('#808000'),
+        'teal': HexColor('#008080'),
+        'silver': HexColor('#C0C0C0')
+    }
+    
+    color_str = color_str.lower().strip()
+    
+    if color_str in color_map:
+        return color_map[color_str]
+    
+    # Handle hex colors
+    if color_str.startswith('#'):
+        try:
+            return HexColor(color_str)
+        except:
+            return "black"
+    
+    # Handle rgb() format
+    if color_str.startswith('rgb('):
+        try:
+            # Extract numbers from rgb(r,g,b)
+            rgb_part = color_str[4:-1]  # Remove 'rgb(' and ')'
+            r, g, b = [int(x.strip()) for x in rgb_part.split(',')]
+            hex_color = '#%02x%02x%02x' % (r, g, b)
+            return HexColor(hex_color)
+        except:
+            return "black"
+    
+    # Default fallback
+    return "black"
+
+def parse_border_style(style_str):
+    """Convert CSS border style to reportlab dash pattern"""
+    if not style_str:
+        return []  # solid
+    
+    style_str = style_str.lower().strip()
+    
+    if style_str == 'none':
+        return None  # Special value for no border
+    elif style_str == 'dashed':
+        return [3, 3]  # 3 points on, 3 points off
+    elif style_str == 'dotted':
+        return [1, 2]  # 1 point on, 2 points off
+    else:
+        return []  # solid for anything else
+
+def map_font_family(font_family, font_bold=False, font_italic=False):
+    """
+    Map CSS font family and style to reportlab font name.
+    Uses the font family map of the registered bundled fonts (see font_table()).
+    Falls back to built-in fonts if the requested font isn't available.
+    """
+    if not font_family:
+        font_family = 'Arial'
+    
+    # Write to log file for debugging
+    try:
+        with open('font_mapping.log', 'a', encoding='utf-8') as f:
+            f.write(f"\nMapping font '{font_family}', bold={font_bold}, italic={font_italic}\n")
+    except:
+        pass
+    
+    # Check if we have this font family registered
+    # Try exact match first (case-sensitive)
+    font_family_map = font_table()[0]
+    if font_family in font_family_map:
+        available_files = font_family_map[font_family]
+        
+        # Try to find the right variant based on bold/italic
+        # Common patterns: 'b' or 'bd' for bold, 'i' for italic, 'z' or 'bi' for bold-italic
+        selected_font = None
+        
+        if font_bold and font_italic:
+            # Look for bold-italic variant
+            for f in available_files:
+                base = f.lower().replace('.ttf', '').replace('.ttc', '')
+                if 'z' in base or ('b' in base and 'i' in base) or 'bolditalic' in base:
+                    selected_font = f
+                    break
+        
+        if not selected_font and font_bold:
+            # Look for bold variant
+            for f in available_files:
+                base = f.lower().replace('.ttf', '').replace('.ttc', '')
+                if ('b' in base or 'bold' in base) and 'i' not in base and 'z' not in base:
+                    selected_font = f
+                    break
+        
+        if not selected_font and font_italic:
+            # Look for italic variant
+            for f in available_files:
+                base = f.lower().replace('.ttf', '').replace('.ttc', '')
+                if 'i' in base and 'b' not in base and 'z' not in base:
+                    selected_font = f
+                    break
+        
+        if not selected_font:
+            # Use the first file (usually the regular variant)
+            selected_font = available_files[0]
+        
+        try:
+            with open('font_mapping.log', 'a', encoding='utf-8') as f:
+                f.write(f"  Using registered font: '{selected_font}'\n")
+        except:
+            pass
+        
+        return selected_font
+    
+    # Fall back to built-in reportlab fonts
+    # Map common web fonts to reportlab font families
+    fallback_map = {
+        # Sans-serif fonts -> Helvetica
+        'Arial': 'Helvetica',
+        'Helvetica': 'Helvetica',
+        'Verdana': 'Helvetica',
+        'Tahoma': 'Helvetica',
+        'Geneva': 'Helvetica',
+        'Calibri': 'Helvetica',
+        'Candara': 'Helvetica',
+        'Trebuchet MS': 'Helvetica',
+        'Century Gothic': 'Helvetica',
+        'Franklin Gothic Medium': 'Helvetica',
+        'Comic Sans MS': 'Helvetica',
+        
+        # Serif fonts -> Times-Roman
+        'Times New Roman': 'Times-Roman',
+        'Georgia': 'Times-Roman',
+        'Garamond': 'Times-Roman',
+        'Palatino': 'Times-Roman',
+        'Book Antiqua': 'Times-Roman',
+        'Cambria': 'Times-Roman',
+        
+        # Monospace fonts -> Courier
+        'Courier New': 'Courier',
+        'Consolas': 'Courier',
+        'Monaco': 'Courier',
+        
+        # Bold fonts -> Helvetica (will be made bold below)
+        'Arial Black': 'Helvetica',
+        'Impact': 'Helvetica',
+        
+        # Signature/Script fonts -> Helvetica (will be made oblique for handwriting effect)
+        'Brush Script MT': 'Helvetica',
+        'Lucida Handwriting': 'Helvetica',
+        'Segoe Script': 'Helvetica',
+        'Monotype Corsiva': 'Helvetica',
+        
+        # Decorative fonts
+        'Papyrus': 'Times-Roman',
+        'Copperplate': 'Times-Roman',
+    }
+    
+    # Get base font family
+    base_font = fallback_map.get(font_family, 'Helvetica')
+    
+    try:
+        with open('font_mapping.log', 'a', encoding='utf-8') as f:
+            f.write(f"  Fallback to built-in font, base: '{base_font}'\n")
+    except:
+        pass
+    
+    # Special handling for signature fonts - always use oblique/italic
+    signature_fonts = ['Brush Script MT', 'Lucida Handwriting', 'Segoe Script', 'Monotype Corsiva']
+    if font_family in signature_fonts:
+        try:
+            with open('font_mapping.log', 'a', encoding='utf-8') as f:
+                f.write(f"  '{font_family}' is a signature font, forcing italic=True\n")
+        except:
+            pass
+        font_italic = True
+    
+    # Special handling for Impact and Arial Black - always bold
+    if font_family in ['Impact', 'Arial Black']:
+        try:
+            with open('font_mapping.log', 'a', encoding='utf-8') as f:
+                f.write(f"  '{font_family}' is a bold font, forcing bold=True\n")
+        except:
+            pass
+        font_bold = True
+    
+    # Apply font style based on bold and italic flags
+    result_font = base_font  # Default
+    
+    if font_bold and font_italic:
+        # Both bold and italic
+        if base_font == 'Helvetica':
+            result_font = 'Helvetica-BoldOblique'
+        elif base_font == 'Times-Roman':
+            result_font = 'Times-BoldItalic'
+        elif base_font == 'Courier':
+            result_font = 'Courier-BoldOblique'
+    elif font_bold:
+        # Only bold
+        if base_font == 'Helvetica':
+            result_font = 'Helvetica-Bold'
+        elif base_font == 'Times-Roman':
+            result_font = 'Times-Bold'
+        elif base_font == 'Courier':
+            result_font = 'Courier-Bold'
+    elif font_italic:
+        # Only italic
+        if base_font == 'Helvetica':
+            result_font = 'Helvetica-Oblique'
+        elif base_font == 'Times-Roman':
+            result_font = 'Times-Italic'
+        elif base_font == 'Courier':
+            result_font = 'Courier-Oblique'
+    
+    try:
+        with open('font_mapping.log', 'a', encoding='utf-8') as f:
+            f.write(f"  Final reportlab font: '{result_font}'\n")
+    except:
+        pass
+    
+    return result_font
+
+@lru_cache(maxsize=256)
+def fallback_fonts(primary_font, font_bold=False, font_italic=False):
+    """Fonts to draw with, in order of preference: the annotation's font, then the fallback families"""
+    font_table()
+    fonts = [primary_font]
+    for family in FALLBACK_FONT_FAMILIES:
+        font = family if family in pdfmetrics.getRegisteredFontNames() else map_font_family(family, font_bold, font_italic)
+        if font not in fonts:
+            fonts.append(font)
+    return tuple(fonts)
+
+def draw_text_runs(can, x, y, text, fonts, font_size):
+    """
+    Draw one line of text, switching to a fallback font for characters the
+    first font can't draw. Returns the width of the drawn text.
+    """
+    width = 0
+    for font, run in GLYPH_COVERAGE.split_runs(text, fonts):
+        can.setFont(font, font_size)
+        can.drawString(x + width, y, run)
+        width += can.stringWidth(run, font, font_size)
+    return width
+
+def get_background_fill(annotation):
+    """
+    Determine background fill settings for an annotation.
+    Returns tuple: (should_fill, fill_color)
+    """
+    # Check new backgroundColor property first
+    bg_color = annotation.get('backgroundColor')
+    
+    if bg_color is None:
+        # Fall back to old transparent property for backward compatibility
+        transparent = annotation.get('transparent', False)
+        if transparent:
+            return (False, None)
+        else:
+            return (True, HexColor('#FFFFFF'))  # White background
+    
+    # Handle new backgroundColor values
+    if bg_color == 'transparent':
+        return (False, None)
+    elif bg_color == 'white':
+        return (True, HexColor('#FFFFFF'))
+    else:
+        # Custom color - parse it
+        color = parse_color(bg_color)
+        return (True, color)
+
+def draw_annotation(can, annotation, page_width, page_height):
+    """
+    Draw a single annotation onto a reportlab canvas.
+    Coordinates in the annotation use the web convention (top-left origin).
+    Returns False if the annotation lies completely outside the page.
+    """
+    x = float(annotation.get('x', 0))
+    y = float(annotation.get('y', 0))
+    width = float(annotation.get('width', 100))
+    height = float(annotation.get('height', 20))
+    value = str(annotation.get('value', ''))
+
+    print(f"  Original annotation: '{value}' at web({x},{y}) size({width},{height})")
+
+    # Skip annotations that are completely outside the page bounds
+    if x >= page_width or y >= page_height or x + width <= 0 or y + height <= 0:
+        print(f"  Skipping annotation outside bounds: x={x}, y={y}, page_size=({page_width},{page_height})")
+        return False
+
+    # Clip coordinates to page bounds but don't force them to arbitrary values
+    clipped_x = max(0, min(x, page_width - 1))
+    clipped_y = max(0, min(y, page_height - 1))
+    clipped_width = min(width, page_width - clipped_x)
+    clipped_height = min(height, page_height - clipped_y)
+
+    # Convert web coordinates (top-left origin) to PDF coordinates (bottom-left origin)
+    pdf_x = clipped_x
+    pdf_y = page_height - clipped_y - clipped_height
+
+    print(f"  Final annotation: '{value}' at web({clipped_x},{clipped_y}) -> pdf({pdf_x},{pdf_y}) size({clipped_width},{clipped_height})")
+
+    # All annotations are now text type
+    # Get font properties from annotation
+    font_family = annotation.get('fontFamily', 'Arial')
+    font_bold = annotation.get('fontBold', False)
+    font_italic = annotation.get('fontItalic', False)
+    font_strikethrough = annotation.get('fontStrikethrough', False)
+    font_size = float(annotation.get('fontSize', 12))
+    font_color = parse_color(annotation.get('fontColor', '#000000'))
+
+    # Map font family and style to reportlab font
+    reportlab_font = map_font_family(font_family, font_bold, font_italic)
+
+    # Set font and size with error handling
+    try:
+        can.setFont(reportlab_font, font_size)
+    except Exception as e:
+        print(f"Warning: Failed to set font '{reportlab_font}' for annotation, falling back to Helvetica. Error: {e}")
+        can.setFont('Helvetica', font_size)
+        reportlab_font = 'Helvetica'
+
+    # Get border properties from annotation
+    border_color = parse_color(annotation.get('borderColor', 'black'))
+    border_style = parse_border_style(annotation.get('borderStyle', 'solid'))
+    border_width = float(annotation.get('borderWidth', 1))
+
+    # Get background fill settings
+    should_fill_bg, fill_color = get_background_fill(annotation)
+
+    # Determine if border should be drawn
+    should_draw_border = border_style is not None
+
+    if should_draw_border:
+        # Apply border styling
+        can.setStrokeColor(border_color)
+        can.setLineWidth(border_width)
+        if border_style:
+            can.setDash(border_style)
+        else:
+            can.setDash([])  # solid line
+
+    # Set fill color if background should be filled
+    if should_fill_bg and fill_color:
+        can.setFillColor(fill_color)
+
+    # Draw rectangle with border and/or fill
+    can.rect(pdf_x, pdf_y, clipped_width, clipped_height, 
+            stroke=1 if should_draw_border else 0, 
+            fill=1 if should_fill_bg else 0)
+
+    # Draw text inside the box with font color (handle multiline)
+    can.setFillColor(font_color)
+    text_x = pdf_x + 2  # small padding
+
+    # Split text by newlines and draw each line
+    lines = value.split('\n')
+    line_height = font_size * 1.2  # Line spacing
+
+    # Calculate starting Y position (top of text block)
+    total_text_height = len(lines) * line_height
+    # Start from top and work down
+    start_y = pdf_y + clipped_height - line_height + (font_size / 3)
+
+    fonts = fallback_fonts(reportlab_font, font_bold, font_italic)
+
+    for i, line in enumerate(lines):
+        line_y = start_y - (i * line_height)
+        text_width = draw_text_runs(can, text_x, line_y, line, fonts, font_size)
+
+        # Draw strikethrough for this line if needed
+        if font_strikethrough:
+            strike_y = line_y + (font_size / 3)  # Position line through middle of text
+            can.setStrokeColor(font_color)
+            can.setLineWidth(1)  # Always use 1px line for strikethrough
+            can.setDash([])  # Reset to solid line (no dash pattern)
+            can.line(text_x, strike_y, text_x + text_width, strike_y)
+            can.setFillColor(font_color)  # Reset fill color for next line
+
+    return True
+
+def render_overlay_bytes(page_annotations, page_width, page_height):
+    """Render the annotations of one page into a single-page overlay PDF"""
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=(page_width, page_height))
+
+    for annotation in page_annotations:
+        draw_annotation(can, annotation, page_width, page_height)
+
+    can.save()
+    return packet.getvalue()
+
+def overlay_cache_key(page_annotations, page_width, page_height):
+    """
+    Cache key for a page's rendered overlay. The overlay only depends on the
+    page size (not the page content), the page's annotations and the fonts.
+    """
+    return hash_json([font_table()[2], round(page_width, 3), round(page_height, 3), page_annotations])
+
+def build_overlay_page(page_annotations, page_width, page_height, overlay_cache=None):
+    """
+    Render the annotations of one page into a single-page overlay PDF page.
+    With an overlay_cache, previously rendered overlays are reused.
+    """
+    if overlay_cache is None:
+        return PdfReader(BytesIO(render_overlay_bytes(page_annotations, page_width, page_height))).pages[0]
+
+    key = overlay_cache_key(page_annotations, page_width, page_height)
+    data = overlay_cache.get(key)
+    if data is not None:
+        try:
+            return PdfReader(BytesIO(data)).pages[0]
+        except Exception as e:
+            print(f"  Warning: discarding unreadable cached overlay {key[:12]}: {e}")
+            overlay_cache.discard(key)
+
+    data = render_overlay_bytes(page_annotations, page_width, page_height)
+    overlay_cache.put(key, data)
+    return PdfReader(BytesIO(data)).pages[0]
+
+def group_annotations_by_page(annotations):
+    """Bucket annotations by their 0-based page index"""
+    by_page = {}
+    for ann in annotations:
+        by_page.setdefault(ann.get('page', 0), []).append(ann)
+    return by_page
+
+def _add_stream(pdf_writer, data, extra=None):
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    if extra:
+        stream.update(extra)
+    return pdf_writer._add_object(stream)
+
+def make_overlay_form(pdf_writer, overlay_page):
+    """
+    Wrap a rendered overlay page as a Form XObject owned by pdf_writer.
+    The same form can be stamped onto any number of pages of that writer.
+    """
+    form = DecodedStreamObject()
+    form.set_data(overlay_page.get_contents().get_data())
+    form.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Form'),
+        NameObject('/BBox'): overlay_page.mediabox,
+        NameObject('/Resources'): overlay_page.raw_get('/Resources').clone(pdf_writer),
+    })
+    return pdf_writer._add_object(form.flate_encode())
+
+def stamp_overlay_form(pdf_writer, page, form_ref):
+    """
+    Draw an overlay form on top of a writer page without touching the
+    page's original content streams or resource dictionaries, which may
+    be shared with other copies of the same source page.
+    """
+    original_resources = page.get('/Resources')
+    original_resources = original_resources.get_object() if original_resources is not None else DictionaryObject()
+    resources = DictionaryObject(original_resources)
+
+    original_xobjects = resources.get('/XObject')
+    xobjects = DictionaryObject(original_xobjects.get_object()) if original_xobjects is not None else DictionaryObject()
+    name = OVERLAY_XOBJECT_NAME
+    while name in xobjects:
+        name += 'X'
+    xobjects[NameObject(name)] = form_ref
+    resources[NameObject('/XObject')] = xobjects
+
+    contents = page.get('/Contents')
+    if contents is None:
+        original_contents = []
+    elif isinstance(contents.get_object(), ArrayObject):
+        original_contents = list(contents.get_object())
+    else:
+        original_contents = [contents]
+
+    # Isolate the original graphics state so the overlay is drawn in default user space
+    new_contents = ArrayObject([_add_stream(pdf_writer, b'q\n')])
+    new_contents.extend(original_contents)
+    new_contents.append(_add_stream(pdf_writer, f'\nQ\nq {name} Do Q\n'.encode()))
+
+    page[NameObject('/Resources')] = resources
+    page[NameObject('/Contents')] = new_contents
+
+def add_annotated_page(pdf_writer, page, page_annotations=None, overlay_form=None, overlay_cache=None):
+    """
+    Append a copy of a source page to the writer and stamp its overlay.
+    The page dictionary is copied but its content streams and resources
+    stay shared, so adding the same source page many times is cheap.
+    Pass overlay_form to reuse an overlay already built for this writer.
+    """
+    new_page = pdf_writer.add_page(page)
+    if overlay_form is None and page_annotations:
+        page_width = float(page.mediabox.width)
+        page_height = float(page.mediabox.height)
+        overlay_page = build_overlay_page(page_annotations, page_width, page_height, overlay_cache)
+        overlay_form = make_overlay_form(pdf_writer, overlay_page)
+    if overlay_form is not None:
+        stamp_overlay_form(pdf_writer, new_page, overlay_form)
+    return new_page
+
+def render_pages(pdf_reader, annotations, page_numbers, pdf_writer=None, overlay_cache=None):
+    """
+    Overlay annotations on the given pages (0-based) of pdf_reader, in order.
+    Pages not listed are left out of the output. Returns the writer.
+    """
+    if pdf_writer is None:
+        pdf_writer = PdfWriter()
+
+    by_page = group_annotations_by_page(annotations)
+
+    for page_num in page_numbers:
+        page_annotations = by_page.get(page_num, [])
+        print(f"Page {page_num + 1} has {len(page_annotations)} annotations")
+        add_annotated_page(pdf_writer, pdf_reader.pages[page_num], page_annotations, overlay_cache=overlay_cache)
+
+    return pdf_writer
+
+def render_annotated_pdf(pdf_reader, annotations, pdf_writer=None, overlay_cache=None):
+    """
+    Overlay annotations on every page of pdf_reader.
+    Appends to pdf_writer when given (used to concatenate documents),
+    otherwise creates a new writer. Returns the writer.
+    """
+    return render_pages(pdf_reader, annotations, range(len(pdf_reader.pages)), pdf_writer, overlay_cache)
+
+def generate_annotated_pdf(pdf_reader, annotations, optimize=False, overlay_cache=None, image_options=None):
+    """
+    Overlay annotations on every page of pdf_reader and write the result.
+    With image_options (see image_optimize.normalize_image_options) the page
+    images are downsampled first; with optimize, the output also goes through
+    optimize_pdf. Returns (BytesIO positioned at 0, stats) where stats has
+    the 'images' and 'optimize' reports, None for steps that didn't run.
+    """
+    pdf_writer = render_annotated_pdf(pdf_reader, annotations, overlay_cache=overlay_cache)
+
+    image_stats = None
+    if image_options:
+        from image_optimize import downsample_images
+
+        image_stats = downsample_images(pdf_writer, **image_options)
+        print(f"Images: {image_stats['replaced']} of {image_stats['images']} re-encoded, "
+              f"{image_stats['bytes_before']} -> {image_stats['bytes_after']} bytes")
+
+    output = BytesIO()
+    pdf_writer.write(output)
+    output.seek(0)
+    del pdf_writer
+
+    print(f"Generated PDF size: {output.getbuffer().nbytes} bytes")
+
+    optimize_stats = None
+    if optimize:
+        from pdf_optimize import optimize_pdf
+
+        optimized_pdf, optimize_stats = optimize_pdf(output.getvalue())
+        output = BytesIO(optimized_pdf)
+        del optimized_pdf
+        print(f"Optimized PDF: {optimize_stats['size_before']} -> {optimize_stats['size_after']} bytes "
+              f"({optimize_stats['merged_objects']} objects merged, "
+              f"{optimize_stats['compressed_streams']} streams compressed, "
+              f"{optimize_stats['pruned_resources']} unused resources dropped)")
+
+    return output, {'images': image_stats, 'optimize': optimize_stats}
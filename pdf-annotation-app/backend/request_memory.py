@@ -0,0 +1,196 @@
+"""
+Low-copy request decoding and per-request memory budgets.
+
+A render request used to hold the same document several times at once:
+the raw request body, the parsed JSON string, the decoded bytes, a copy
+in BytesIO and another copy for logging the output size. The helpers
+here keep at most two copies alive at any one time:
+
+- the request body is not cached on the request; a JSON body is decoded
+  to text and the bytes are dropped before the text is parsed, so the
+  peak while parsing is two body-sized objects rather than three
+- the base64 string is dropped as soon as it has been decoded
+- BytesIO over a bytes object shares its buffer (CPython only copies on write)
+- output sizes are read from the buffer, and finished outputs are cached
+  from getvalue(), which shares the buffer of a BytesIO nothing else exports
+
+MemoryBudget estimates what a request will need from its Content-Length,
+plus the size of any stored document it refers to instead of sending it,
+and rejects it before any work is done if it would not fit.
+
+Bodies can also be sent as msgpack (Content-Type application/x-msgpack),
+with annotations in the columnar form of annotation_codec and binary
+fields as raw bytes instead of base64; load_request_body() decodes either
+form to the same dict, so views don't need to know which one was sent.
+"""
+import binascii
+import json
+import os
+import threading
+from contextlib import contextmanager
+from functools import partial, wraps
+
+from flask import Response, jsonify, request
+
+from annotation_codec import MSGPACK_MIMETYPE, MSGPACK_MIMETYPES, decode_annotations, is_columnar, pack, unpack
+
+MB = 1024 * 1024
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a request would not fit in the memory budget"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class MemoryBudget:
+    """
+    Tracks the estimated memory of in-flight requests.
+    A request larger than per_request_bytes can never run (413); one that
+    would push the in-flight total over total_bytes is rejected for now (503).
+    """
+
+    def __init__(self, per_request_bytes, total_bytes, memory_factor):
+        self.per_request_bytes = per_request_bytes
+        self.total_bytes = total_bytes
+        self.memory_factor = memory_factor
+        self.in_flight_bytes = 0
+        self.peak_in_flight_bytes = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            per_request_bytes=int(float(os.environ.get('REQUEST_MEMORY_BUDGET_MB', 512)) * MB),
+            total_bytes=int(float(os.environ.get('TOTAL_MEMORY_BUDGET_MB', 2048)) * MB),
+            memory_factor=float(os.environ.get('RENDER_MEMORY_FACTOR', 4)),
+        )
+
+    def estimate(self, content_length, stored_bytes=0):
+        """Estimated peak memory of a request with the given body size that loads a stored document of stored_bytes"""
+        return int(((content_length or 0) + (stored_bytes or 0)) * self.memory_factor)
+
+    @contextmanager
+    def reserve(self, nbytes):
+        with self._lock:
+            if nbytes > self.per_request_bytes:
+                self.rejected += 1
+                raise MemoryBudgetExceeded(
+                    f'Request needs about {nbytes / MB:.1f} MB, the limit is {self.per_request_bytes / MB:.1f} MB', 413)
+            if self.in_flight_bytes + nbytes > self.total_bytes:
+                self.rejected += 1
+                raise MemoryBudgetExceeded('Server is busy, please retry shortly', 503)
+            self.in_flight_bytes += nbytes
+            self.peak_in_flight_bytes = max(self.peak_in_flight_bytes, self.in_flight_bytes)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight_bytes -= nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight_bytes': self.in_flight_bytes,
+                'peak_in_flight_bytes': self.peak_in_flight_bytes,
+                'per_request_bytes': self.per_request_bytes,
+                'total_bytes': self.total_bytes,
+                'rejected': self.rejected,
+            }
+
+    def limit(self, view=None, stored_bytes=None):
+        """
+        Route decorator: reserve the request's estimated memory before running it.
+        stored_bytes is a callable returning the size of the stored document a
+        request loads (by project_id or document_hash), which its body doesn't carry.
+        """
+        if view is None:
+            return partial(self.limit, stored_bytes=stored_bytes)
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            document_bytes = 0
+            if stored_bytes:
+                try:
+                    document_bytes = stored_bytes()
+                except Exception as e:
+                    # The view reports a bad request itself
+                    print(f"  Warning: No stored document size for {request.path}: {e}")
+            try:
+                with self.reserve(self.estimate(request.content_length, document_bytes)):
+                    return view(*args, **kwargs)
+            except MemoryBudgetExceeded as e:
+                print(f"Rejected {request.path}: {e}")
+                response = jsonify({'error': str(e)})
+                if e.status_code == 503:
+                    response.headers['Retry-After'] = '5'
+                return response, e.status_code
+        return wrapper
+
+
+def is_msgpack_request():
+    return request.mimetype in MSGPACK_MIMETYPES
+
+def wants_msgpack():
+    """True if the Accept header prefers msgpack to JSON (JSON wins ties and */*)"""
+    return request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES) in MSGPACK_MIMETYPES
+
+def load_request_body():
+    """
+    Parse the JSON or msgpack request body without keeping the raw bytes cached
+    on the request, so only the parsed form stays alive. Columnar annotations
+    are decoded to a list. Returns None for an empty body; raises ValueError
+    for a body that can't be parsed or decoded.
+    """
+    body = request.get_data(cache=False)
+    if not body:
+        return None
+    if is_msgpack_request():
+        data = unpack(body)
+        del body
+    else:
+        # json.loads() would decode the bytes to text itself while they are still referenced here
+        text = body.decode(json.detect_encoding(body), 'surrogatepass')
+        del body
+        data = json.loads(text)
+        del text
+    if isinstance(data, dict) and is_columnar(data.get('annotations')):
+        data['annotations'] = decode_annotations(data['annotations'])
+    return data
+
+def peek_request_body():
+    """
+    Parse a small JSON or msgpack body for a look before the view runs; the raw
+    bytes stay cached on the request for the view. Annotations are left as sent.
+    """
+    try:
+        if request.is_json:
+            return request.get_json(silent=True)
+        if is_msgpack_request():
+            return unpack(request.get_data())
+    except Exception:
+        pass
+    return None
+
+def msgpack_response(payload, status=200):
+    return Response(pack(payload), status=status, mimetype=MSGPACK_MIMETYPE)
+
+def take_base64_payload(data, key):
+    """
+    Remove a base64 field from a parsed request and decode it.
+    Popping the field lets the (larger) base64 string be freed right after decoding.
+    msgpack bodies carry the field as raw bytes, which are returned as they are.
+    """
+    encoded = data.pop(key, None)
+    if not encoded:
+        return None
+    if isinstance(encoded, bytes):
+        return encoded
+    return binascii.a2b_base64(encoded)
+
+def buffer_size(stream):
+    """Size of a BytesIO's contents without copying them"""
+    return stream.getbuffer().nbytes
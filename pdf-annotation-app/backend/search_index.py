@@ -0,0 +1,302 @@
+"""
+Full-text search over all projects.
+
+Annotation values and the text of every PDF page are kept in a SQLite
+FTS5 index next to the project store, so finding the project that
+mentions a name or reference number is a single indexed query instead
+of unpickling every project.
+
+The index is incremental: saving a project replaces only that project's
+annotation rows, and page text is extracted once per distinct PDF
+(keyed by its SHA-256, like the blob store) and reused by every project
+that shares the document. Indexing runs on a background thread so
+save-project does not wait for text extraction; searches read through
+their own connections and are not blocked by the writer (WAL mode).
+"""
+import os
+import queue
+import re
+import sqlite3
+import threading
+from io import BytesIO
+
+from pypdf import PdfReader
+
+SEARCH_DIR_NAME = '.search'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    project_id TEXT PRIMARY KEY,
+    pdf_sha256 TEXT,
+    pdf_filename TEXT,
+    revision TEXT
+);
+CREATE INDEX IF NOT EXISTS projects_pdf ON projects(pdf_sha256);
+
+-- One row per searchable text: an annotation value (project_id set) or a
+-- page of a PDF (pdf_sha256 set, shared by every project using that PDF)
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    project_id TEXT,
+    pdf_sha256 TEXT,
+    page INTEGER,
+    kind TEXT,
+    annotation_id TEXT,
+    x REAL, y REAL, width REAL, height REAL,
+    content TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_project ON entries(project_id);
+CREATE INDEX IF NOT EXISTS entries_pdf ON entries(pdf_sha256);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    content, content='entries', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts(rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+
+# Annotation hits on a project and page hits on the PDF it uses, as one result set
+SEARCH_SQL = """
+SELECT p.project_id, p.pdf_filename, e.page, e.kind, e.annotation_id,
+       e.x, e.y, e.width, e.height,
+       snippet(entries_fts, 0, '[', ']', '...', 12) AS snippet,
+       bm25(entries_fts) AS rank
+FROM entries_fts
+JOIN entries e ON e.id = entries_fts.rowid
+JOIN projects p ON p.project_id = e.project_id OR p.pdf_sha256 = e.pdf_sha256
+WHERE entries_fts MATCH ? {project_filter}
+ORDER BY rank
+LIMIT ? OFFSET ?
+"""
+
+COUNT_SQL = """
+SELECT count(*)
+FROM entries_fts
+JOIN entries e ON e.id = entries_fts.rowid
+JOIN projects p ON p.project_id = e.project_id OR p.pdf_sha256 = e.pdf_sha256
+WHERE entries_fts MATCH ? {project_filter}
+"""
+
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def build_match_query(text, prefix=False):
+    """
+    Turn free text into an FTS5 query matching all of its words.
+    Words are quoted, so user input can't produce FTS syntax errors.
+    With prefix=True the last word also matches longer words ("inv" -> "invoice").
+    """
+    terms = TERM_PATTERN.findall(text)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    if prefix:
+        quoted[-1] += '*'
+    return ' '.join(quoted)
+
+def extract_page_texts(pdf_bytes):
+    """Yield (page_number, text) for every page with extractable text"""
+    reader = PdfReader(BytesIO(pdf_bytes))
+    for page_num, page in enumerate(reader.pages):
+        try:
+            text = page.extract_text()
+        except Exception as e:
+            print(f"  Warning: could not extract text from page {page_num + 1}: {e}")
+            continue
+        if text and text.strip():
+            yield page_num, text
+
+
+class SearchIndex:
+    """SQLite FTS5 index of annotation values and page text across projects"""
+
+    def __init__(self, path, project_store=None):
+        self.path = path
+        self.project_store = project_store
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _connection(self):
+        """One connection per thread"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+        return connection
+
+    def revision(self, project_id):
+        row = self._connection().execute(
+            'SELECT revision FROM projects WHERE project_id = ?', (project_id,)).fetchone()
+        return row[0] if row else None
+
+    def index_project(self, project, pdf_loader=None, revision=None):
+        """
+        Replace a project's entries in the index. Page text is only extracted
+        (via pdf_loader()) if no other project already indexed the same PDF.
+        """
+        connection = self._connection()
+        digest = getattr(project, 'pdf_sha256', None)
+
+        needs_text = False
+        if digest and pdf_loader is not None:
+            needs_text = connection.execute(
+                'SELECT 1 FROM entries WHERE pdf_sha256 = ? LIMIT 1', (digest,)).fetchone() is None
+        page_texts = list(extract_page_texts(pdf_loader())) if needs_text else []
+
+        with connection:
+            previous = connection.execute(
+                'SELECT pdf_sha256 FROM projects WHERE project_id = ?', (project.project_id,)).fetchone()
+            connection.execute('DELETE FROM entries WHERE project_id = ?', (project.project_id,))
+            connection.execute(
+                'INSERT OR REPLACE INTO projects (project_id, pdf_sha256, pdf_filename, revision) VALUES (?, ?, ?, ?)',
+                (project.project_id, digest, project.pdf_filename, str(revision) if revision is not None else None))
+
+            connection.executemany(
+                'INSERT INTO entries (project_id, page, kind, annotation_id, x, y, width, height, content) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(project.project_id, ann.get('page', 0), 'annotation', ann.get('id'),
+                  ann.get('x'), ann.get('y'), ann.get('width'), ann.get('height'), str(ann['value']))
+                 for ann in project.annotations if str(ann.get('value', '')).strip()])
+
+            if page_texts:
+                connection.executemany(
+                    'INSERT INTO entries (pdf_sha256, page, kind, content) VALUES (?, ?, ?, ?)',
+                    [(digest, page_num, 'page', text) for page_num, text in page_texts])
+
+            if previous and previous[0] and previous[0] != digest:
+                self._drop_unused_pdf(connection, previous[0])
+
+    def remove_project(self, project_id):
+        connection = self._connection()
+        with connection:
+            previous = connection.execute(
+                'SELECT pdf_sha256 FROM projects WHERE project_id = ?', (project_id,)).fetchone()
+            connection.execute('DELETE FROM entries WHERE project_id = ?', (project_id,))
+            connection.execute('DELETE FROM projects WHERE project_id = ?', (project_id,))
+            if previous and previous[0]:
+                self._drop_unused_pdf(connection, previous[0])
+
+    @staticmethod
+    def _drop_unused_pdf(connection, digest):
+        """Remove a PDF's page text once no project uses it any more"""
+        in_use = connection.execute('SELECT 1 FROM projects WHERE pdf_sha256 = ? LIMIT 1', (digest,)).fetchone()
+        if not in_use:
+            connection.execute('DELETE FROM entries WHERE pdf_sha256 = ?', (digest,))
+
+    def search(self, text, limit=20, offset=0, project_id=None, prefix=False):
+        """
+        Ranked hits for free text. Returns {'total': n, 'results': [...]},
+        each result naming the project, page and (for annotations) the box.
+        """
+        match = build_match_query(text, prefix)
+        if match is None:
+            return {'total': 0, 'results': []}
+
+        params = [match]
+        project_filter = ''
+        if project_id:
+            project_filter = 'AND p.project_id = ?'
+            params.append(project_id)
+
+        connection = self._connection()
+        total = connection.execute(COUNT_SQL.format(project_filter=project_filter), params).fetchone()[0]
+        rows = connection.execute(SEARCH_SQL.format(project_filter=project_filter), params + [limit, offset]).fetchall()
+
+        results = []
+        for (hit_project, filename, page, kind, annotation_id, x, y, width, height, snippet, rank) in rows:
+            result = {
+                'project_id': hit_project,
+                'pdf_filename': filename,
+                'page': page,
+                'kind': kind,
+                'snippet': snippet,
+                'score': -rank,
+            }
+            if kind == 'annotation':
+                result['annotation_id'] = annotation_id
+                result['box'] = {'x': x, 'y': y, 'width': width, 'height': height}
+            results.append(result)
+        return {'total': total, 'results': results}
+
+    def stats(self):
+        connection = self._connection()
+        return {
+            'projects': connection.execute('SELECT count(*) FROM projects').fetchone()[0],
+            'entries': connection.execute('SELECT count(*) FROM entries').fetchone()[0],
+            'pending': self._queue.qsize(),
+        }
+
+    def _index_from_store(self, project_id, force=False):
+        """Index a project as currently saved in the project store"""
+        revision = self.project_store.revision(project_id)
+        if revision is None:
+            self.remove_project(project_id)
+            return False
+        if not force and self.revision(project_id) == str(revision):
+            return False
+        project = self.project_store.load(project_id)
+        if project is None:
+            self.remove_project(project_id)
+            return False
+        # Projects from before the blob store get their PDF moved there, so page text can be shared
+        project = self.project_store.migrate_pdf(project)
+        self.index_project(project, lambda: self.project_store.load_pdf(project), revision)
+        return True
+
+    def submit(self, project_id):
+        """Queue a saved project for (re)indexing on the background thread"""
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='search-indexer', daemon=True)
+                self._worker.start()
+        self._queue.put(project_id)
+
+    def _run(self):
+        while True:
+            project_id = self._queue.get()
+            try:
+                self._index_from_store(project_id, force=True)
+            except Exception as e:
+                print(f"ERROR indexing project {project_id} for search: {e}")
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        """Block until every queued project has been indexed"""
+        self._queue.join()
+
+    def reindex_all(self, force=False):
+        """Bring the index up to date with the project store. Returns (indexed, removed)."""
+        indexed = 0
+        seen = set()
+        for _, project in self.project_store.iter_projects():
+            seen.add(project.project_id)
+            if self._index_from_store(project.project_id, force=force):
+                indexed += 1
+
+        stale = [row[0] for row in self._connection().execute('SELECT project_id FROM projects')
+                 if row[0] not in seen]
+        for project_id in stale:
+            self.remove_project(project_id)
+        return indexed, len(stale)
+
+
+def open_search_index(projects_folder, project_store):
+    """Open (creating if needed) the search index stored with a project store"""
+    path = os.environ.get('SEARCH_INDEX_PATH') or os.path.join(projects_folder, SEARCH_DIR_NAME, 'index.sqlite3')
+    return SearchIndex(path, project_store)
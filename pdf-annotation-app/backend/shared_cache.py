@@ -0,0 +1,359 @@
+"""
+Node-wide cache of source documents shared by all worker processes.
+
+DocumentCache is per process: with several workers, each one decodes,
+stores and parses its own copy of a popular document. The shared cache
+keeps one copy per machine, as files in a directory (ideally on tmpfs,
+e.g. /dev/shm), keyed by the document's SHA-256:
+
+    <digest>.pdf   the document bytes
+    <digest>.json  page count, page sizes and the object number of every
+                   page, computed once by the worker that added it
+
+Workers open a document by memory-mapping its file, so all of them read
+the same pages of the OS page cache instead of holding private copies.
+The stored page object numbers let a worker load just the pages it uses:
+pypdf would otherwise walk and parse the whole page tree (about 0.3 s
+for 2000 pages) before the first page can be read. The xref is still
+read by pypdf, which only takes a few milliseconds.
+
+Entries are written to temp files and renamed into place, metadata last,
+so a document is visible only once it is complete. Adding and evicting
+take an exclusive file lock in the directory; lookups take no lock.
+Least recently used entries (by metadata mtime, refreshed on use) are
+evicted when the directory is over its entry or byte budget. A mapped
+document stays readable after eviction, because the mapping outlives
+the unlinked file.
+"""
+import json
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from pypdf import PdfReader
+from pypdf.generic import IndirectObject
+from pypdf._page import PageObject
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+MB = 1024 * 1024
+
+SHARED_CACHE_VERSION = 1
+LOCK_FILE_NAME = '.lock'
+TEMP_PREFIX = '.tmp-'
+
+# A hit refreshes the entry's LRU position at most this often
+TOUCH_INTERVAL_SECONDS = 30
+
+INHERITABLE_PAGE_ATTRIBUTES = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+
+@contextmanager
+def _file_lock(path):
+    with open(path, 'a+b') as lock_file:
+        if sys.platform == 'win32':
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if sys.platform == 'win32':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def _write_atomic(directory, path, data):
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def page_metadata(reader):
+    """
+    Page count, sizes ([width, height, rotation]) and object numbers of a
+    parsed document. Each of 'pages' is [object number, generation,
+    {attribute: object number of the ancestor it inherits it from}]; it is
+    None when some page can't be addressed that way (direct objects in the
+    page tree, encrypted documents), and such documents are opened the
+    usual way.
+    """
+    pages = []
+    addressable = not reader.is_encrypted
+
+    visited = set()
+
+    def walk(node_ref, inherited):
+        nonlocal addressable
+        if node_ref.idnum in visited:
+            addressable = False
+            return
+        visited.add(node_ref.idnum)
+        node = node_ref.get_object()
+        kids = node.get('/Kids')
+        # Same rule as pypdf: a node without /Type is a page unless it has /Kids
+        node_type = node.get('/Type', '/Pages' if kids is not None else '/Page')
+        if node_type == '/Pages':
+            inherited = dict(inherited)
+            for attribute in INHERITABLE_PAGE_ATTRIBUTES:
+                if attribute in node:
+                    inherited[attribute] = node_ref.idnum
+            for kid in kids.get_object() if kids is not None else []:
+                if isinstance(kid, IndirectObject):
+                    walk(kid, inherited)
+                else:
+                    addressable = False
+            return
+        pages.append([node_ref.idnum, node_ref.generation,
+                      {attribute: source for attribute, source in inherited.items() if attribute not in node}])
+
+    if addressable:
+        root_pages = reader.trailer['/Root'].get_object().raw_get('/Pages')
+        if isinstance(root_pages, IndirectObject):
+            walk(root_pages, {})
+        else:
+            addressable = False
+
+    page_count = len(reader.pages)
+    if len(pages) != page_count:
+        addressable = False
+    sizes = []
+    for page in reader.pages:
+        box = page.mediabox
+        sizes.append([float(box.width), float(box.height), int(page.get('/Rotate', 0) or 0)])
+
+    return {
+        'version': SHARED_CACHE_VERSION,
+        'page_count': page_count,
+        'page_sizes': sizes,
+        'pages': pages if addressable else None,
+    }
+
+
+class LazyPageList(list):
+    """
+    Stands in for PdfReader.flattened_pages: pages are built from their
+    stored object numbers the first time they are read.
+    """
+
+    def __init__(self, reader, pages):
+        super().__init__([None] * len(pages))
+        self._reader = reader
+        self._pages = pages
+
+    def _build(self, index):
+        idnum, generation, inherited = self._pages[index]
+        reference = IndirectObject(idnum, generation, self._reader)
+        page_dict = reference.get_object()
+        for attribute, source in inherited.items():
+            if attribute not in page_dict:
+                page_dict[attribute] = self._reader.get_object(source)[attribute]
+        page = PageObject(self._reader, reference)
+        page.update(page_dict)
+        return page
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        page = list.__getitem__(self, index)
+        if page is None:
+            page = self._build(index)
+            list.__setitem__(self, index, page)
+        return page
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class SharedDocument:
+    """A memory-mapped document from the shared cache and its metadata"""
+
+    def __init__(self, digest, path, metadata):
+        self.digest = digest
+        self.metadata = metadata
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.buffer)
+        self.page_count = metadata['page_count']
+
+    def open_reader(self):
+        """PdfReader over the mapping; with stored page numbers, pages are loaded on first use"""
+        reader = PdfReader(_MappedStream(self.buffer))
+        if self.metadata.get('pages') is not None:
+            reader.flattened_pages = LazyPageList(reader, self.metadata['pages'])
+        return reader
+
+
+class _MappedStream:
+    """Read-only file interface over a mapping, with its own position (one per reader)"""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._position = 0
+
+    def read(self, size=-1):
+        end = len(self._buffer) if size is None or size < 0 else min(self._position + size, len(self._buffer))
+        data = self._buffer[self._position:end]
+        self._position = end
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += len(self._buffer)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+class SharedDocumentCache:
+    """Documents and their page metadata in a directory shared by all workers on the machine"""
+
+    def __init__(self, directory, max_bytes=1024 * MB, max_entries=256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+        self.evicted = 0
+        self._stats_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._lock_path = os.path.join(directory, LOCK_FILE_NAME)
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Shared cache in SHARED_DOCUMENT_CACHE_DIR (e.g. /dev/shm/pdf-documents), bounded by
+        SHARED_DOCUMENT_CACHE_MB and SHARED_DOCUMENT_CACHE_ENTRIES. None when the directory isn't set.
+        """
+        directory = os.environ.get('SHARED_DOCUMENT_CACHE_DIR')
+        if not directory:
+            return None
+        return cls(
+            directory,
+            max_bytes=int(float(os.environ.get('SHARED_DOCUMENT_CACHE_MB', 1024)) * MB),
+            max_entries=int(os.environ.get('SHARED_DOCUMENT_CACHE_ENTRIES', 256)),
+        )
+
+    def _paths(self, digest):
+        return os.path.join(self.directory, f'{digest}.pdf'), os.path.join(self.directory, f'{digest}.json')
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, digest):
+        """The mapped document for digest, or None"""
+        pdf_path, meta_path = self._paths(digest)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                metadata = json.load(f)
+            if metadata.get('version') != SHARED_CACHE_VERSION or metadata.get('size') != os.path.getsize(pdf_path):
+                raise ValueError('stale entry')
+            document = SharedDocument(digest, pdf_path, metadata)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"  Warning: Ignoring shared cache entry {digest[:12]}: {e}")
+            self._count('misses')
+            return None
+
+        try:
+            if time.time() - os.path.getmtime(meta_path) > TOUCH_INTERVAL_SECONDS:
+                os.utime(meta_path)
+        except OSError:
+            pass  # Evicted meanwhile; the mapping stays valid
+        self._count('hits')
+        return document
+
+    def put(self, digest, pdf_bytes, reader=None):
+        """
+        Add a document (unless another worker already has) and return it mapped.
+        reader, if given, is a parsed reader of pdf_bytes used for the metadata.
+        """
+        document = self.get(digest)
+        if document is not None:
+            return document
+
+        metadata = page_metadata(reader or PdfReader(BytesIO(pdf_bytes)))
+        metadata['size'] = len(pdf_bytes)
+        pdf_path, meta_path = self._paths(digest)
+        with _file_lock(self._lock_path):
+            if not os.path.exists(meta_path):
+                _write_atomic(self.directory, pdf_path, pdf_bytes)
+                _write_atomic(self.directory, meta_path, json.dumps(metadata).encode('utf-8'))
+                self._count('added')
+                self._evict(keep=digest)
+        return SharedDocument(digest, pdf_path, metadata)
+
+    def _entries(self):
+        """(mtime, digest, size) of every complete entry"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name.startswith('.'):
+                continue
+            digest = name[:-len('.json')]
+            pdf_path, meta_path = self._paths(digest)
+            try:
+                entries.append((os.path.getmtime(meta_path), digest, os.path.getsize(pdf_path)))
+            except OSError:
+                continue
+        return entries
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until within budget. Called with the lock held."""
+        entries = sorted(self._entries())
+        total_bytes = sum(size for _, _, size in entries)
+        count = len(entries)
+        for _, digest, size in entries:
+            if count <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            pdf_path, meta_path = self._paths(digest)
+            try:
+                # Metadata first, so no reader finds a half-removed entry
+                os.remove(meta_path)
+                os.remove(pdf_path)
+            except OSError as e:
+                # Windows can't remove a file another process has mapped
+                print(f"  Warning: Could not evict shared cache entry {digest[:12]}: {e}")
+                continue
+            count -= 1
+            total_bytes -= size
+            self._count('evicted')
+
+    def stats(self):
+        entries = self._entries()
+        with self._stats_lock:
+            return {
+                'directory': self.directory,
+                'entries': len(entries),
+                'bytes': sum(size for _, _, size in entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'added': self.added,
+                'evicted': self.evicted,
+            }
@@ -0,0 +1,54 @@
+"""
+Shared fixtures for the backend tests. Run from the backend directory:
+
+    python -m pytest tests
+
+The server module keeps its stores in module globals, so the storage
+folders are pointed at a temporary directory before anything imports it.
+"""
+import os
+import sys
+import tempfile
+from io import BytesIO
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+_storage_root = tempfile.mkdtemp(prefix='pdf-annotation-tests-')
+os.environ.setdefault('PROJECTS_FOLDER', os.path.join(_storage_root, 'projects'))
+os.environ.setdefault('RENDER_CACHE_FOLDER', os.path.join(_storage_root, 'cache'))
+
+
+def make_pdf(pages=1):
+    """A small PDF with one line of text per page"""
+    from reportlab.pdfgen import canvas
+
+    buffer = BytesIO()
+    pdf_canvas = canvas.Canvas(buffer)
+    for page_num in range(pages):
+        pdf_canvas.drawString(72, 720, f'Page {page_num + 1}')
+        pdf_canvas.showPage()
+    pdf_canvas.save()
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def pdf_bytes():
+    return make_pdf()
+
+@pytest.fixture
+def store(tmp_path):
+    from project_store import open_project_store
+    return open_project_store(str(tmp_path / 'projects'))
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app
+    app.app.config['TESTING'] = True
+    return app
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
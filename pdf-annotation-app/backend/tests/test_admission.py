@@ -0,0 +1,145 @@
+import base64
+import threading
+
+from flask import Flask
+
+from admission import AdmissionController
+from request_memory import MB, MemoryBudget
+
+
+def make_app(admission=None, memory_budget=None, cost=None, **limits):
+    """A one-route app whose view blocks until release is set"""
+    app = Flask(__name__)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def view():
+        entered.set()
+        release.wait(5)
+        return 'done'
+
+    if memory_budget is not None:
+        view = memory_budget.limit(view)
+    if admission is not None:
+        view = admission.limit('render', cost=cost, **limits)(view)
+    app.add_url_rule('/render', 'render', view, methods=['POST'])
+    return app, entered, release
+
+def start_request(app, **kwargs):
+    """Send a request from a background thread; returns the thread and a list that receives the response"""
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(app.test_client().post('/render', **kwargs)))
+    thread.start()
+    return thread, responses
+
+def controller(**overrides):
+    settings = dict(max_concurrent=1, max_cost=100, max_queue=0, queue_timeout=5)
+    settings.update(overrides)
+    return AdmissionController(**settings)
+
+
+def test_full_queue_is_rejected_with_429():
+    admission = controller()
+    app, entered, release = make_app(admission)
+    thread, responses = start_request(app)
+    assert entered.wait(5)
+
+    response = app.test_client().post('/render')
+    release.set()
+    thread.join()
+
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert responses[0].status_code == 200
+    assert admission.gates['render'].stats()['rejected_queue_full'] == 1
+
+def test_queue_timeout_is_rejected_with_429():
+    admission = controller(max_queue=1, queue_timeout=0.05)
+    app, entered, release = make_app(admission)
+    thread, _ = start_request(app)
+    assert entered.wait(5)
+
+    response = app.test_client().post('/render')
+    release.set()
+    thread.join()
+
+    assert response.status_code == 429
+    assert 'Timed out' in response.get_json()['error']
+    assert admission.gates['render'].stats()['rejected_timeout'] == 1
+
+def test_queued_request_runs_when_a_slot_frees():
+    admission = controller(max_queue=1)
+    app, entered, release = make_app(admission)
+    first, first_responses = start_request(app)
+    assert entered.wait(5)
+    second, second_responses = start_request(app)
+
+    release.set()
+    first.join()
+    second.join()
+
+    assert first_responses[0].status_code == second_responses[0].status_code == 200
+    assert admission.gates['render'].stats()['admitted'] == 2
+
+def test_requests_over_the_cost_limit_wait():
+    admission = controller(max_concurrent=4, max_cost=10, queue_timeout=0.05, max_queue=1)
+    app, entered, release = make_app(admission, cost=lambda: 6)
+    thread, _ = start_request(app)
+    assert entered.wait(5)
+
+    # A second request of cost 6 doesn't fit next to the first
+    response = app.test_client().post('/render')
+    release.set()
+    thread.join()
+    assert response.status_code == 429
+
+def test_failing_cost_estimate_counts_as_one():
+    def broken_cost():
+        raise ValueError('unreadable body')
+    app, _, release = make_app(controller(), cost=broken_cost)
+    release.set()
+    assert app.test_client().post('/render').status_code == 200
+
+
+def test_request_over_the_per_request_budget_is_rejected_with_413():
+    budget = MemoryBudget(per_request_bytes=1 * MB, total_bytes=8 * MB, memory_factor=4)
+    app, _, release = make_app(memory_budget=budget)
+    release.set()
+
+    response = app.test_client().post('/render', data=b'x' * MB)
+    assert response.status_code == 413
+    assert budget.stats()['rejected'] == 1
+
+def test_request_over_the_total_budget_is_rejected_with_503():
+    budget = MemoryBudget(per_request_bytes=4 * MB, total_bytes=3 * MB, memory_factor=4)
+    app, entered, release = make_app(memory_budget=budget)
+    thread, responses = start_request(app, data=b'x' * (MB // 2))
+    assert entered.wait(5)
+
+    response = app.test_client().post('/render', data=b'x' * (MB // 2))
+    release.set()
+    thread.join()
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+    assert responses[0].status_code == 200
+    assert budget.stats()['in_flight_bytes'] == 0
+
+
+def test_render_cost_is_estimated_without_loading_the_project(client, app_module, pdf_bytes, monkeypatch):
+    saved = client.post('/api/save-project', json={'pdf_data': base64.b64encode(pdf_bytes).decode(),
+                                                   'annotations': [{'id': 'a', 'page': 0}]})
+    project_id = saved.get_json()['project_id']
+
+    def no_load(*args, **kwargs):
+        raise AssertionError('project loaded before admission')
+    monkeypatch.setattr(app_module.autosave, 'load', no_load)
+    monkeypatch.setattr(app_module.project_store, 'load', no_load)
+
+    for body in ({'project_id': project_id}, {'project_id': '../escape'}, {'project_id': 'missing'}):
+        with app_module.app.test_request_context('/api/preview-pdf', method='POST', json=body):
+            assert app_module.estimate_render_cost() >= 1
+            assert app_module.stored_document_bytes() >= 0
+
+    with app_module.app.test_request_context('/api/preview-pdf', method='POST', json={'project_id': project_id}):
+        assert app_module.stored_document_bytes() == app_module.project_store.revision(project_id)[1]
@@ -0,0 +1,85 @@
+import copy
+
+import pytest
+
+from annotation_codec import (MAX_ANNOTATIONS, count_annotations, decode_annotations, encode_annotations, pack,
+                              unpack)
+
+ANNOTATIONS = [
+    {'id': 'a', 'x': 10, 'y': 20.5, 'page': 0, 'fontFamily': 'Arial', 'tags': ['one']},
+    {'id': 'b', 'x': 30, 'y': 40.0, 'page': 1, 'fontFamily': 'Arial'},
+    {'id': 'c', 'x': 2 ** 40, 'y': 1.0, 'page': 1, 'fontFamily': 'Courier', 'bold': True},
+]
+
+
+def corrupt(mutate):
+    message = copy.deepcopy(encode_annotations(ANNOTATIONS))
+    mutate(message)
+    return message
+
+
+def test_round_trip():
+    message = encode_annotations(ANNOTATIONS)
+    assert message['columns']['page']['type'] == 'i32'
+    assert message['columns']['y']['type'] == 'f64'
+    assert message['columns']['fontFamily']['type'] == 'dict'
+    assert decode_annotations(unpack(pack(message))) == ANNOTATIONS
+
+def test_empty_annotations_round_trip():
+    assert decode_annotations(encode_annotations([])) == []
+    assert decode_annotations(encode_annotations([{}, {}])) == [{}, {}]
+
+def test_plain_list_passes_through():
+    assert decode_annotations(ANNOTATIONS) is ANNOTATIONS
+
+def test_count_annotations():
+    assert count_annotations(ANNOTATIONS) == 3
+    assert count_annotations(encode_annotations(ANNOTATIONS)) == 3
+    assert count_annotations({'format': 'columnar', 'count': 'many'}) == 0
+    assert count_annotations(None) == 0
+
+@pytest.mark.parametrize('mutate', [
+    lambda m: m.pop('count'),
+    lambda m: m.update(count='3'),
+    lambda m: m.update(count=-1),
+    lambda m: m.update(keys=[], count=MAX_ANNOTATIONS + 1),
+    lambda m: m.update(keys='id'),
+    lambda m: m.update(keys=['id', 'id']),
+    lambda m: m['columns'].pop('x'),
+    lambda m: m.update(columns=[]),
+    lambda m: m['columns'].update(x=3),
+    lambda m: m['columns']['x'].update(type='i64'),
+    lambda m: m['columns']['x'].pop('data'),
+    lambda m: m['columns']['x'].update(data='not bytes'),
+    lambda m: m['columns']['y'].update(data=b'\x00' * 9),
+    lambda m: m['columns']['page'].update(data=b'\x00' * 4),
+    lambda m: m['columns']['fontFamily'].update(ids='u8'),
+    lambda m: m['columns']['fontFamily'].update(data=b'\x09\x00\x01\x00\x01\x00'),
+    lambda m: m['columns']['fontFamily'].pop('values'),
+    lambda m: m['columns']['tags'].update(absent=[3]),
+    lambda m: m['columns']['tags'].update(absent=[-1]),
+    lambda m: m['columns']['tags'].update(absent=[1, 1]),
+    lambda m: m['columns']['tags'].update(absent=['1']),
+    lambda m: m['columns']['tags'].pop('values'),
+    lambda m: m.update(version=2),
+])
+def test_malformed_message_raises_value_error(mutate):
+    with pytest.raises(ValueError):
+        decode_annotations(corrupt(mutate))
+
+def test_not_a_message_raises_value_error():
+    with pytest.raises(ValueError):
+        decode_annotations({'annotations': []})
+
+
+@pytest.mark.parametrize('path', ['/api/save-project', '/api/save-annotations', '/api/generate-pdf',
+                                  '/api/preview-pdf', '/api/insert-page'])
+@pytest.mark.parametrize('body, content_type', [
+    (pack({'annotations': corrupt(lambda m: m['columns'].pop('x'))}), 'application/x-msgpack'),
+    (b'\xc1', 'application/x-msgpack'),
+    (b'{"annotations": [', 'application/json'),
+])
+def test_routes_reject_malformed_bodies(client, path, body, content_type):
+    response = client.post(path, data=body, content_type=content_type)
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith('Invalid request body')
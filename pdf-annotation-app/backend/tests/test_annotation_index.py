@@ -0,0 +1,107 @@
+import json
+import random
+
+import pytest
+
+from annotation_index import AnnotationIndex, AnnotationIndexCache, annotation_box, boxes_intersect
+
+
+def box(id, x, y, width=40, height=20, page=0):
+    return {'id': id, 'page': page, 'x': x, 'y': y, 'width': width, 'height': height}
+
+def ids(annotations):
+    return [ann['id'] for ann in annotations]
+
+def post_json(client, path, body):
+    # json.dumps writes Infinity and NaN, which the server's parser accepts
+    return client.post(path, data=json.dumps(body), content_type='application/json')
+
+
+def test_query_rectangle_and_hit_test():
+    index = AnnotationIndex([box('a', 10, 10), box('b', 200, 300), box('c', 30, 15), box('d', 10, 10, page=1)])
+    assert ids(index.query(0, 0, 0, 100, 100)) == ['a', 'c']
+    assert ids(index.query(0, 215, 305)) == ['b']
+    assert index.query(0, 500, 500) == []
+    assert ids(index.on_page(1)) == ['d']
+    assert index.on_page(5) == []
+
+def test_query_matches_brute_force():
+    rng = random.Random(1)
+    annotations = [box(str(i), rng.uniform(0, 600), rng.uniform(0, 800), rng.uniform(1, 300), rng.uniform(1, 60))
+                   for i in range(300)]
+    index = AnnotationIndex(annotations)
+    for _ in range(50):
+        rect = (rng.uniform(-50, 600), rng.uniform(-50, 800), rng.uniform(0, 400), rng.uniform(0, 400))
+        query_box = (rect[0], rect[1], rect[0] + rect[2], rect[1] + rect[3])
+        expected = [ann['id'] for ann in annotations if boxes_intersect(annotation_box(ann), query_box)]
+        assert ids(index.query(0, *rect)) == expected
+
+def test_overlaps_need_positive_area():
+    index = AnnotationIndex([box('a', 0, 0), box('b', 20, 10), box('c', 40, 0), box('big', 0, 0, 2000, 2000)])
+    pairs = {(o['first'], o['second']) for o in index.overlaps(0)}
+    # a and c only touch
+    assert pairs == {('a', 'b'), ('b', 'c'), ('a', 'big'), ('b', 'big'), ('c', 'big')}
+    shared = next(o for o in index.overlaps(0) if (o['first'], o['second']) == ('a', 'b'))
+    assert shared['intersection'] == {'x': 20.0, 'y': 10.0, 'width': 20.0, 'height': 10.0}
+
+def test_non_finite_annotation_boxes_do_not_break_the_index():
+    index = AnnotationIndex([box('a', 10, 10), box('wide', 0, 0, float('inf')), box('lost', float('nan'), 0)])
+    assert ids(index.query(0, 0, 0, 100, 100)) == ['a', 'wide']
+    assert {(o['first'], o['second']) for o in index.overlaps(0)} == {('a', 'wide')}
+
+def test_cache_rebuilds_on_new_version():
+    cache = AnnotationIndexCache(max_entries=1)
+    loads = []
+    def loader(annotations):
+        return lambda: loads.append(1) or annotations
+
+    first = cache.get('p', 1, loader([box('a', 0, 0)]))
+    assert cache.get('p', 1, loader([])) is first
+    assert ids(cache.get('p', 2, loader([box('b', 0, 0)])).on_page(0)) == ['b']
+    cache.get('q', 1, loader([]))
+    cache.get('p', 2, loader([]))
+    assert len(loads) == 4
+
+
+def test_query_route_with_sent_annotations(client):
+    response = post_json(client, '/api/annotations/query',
+                         {'annotations': [box('a', 10, 10), box('b', 300, 300)], 'page': 0, 'x': 0, 'y': 0,
+                          'width': 50, 'height': 50})
+    assert response.status_code == 200
+    assert ids(response.get_json()['annotations']) == ['a']
+
+def test_query_route_sees_buffered_annotation_saves(client, pdf_bytes):
+    import base64
+    saved = client.post('/api/save-project', json={'pdf_data': base64.b64encode(pdf_bytes).decode(),
+                                                   'annotations': [box('a', 10, 10)]})
+    project_id = saved.get_json()['project_id']
+    assert post_json(client, '/api/annotations/query', {'project_id': project_id, 'page': 0}).get_json()['count'] == 1
+
+    client.post('/api/save-annotations', json={'project_id': project_id,
+                                               'annotations': [box('a', 10, 10), box('b', 20, 20)]})
+    response = post_json(client, '/api/annotations/query', {'project_id': project_id, 'page': 0})
+    assert ids(response.get_json()['annotations']) == ['a', 'b']
+
+    assert post_json(client, '/api/annotations/query', {'project_id': 'missing', 'page': 0}).status_code == 404
+
+@pytest.mark.parametrize('query', [
+    {'page': 0, 'x': float('inf'), 'y': 0},
+    {'page': 0, 'x': 0, 'y': float('nan')},
+    {'page': 0, 'x': 0, 'y': 0, 'width': float('-inf')},
+    {'page': float('inf')},
+    {'page': float('nan')},
+    {'page': 'first'},
+    {'x': 0, 'y': 0},
+])
+def test_query_route_rejects_invalid_queries(client, query):
+    response = post_json(client, '/api/annotations/query', dict(query, annotations=[box('a', 0, 0)]))
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('page', [float('inf'), float('nan')])
+def test_overlaps_route_rejects_non_finite_page(client, page):
+    response = post_json(client, '/api/annotations/overlaps', {'annotations': [], 'page': page})
+    assert response.status_code == 400
+
+def test_overlaps_route(client):
+    response = post_json(client, '/api/annotations/overlaps', {'annotations': [box('a', 0, 0), box('b', 10, 10)]})
+    assert response.get_json()['count'] == 1
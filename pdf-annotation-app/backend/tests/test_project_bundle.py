@@ -0,0 +1,115 @@
+import io
+import tarfile
+
+import pytest
+
+from project_bundle import BundleError, import_bundle, write_bundle
+from project_store import ProjectData, open_project_store
+from conftest import make_pdf
+
+
+def save_project(store, pdf_bytes, annotations):
+    project = ProjectData()
+    project.pdf_filename = 'document.pdf'
+    project.annotations = annotations
+    project.metadata = {'author': 'tests'}
+    store.save(project, pdf_bytes)
+    return project
+
+def make_bundle(*entries):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, data in entries:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    buffer.seek(0)
+    return buffer
+
+HEADER = ('bundle.json', b'{"format":"pdf-annotation-bundle","version":1}')
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(tmp_path, store, compress):
+    shared_pdf, other_pdf = make_pdf(1), make_pdf(2)
+    projects = [
+        save_project(store, shared_pdf, [{'id': 'a', 'page': 0, 'value': 'café'}]),
+        save_project(store, shared_pdf, []),
+        save_project(store, other_pdf, [{'id': 'b', 'page': 1}]),
+    ]
+    bundle = io.BytesIO()
+    write_bundle(store, bundle, compress=compress)
+    bundle.seek(0)
+
+    target = open_project_store(str(tmp_path / 'target'))
+    report = import_bundle(target, bundle)
+
+    assert report['projects_imported'] == 3
+    assert report['pdfs_imported'] == 2
+    assert report['projects_failed'] == 0
+    for project in projects:
+        restored = target.load(project.project_id)
+        assert restored.annotations == project.annotations
+        assert restored.metadata == project.metadata
+        assert restored.pdf_filename == project.pdf_filename
+        assert target.load_pdf(restored) == store.load_pdf(project)
+    assert target.blobs.refcount(projects[0].pdf_sha256) == 2
+
+def test_existing_projects_kept_unless_overwrite(tmp_path, store, pdf_bytes):
+    project = save_project(store, pdf_bytes, [{'id': 'a', 'page': 0}])
+    bundle = io.BytesIO()
+    write_bundle(store, bundle)
+
+    project.annotations = [{'id': 'changed', 'page': 0}]
+    store.save(project)
+    bundle.seek(0)
+    assert import_bundle(store, bundle)['projects_skipped'] == 1
+    assert store.load(project.project_id).annotations[0]['id'] == 'changed'
+
+    bundle.seek(0)
+    assert import_bundle(store, bundle, overwrite=True)['projects_imported'] == 1
+    assert store.load(project.project_id).annotations[0]['id'] == 'a'
+
+def test_corrupt_pdf_fails_its_project_only(tmp_path, store, pdf_bytes):
+    project = save_project(store, pdf_bytes, [])
+    bundle = io.BytesIO()
+    write_bundle(store, bundle)
+    # Flip a byte inside the PDF entry without changing the archive structure
+    data = bytearray(bundle.getvalue())
+    offset = data.index(b'%PDF') + 20
+    data[offset] ^= 0xFF
+
+    target = open_project_store(str(tmp_path / 'target'))
+    report = import_bundle(target, io.BytesIO(bytes(data)))
+
+    assert report['pdfs_failed'] == 1
+    assert report['projects_failed'] == 1
+    assert target.load(project.project_id) is None
+
+@pytest.mark.parametrize('entries', [
+    [('projects/x/manifest.json', b'{}')],
+    [('bundle.json', b'{not json')],
+    [('bundle.json', b'[1]')],
+    [('bundle.json', b'{"format":"something-else","version":1}')],
+    [('bundle.json', b'{"format":"pdf-annotation-bundle","version":99}')],
+])
+def test_malformed_bundle_raises_bundle_error(store, entries):
+    with pytest.raises(BundleError):
+        import_bundle(store, make_bundle(*entries))
+
+@pytest.mark.parametrize('trailer', [None, b'{bad', b'[1]', b'{"projects":1}'])
+def test_bad_trailer_marks_import_incomplete(store, trailer):
+    entries = [HEADER] if trailer is None else [HEADER, ('bundle-end.json', trailer)]
+    report = import_bundle(store, make_bundle(*entries))
+    assert not report.get('complete')
+    assert report['errors']
+
+def test_complete_bundle_is_marked_complete(store):
+    report = import_bundle(store, make_bundle(HEADER, ('bundle-end.json', b'{"projects":0,"pdfs":0}')))
+    assert report['complete']
+
+def test_import_route_reports_malformed_bundle(client):
+    response = client.post('/api/import-projects', data=make_bundle(('bundle.json', b'{not json')).getvalue(),
+                           content_type='application/x-tar')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+import pytest
+
+from project_store import LayoutMigrationRequired, ProjectData, dump_project_bytes, open_project_store
+
+
+def make_project(annotations=None):
+    project = ProjectData()
+    project.annotations = annotations or []
+    return project
+
+def age_blob(store, digest, seconds=7200):
+    """Backdate a blob's mtime so it is outside the garbage collection grace period"""
+    past = time.time() - seconds
+    os.utime(store.blobs.path(digest), (past, past))
+
+
+def test_open_refuses_flat_layout(tmp_path):
+    project = make_project()
+    (tmp_path / f'project_{project.project_id}.pkl').write_bytes(dump_project_bytes(project))
+
+    with pytest.raises(LayoutMigrationRequired):
+        open_project_store(str(tmp_path))
+
+    store = open_project_store(str(tmp_path), migrate=True)
+    assert store.load(project.project_id).project_id == project.project_id
+    assert store.backend.flat_files() == []
+    # Once migrated the store opens normally
+    open_project_store(str(tmp_path))
+
+def test_concurrent_migrations_move_each_file_once(tmp_path):
+    projects = [make_project() for _ in range(20)]
+    for project in projects:
+        (tmp_path / f'project_{project.project_id}.pkl').write_bytes(dump_project_bytes(project))
+
+    errors = []
+    def migrate():
+        try:
+            open_project_store(str(tmp_path), migrate=True)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=migrate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    store = open_project_store(str(tmp_path))
+    assert sorted(p.project_id for _, p in store.iter_projects()) == sorted(p.project_id for p in projects)
+
+def test_save_counts_references(store, pdf_bytes):
+    first, second = make_project(), make_project()
+    store.save(first, pdf_bytes)
+    store.save(second, pdf_bytes)
+    assert first.pdf_sha256 == second.pdf_sha256
+    assert store.blobs.refcount(first.pdf_sha256) == 2
+
+    store.delete(first.project_id)
+    assert store.blobs.refcount(second.pdf_sha256) == 1
+    assert store.load_pdf(second) == pdf_bytes
+
+def test_gc_deletes_old_unreferenced_blobs_only(store, pdf_bytes):
+    project = make_project()
+    store.save(project, pdf_bytes)
+    orphan = store.blobs.put(b'%PDF-1.4 orphan')
+    age_blob(store, project.pdf_sha256)
+    age_blob(store, orphan)
+    recent_orphan = store.blobs.put(b'%PDF-1.4 recent')
+
+    report = store.collect_garbage()
+
+    assert report['deleted_blobs'] == 1
+    assert not store.blobs.exists(orphan)
+    assert store.blobs.exists(project.pdf_sha256)
+    assert store.blobs.exists(recent_orphan)
+
+def test_gc_dry_run_deletes_nothing(store):
+    orphan = store.blobs.put(b'%PDF-1.4 orphan')
+    age_blob(store, orphan)
+
+    report = store.collect_garbage(dry_run=True)
+
+    assert report['deleted_blobs'] == 1
+    assert store.blobs.exists(orphan)
+
+def test_gc_resets_drifted_refcount_then_deletes(store):
+    orphan = store.blobs.put(b'%PDF-1.4 orphan')
+    store.blobs.incref(orphan)
+    age_blob(store, orphan)
+
+    report = store.collect_garbage()
+    assert report['repaired_refcounts'] == 1
+    assert store.blobs.exists(orphan)
+    assert store.blobs.refcount(orphan) == 0
+
+    store.collect_garbage()
+    assert not store.blobs.exists(orphan)
+
+@pytest.mark.parametrize('reuse', ['put', 'retain'])
+def test_blob_reused_after_gc_read_projects_is_kept(store, reuse):
+    data = b'%PDF-1.4 shared'
+    digest = store.blobs.put(data)
+    age_blob(store, digest)
+    # GC decided the blob was unused as of now...
+    unused_since = time.time() - 1
+
+    # ...then a save reused it before the delete
+    if reuse == 'put':
+        store.blobs.put(data)
+    else:
+        assert store.blobs.retain(digest)
+
+    assert store.blobs.delete_unused(digest, unused_since) is None
+    assert store.blobs.exists(digest)
+
+def test_retain_reports_missing_blob(store):
+    assert store.blobs.retain('0' * 64) is False
+
+def test_bundle_import_retains_existing_blob(tmp_path, store, pdf_bytes):
+    from io import BytesIO
+    from project_bundle import import_bundle, write_bundle
+
+    source = open_project_store(str(tmp_path / 'source'))
+    project = make_project([{'id': 'a', 'page': 0}])
+    source.save(project, pdf_bytes)
+    bundle = BytesIO()
+    write_bundle(source, bundle)
+
+    # The target already has the PDF, unreferenced and past the grace period
+    digest = store.blobs.put(pdf_bytes)
+    age_blob(store, digest)
+    unused_since = time.time() - 1
+    bundle.seek(0)
+    report = import_bundle(store, bundle)
+
+    assert report['pdfs_existing'] == 1
+    assert store.blobs.delete_unused(digest, unused_since) is None
+    assert store.load_pdf(store.load(project.project_id)) == pdf_bytes
@@ -0,0 +1,163 @@
+"""
+Page thumbnails for the page navigator.
+
+Most of our documents are scans: every page is one embedded image. For
+those, the thumbnail is that image scaled down, which is far cheaper than
+rendering the page. A page's /Thumb entry (a small preview some producers
+embed) is used instead when it is large enough. JPEG images are decoded
+in Pillow's draft mode, which scales down while decoding.
+
+There is no PDF rasterizer in the backend, so pages drawn with vector
+content and text have no thumbnail; the batch response marks them with
+data: null and the navigator renders those pages itself.
+
+Thumbnails are JPEG bytes in a RenderCache (memory plus disk under
+RENDER_CACHE_FOLDER/thumbnails), keyed by document hash, page and size.
+Pages without a thumbnail are cached too, as an empty entry, so they are
+not inspected again.
+"""
+from io import BytesIO
+
+from PIL import Image
+from pypdf.filters import _xobj_to_image
+from pypdf.generic import NameObject
+
+from overlay_cache import hash_json
+
+# Bump when thumbnail output changes, so cached thumbnails are not reused
+THUMBNAIL_VERSION = 1
+
+DEFAULT_THUMBNAIL_SIZE = 128
+MIN_THUMBNAIL_SIZE = 32
+MAX_THUMBNAIL_SIZE = 512
+JPEG_QUALITY = 70
+
+# An embedded image whose aspect ratio is within this fraction of the page's is taken to be a scan of it
+SCAN_ASPECT_TOLERANCE = 0.05
+
+
+def thumbnail_key(digest, page_number, size):
+    return hash_json(['thumbnail', THUMBNAIL_VERSION, digest, page_number, size])
+
+def _image_xobjects(page):
+    """Image XObjects used directly by a page (not inside forms)"""
+    resources = page.get('/Resources')
+    if resources is None:
+        return []
+    xobjects = resources.get_object().get('/XObject')
+    if xobjects is None:
+        return []
+    images = []
+    for name, ref in xobjects.get_object().items():
+        xobject = ref.get_object()
+        if xobject.get('/Subtype') == '/Image':
+            images.append(xobject)
+    return images
+
+def _open_image(xobject, size):
+    """Decode an image XObject into a PIL image, decoding JPEGs at reduced size"""
+    filters = xobject.get('/Filter')
+    if not isinstance(filters, list):
+        filters = [filters]
+    if filters[-1] == NameObject('/DCTDecode'):
+        # get_data() undoes any filters before DCTDecode (e.g. ASCII85) and leaves the JPEG
+        image = Image.open(BytesIO(xobject.get_data()))
+        image.draft('RGB', (size, size))
+        return image
+    return _xobj_to_image(xobject)[2]
+
+def _pixel_size(xobject):
+    return int(xobject.get('/Width', 0)), int(xobject.get('/Height', 0))
+
+def _looks_like_scan(xobject, page):
+    """True if the image has the page's proportions, as a full-page scan does (a logo usually doesn't)"""
+    width, height = _pixel_size(xobject)
+    page_width, page_height = float(page.mediabox.width), float(page.mediabox.height)
+    if not (width and height and page_width and page_height):
+        return False
+    page_ratio = page_width / page_height
+    return abs(width / height - page_ratio) <= SCAN_ASPECT_TOLERANCE * page_ratio
+
+def page_image(page, size):
+    """
+    The image to make a page's thumbnail from: its /Thumb if that is at least
+    size pixels, else the page's embedded image if it is a scan, else a
+    smaller /Thumb. None for pages that would have to be rendered.
+    """
+    thumb = page.get('/Thumb')
+    thumb = thumb.get_object() if thumb is not None else None
+    if thumb is not None and max(_pixel_size(thumb)) >= size:
+        return _open_image(thumb, size)
+
+    images = _image_xobjects(page)
+    if len(images) == 1 and _looks_like_scan(images[0], page):
+        return _open_image(images[0], size)
+
+    if thumb is not None:
+        return _open_image(thumb, size)
+    return None
+
+def make_thumbnail(page, size):
+    """JPEG thumbnail of a pypdf page that fits in size x size pixels, or None"""
+    image = page_image(page, size)
+    if image is None:
+        return None
+
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.thumbnail((size, size), Image.LANCZOS)
+    rotation = page.rotation % 360
+    if rotation:
+        # /Rotate turns the page clockwise, PIL rotates counter-clockwise
+        image = image.rotate(-rotation, expand=True)
+
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+class ThumbnailService:
+    """Cached thumbnails of the pages of CachedDocuments"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.generated = 0
+        self.unavailable = 0
+        self.errors = 0
+
+    def get(self, document, page_number, size):
+        """JPEG bytes of a page's thumbnail, or None if the page has none"""
+        key = thumbnail_key(document.digest, page_number, size)
+        data = self.cache.get(key)
+        if data is None:
+            try:
+                # pypdf readers are not thread safe
+                with document.lock:
+                    data = make_thumbnail(document.reader.pages[page_number], size)
+            except Exception as e:
+                print(f"  Warning: No thumbnail for page {page_number + 1} of {document.digest[:12]}: {e}")
+                self.errors += 1
+                data = None
+            if data:
+                self.generated += 1
+            else:
+                self.unavailable += 1
+            self.cache.put(key, data or b'')
+        return data or None
+
+    def describe(self, document, page_number, size):
+        """Thumbnail of a page as a dict with its pixel size and the JPEG bytes"""
+        data = self.get(document, page_number, size)
+        if data is None:
+            return {'page': page_number, 'width': None, 'height': None, 'data': None}
+        with Image.open(BytesIO(data)) as image:
+            width, height = image.size
+        return {'page': page_number, 'width': width, 'height': height, 'data': data}
+
+    def stats(self):
+        return {
+            'generated': self.generated,
+            'unavailable': self.unavailable,
+            'errors': self.errors,
+            'cache': self.cache.stats(),
+        }
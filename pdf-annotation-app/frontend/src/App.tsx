@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import CleanPDFViewer from './components/CleanPDFViewer';
 import SimplePDFDisplay from './components/SimplePDFDisplay';
 import ProjectManager from './components/ProjectManager';
@@ -7,20 +7,61 @@ import { Annotation, ProjectData } from './types';
 import { api } from './api';
 import './App.css';
 
+// Wait for a pause in editing before autosaving
+const AUTOSAVE_DELAY_MS = 1500;
+
 const App: React.FC = () => {
   const [pdfData, setPdfData] = useState<string | null>(null);
+  const [pdfSourceUrl, setPdfSourceUrl] = useState<string | null>(null);
   const [pdfFilename, setPdfFilename] = useState<string>('');
   const [annotations, setAnnotations] = useState<Annotation[]>([]);
   const [currentProject, setCurrentProject] = useState<ProjectData | null>(null);
 
   const generateId = () => Math.random().toString(36).substr(2, 9);
 
+  // Annotations as last loaded or saved, so autosave only fires on real edits
+  const savedAnnotations = useRef<Annotation[] | null>(null);
+
+  // Project whose stored PDF is shown; bytes fetched for any other project are stale
+  const pdfProjectId = useRef<string | null>(null);
+
+  // The PDF bytes, fetched from the server on first need when a loaded project is only shown by URL.
+  // Returns null if there is no PDF or another project (or file) was opened meanwhile.
+  const ensurePdfData = async (): Promise<string | null> => {
+    if (pdfData) return pdfData;
+    const projectId = pdfProjectId.current;
+    if (!pdfSourceUrl || !projectId) return null;
+
+    const data = await api.fetchProjectPdf(projectId);
+    if (pdfProjectId.current !== projectId) return null;
+    setPdfData(data);
+    return data;
+  };
+
+  // Autosave annotation edits of a loaded project. Only while the PDF is the
+  // stored one (pdfSourceUrl is cleared when pages are inserted or a new file is uploaded).
+  useEffect(() => {
+    if (!currentProject || !pdfSourceUrl || annotations === savedAnnotations.current) return;
+
+    const timer = setTimeout(async () => {
+      try {
+        await api.saveAnnotations(currentProject.project_id, annotations);
+        savedAnnotations.current = annotations;
+      } catch (error) {
+        console.error('Error autosaving annotations:', error);
+      }
+    }, AUTOSAVE_DELAY_MS);
+    return () => clearTimeout(timer);
+  }, [annotations, currentProject, pdfSourceUrl]);
+
   const handleFileUpload = async (event: React.ChangeEvent<HTMLInputElement>) => {
     const file = event.target.files?.[0];
     if (!file) return;
 
     try {
       const response = await api.uploadPdf(file);
+      pdfProjectId.current = null;
+      setPdfSourceUrl(null);
       setPdfData(response.pdf_data);
       setPdfFilename(response.filename);
       setAnnotations([]);
@@ -52,16 +93,19 @@ const App: React.FC = () => {
   };
 
   const handleSaveProject = async () => {
-    if (!pdfData) {
-      alert('No PDF loaded to save');
-      return;
-    }
-
     try {
+      const data = await ensurePdfData();
+      if (!data) {
+        alert('No PDF loaded to save');
+        return;
+      }
+
       const projectData = {
-        pdf_data: pdfData,
+        pdf_data: data,
         pdf_filename: pdfFilename,
         annotations,
+        // Only a PDF the server hasn't stored yet (uploaded or with inserted pages) needs linearizing
+        linearize: !pdfSourceUrl,
         metadata: {
           saved_at: new Date().toISOString(),
         },
@@ -76,14 +120,20 @@ const App: React.FC = () => {
   };
 
   const handleProjectLoad = (projectResponse: any) => {
-    const { project_data, pdf_data } = projectResponse;
-    setPdfData(pdf_data);
+    const { project_data } = projectResponse;
+    pdfProjectId.current = project_data.project_id;
+    // Show the document from the Range-capable URL; the bytes are only fetched for saving, printing or inserting pages
+    setPdfData(null);
+    setPdfSourceUrl(api.projectPdfUrl(project_data.project_id));
     setPdfFilename(project_data.pdf_filename);
+    savedAnnotations.current = project_data.annotations;
     setAnnotations(project_data.annotations);
     setCurrentProject(project_data);
   };
 
   const handleNewProject = () => {
+    pdfProjectId.current = null;
+    setPdfSourceUrl(null);
     setPdfData(null);
     setPdfFilename('');
     setAnnotations([]);
@@ -91,13 +141,14 @@ const App: React.FC = () => {
   };
 
   const handlePrint = async () => {
-    if (!pdfData) {
-      alert('No PDF to print');
-      return;
-    }
-
     try {
-      const blob = await api.generatePdf(pdfData, annotations);
+      const data = await ensurePdfData();
+      if (!data) {
+        alert('No PDF to print');
+        return;
+      }
+
+      const blob = await api.generatePdf(data, annotations);
       const url = window.URL.createObjectURL(blob);
       const link = document.createElement('a');
       link.href = url;
@@ -117,11 +168,13 @@ const App: React.FC = () => {
   };
 
   const handleInsertPageBefore = async (pageIndex: number) => {
-    if (!pdfData) return;
-    
     try {
-      const response = await api.insertPage(pdfData, pageIndex, 'before');
+      const data = await ensurePdfData();
+      if (!data) return;
+
+      const response = await api.insertPage(data, pageIndex, 'before');
       if (response.success) {
+        setPdfSourceUrl(null);
         setPdfData(response.pdfData);
       } else {
         console.error('Failed to insert page:', response.error);
@@ -134,11 +187,13 @@ const App: React.FC = () => {
   };
 
   const handleInsertPageAfter = async (pageIndex: number) => {
-    if (!pdfData) return;
-    
     try {
-      const response = await api.insertPage(pdfData, pageIndex, 'after');
+      const data = await ensurePdfData();
+      if (!data) return;
+
+      const response = await api.insertPage(data, pageIndex, 'after');
       if (response.success) {
+        setPdfSourceUrl(null);
         setPdfData(response.pdfData);
       } else {
         console.error('Failed to insert page:', response.error);
@@ -167,7 +222,7 @@ const App: React.FC = () => {
             📄 Upload PDF
           </label>
           
-          {pdfData && (
+          {(pdfData || pdfSourceUrl) && (
             <>
               <button onClick={handleSaveProject} className="save-btn">
                 💾 Save Project
@@ -198,9 +253,10 @@ const App: React.FC = () => {
         </aside>
 
         <main className="main-content">
-          {pdfData ? (
+          {pdfData || pdfSourceUrl ? (
             <CleanPDFViewer
               pdfData={pdfData}
+              pdfSourceUrl={pdfSourceUrl}
               annotations={annotations}
               onAnnotationAdd={handlePDFClick}
               onAnnotationUpdate={handleAnnotationUpdate}
@@ -1,8 +1,19 @@
 import axios from 'axios';
-import { ProjectData, ProjectSummary } from './types';
+import { Annotation, ProjectData, ProjectSummary } from './types';
 
 const API_BASE_URL = 'http://localhost:5001/api';
 
+// Downsampling of page images on export, for smaller print files (server defaults: 150 DPI, quality 75, jpeg)
+export interface ImageOptions {
+  dpi?: number;
+  quality?: number;
+  format?: 'jpeg' | 'flate';
+}
+
+const imageOptionsBody = (options?: ImageOptions) => options
+  ? { downsample_images: true, image_dpi: options.dpi, image_quality: options.quality, image_format: options.format }
+  : {};
+
 export const api = {
   uploadPdf: async (file: File) => {
     const formData = new FormData();
@@ -34,31 +45,199 @@ export const api = {
     }
   },
 
-  saveProject: async (projectData: Partial<ProjectData>) => {
+  saveProject: async (projectData: Partial<ProjectData> & { linearize?: boolean }) => {
     const response = await axios.post(`${API_BASE_URL}/save-project`, projectData);
     return response.data;
   },
 
+  // Lightweight save of an existing project's annotations; the server buffers and coalesces these
+  saveAnnotations: async (projectId: string, annotations: Annotation[], commit: boolean = false) => {
+    const response = await axios.post(`${API_BASE_URL}/save-annotations`, {
+      project_id: projectId,
+      annotations,
+      commit,
+      metadata: { saved_at: new Date().toISOString() },
+    });
+    return response.data;
+  },
+
+  commitProject: async (projectId: string) => {
+    const response = await axios.post(`${API_BASE_URL}/commit-project/${projectId}`);
+    return response.data;
+  },
+
+  // Returns the project manifest only; the PDF is fetched separately from projectPdfUrl()
   loadProject: async (projectId: string) => {
     const response = await axios.get(`${API_BASE_URL}/load-project/${projectId}`);
     return response.data;
   },
 
+  projectPdfUrl: (projectId: string) => `${API_BASE_URL}/project-pdf/${projectId}`,
+
+  fetchProjectPdf: async (projectId: string): Promise<string> => {
+    const response = await axios.get(`${API_BASE_URL}/project-pdf/${projectId}`, {
+      responseType: 'arraybuffer',
+    });
+    const bytes = new Uint8Array(response.data);
+    let binary = '';
+    const chunkSize = 0x8000;
+    for (let i = 0; i < bytes.length; i += chunkSize) {
+      binary += String.fromCharCode.apply(null, Array.from(bytes.subarray(i, i + chunkSize)));
+    }
+    return btoa(binary);
+  },
+
   listProjects: async (): Promise<{ success: boolean; projects: ProjectSummary[] }> => {
     const response = await axios.get(`${API_BASE_URL}/list-projects`);
     return response.data;
   },
 
-  generatePdf: async (pdfData: string, annotations: any[]) => {
+  searchProjects: async (query: string, limit: number = 20, offset: number = 0, prefix: boolean = true) => {
+    const response = await axios.get(`${API_BASE_URL}/search`, {
+      params: { q: query, limit, offset, prefix },
+    });
+    return response.data;
+  },
+
+  // Streamed download of a project bundle; link to it rather than buffering it in memory
+  exportProjectsUrl: (projectIds: string[] = [], compress: boolean = true) => {
+    const params = new URLSearchParams(projectIds.map((id) => ['project_id', id]));
+    params.set('compress', String(compress));
+    return `${API_BASE_URL}/export-projects?${params}`;
+  },
+
+  importProjects: async (bundle: File, overwrite: boolean = false) => {
+    const formData = new FormData();
+    formData.append('bundle', bundle);
+
+    const response = await axios.post(`${API_BASE_URL}/import-projects`, formData, {
+      params: { overwrite },
+      headers: {
+        'Content-Type': 'multipart/form-data',
+      },
+    });
+    return response.data;
+  },
+
+  generatePdf: async (pdfData: string, annotations: any[], optimize: boolean = false, imageOptions?: ImageOptions) => {
+    const response = await axios.post(
+      `${API_BASE_URL}/generate-pdf`,
+      { pdf_data: pdfData, annotations, optimize, ...imageOptionsBody(imageOptions) },
+      { responseType: 'blob' }
+    );
+    
+    return response.data;
+  },
+
+  // Export a saved project; the server uses its stored PDF and caches the result
+  generateProjectPdf: async (
+    projectId: string,
+    annotations?: any[],
+    optimize: boolean = false,
+    imageOptions?: ImageOptions
+  ) => {
     const response = await axios.post(
       `${API_BASE_URL}/generate-pdf`,
-      { pdf_data: pdfData, annotations },
+      { project_id: projectId, annotations, optimize, ...imageOptionsBody(imageOptions) },
       { responseType: 'blob' }
     );
     
     return response.data;
   },
 
+  // Render only some pages for live preview. Sends the document hash when the
+  // server already has the source cached and falls back to sending the PDF.
+  previewPdf: async (
+    source: { documentHash?: string | null; projectId?: string | null; pdfData?: string | null },
+    annotations: any[],
+    pages: number[]
+  ): Promise<{ blob: Blob; documentHash: string | null }> => {
+    const post = (body: any) => axios.post(
+      `${API_BASE_URL}/preview-pdf`,
+      { ...body, annotations, pages },
+      { responseType: 'blob' }
+    );
+
+    let response;
+    try {
+      if (source.documentHash) {
+        response = await post({ document_hash: source.documentHash });
+      } else if (source.projectId) {
+        response = await post({ project_id: source.projectId });
+      }
+    } catch (error: any) {
+      if (error.response?.status !== 404 || !source.pdfData) {
+        throw error;
+      }
+    }
+    if (!response) {
+      response = await post({ pdf_data: source.pdfData });
+    }
+
+    return { blob: response.data, documentHash: response.headers['x-document-hash'] || null };
+  },
+
+  // Annotations on a page intersecting a rectangle (e.g. the visible viewport)
+  // Thumbnails of pages pageFrom..pageTo (0-based, inclusive) in one request; pages without
+  // an embedded image come back with data: null and have to be rendered by the client
+  getThumbnails: async (
+    source: { documentHash?: string | null; projectId?: string | null },
+    pageFrom: number = 0,
+    pageTo?: number,
+    size: number = 128
+  ): Promise<{
+    success: boolean;
+    document_hash: string;
+    page_count: number;
+    thumbnails: Array<{ page: number; width: number | null; height: number | null; data: string | null }>;
+  }> => {
+    const response = await axios.get(`${API_BASE_URL}/thumbnails`, {
+      params: {
+        document_hash: source.documentHash || undefined,
+        project_id: source.documentHash ? undefined : source.projectId || undefined,
+        page_from: pageFrom,
+        page_to: pageTo,
+        size,
+      },
+    });
+    return response.data;
+  },
+
+  thumbnailUrl: (documentHash: string, page: number, size: number = 128) =>
+    `${API_BASE_URL}/thumbnails/${documentHash}/${page}?size=${size}`,
+
+  queryAnnotations: async (
+    projectId: string,
+    page: number,
+    rect?: { x: number; y: number; width: number; height: number }
+  ): Promise<{ success: boolean; annotations: Annotation[]; count: number }> => {
+    const response = await axios.post(`${API_BASE_URL}/annotations/query`, { project_id: projectId, page, ...rect });
+    return response.data;
+  },
+
+  findOverlaps: async (projectId: string, page?: number) => {
+    const response = await axios.post(`${API_BASE_URL}/annotations/overlaps`, { project_id: projectId, page });
+    return response.data;
+  },
+
+  mailMerge: async (projectId: string, dataFile: File, mode: 'single' | 'separate' = 'single', filenamePattern?: string) => {
+    const formData = new FormData();
+    formData.append('project_id', projectId);
+    formData.append('data', dataFile);
+    formData.append('mode', mode);
+    if (filenamePattern) {
+      formData.append('filename_pattern', filenamePattern);
+    }
+
+    const response = await axios.post(`${API_BASE_URL}/mail-merge`, formData, {
+      headers: {
+        'Content-Type': 'multipart/form-data',
+      },
+      responseType: 'blob',
+    });
+    return response.data;
+  },
+
   insertPage: async (pdfData: string, pageIndex: number, position: 'before' | 'after') => {
     const response = await axios.post(`${API_BASE_URL}/insert-page`, {
       pdfData,
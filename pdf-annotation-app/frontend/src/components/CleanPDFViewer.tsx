@@ -1,5 +1,6 @@
-import React, { useState, useCallback, useEffect, useRef } from 'react';
+import React, { useState, useCallback, useEffect, useMemo, useRef } from 'react';
 import { Document, Page } from 'react-pdf';
+import type { PDFDocumentProxy, PDFPageProxy } from 'pdfjs-dist';
 import { Annotation } from '../types';
 import AnnotationOverlaySimple from './AnnotationOverlaySimple';
 import InsertPageDialog from './InsertPageDialog';
@@ -10,8 +11,39 @@ import './PDFViewer.css';
 import 'react-pdf/dist/Page/AnnotationLayer.css';
 import 'react-pdf/dist/Page/TextLayer.css';
 
+// Continuous mode only mounts the pages around the viewport; the rest of the
+// document is represented by padding computed from the page sizes.
+
+type PageSize = { width: number; height: number };
+type PageRange = { first: number; last: number };
+
+// Space between pages in continuous mode (the gap of .pdf-pages-virtual)
+const PAGE_GAP = 20;
+// Top padding of .pdf-container
+const CONTAINER_PADDING = 20;
+// Pages mounted (and rendered) on each side of the viewport once the browser is idle
+const OVERSCAN_PAGES = 1;
+// Pages on each side whose page objects are loaded ahead at idle priority, so their sizes are known
+const PREFETCH_PAGES = 4;
+// Size assumed for pages that haven't been loaded yet, until the first page is (A4 in points)
+const DEFAULT_PAGE_SIZE: PageSize = { width: 595, height: 842 };
+
+const requestIdle = (callback: () => void): number =>
+  typeof window.requestIdleCallback === 'function'
+    ? window.requestIdleCallback(callback, { timeout: 500 })
+    : window.setTimeout(callback, 50);
+
+const cancelIdle = (handle: number) => {
+  if (typeof window.cancelIdleCallback === 'function') {
+    window.cancelIdleCallback(handle);
+  } else {
+    window.clearTimeout(handle);
+  }
+};
+
 interface PDFViewerProps {
   pdfData: string | null;
+  pdfSourceUrl?: string | null; // Remote PDF URL (Range-capable), preferred over pdfData when set
   annotations: Annotation[];
   onAnnotationAdd: (annotation: Omit<Annotation, 'id' | 'created_at'>) => void;
   onAnnotationUpdate: (id: string, updates: Partial<Annotation>) => void;
@@ -22,6 +54,7 @@ interface PDFViewerProps {
 
 const PDFViewer: React.FC<PDFViewerProps> = ({
   pdfData,
+  pdfSourceUrl,
   annotations,
   onAnnotationAdd,
   onAnnotationUpdate,
@@ -42,6 +75,13 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
   const [showDeleteConfirmation, setShowDeleteConfirmation] = useState<boolean>(false); // Dialog for delete confirmation
   const [newlyAddedAnnotationId, setNewlyAddedAnnotationId] = useState<string | null>(null); // Track newly added annotation
   const prevAnnotationsLengthRef = useRef(annotations.length); // Track previous annotation count
+  const pdfDocumentRef = useRef<PDFDocumentProxy | null>(null); // Loaded document, for prefetching pages
+  const requestedPagesRef = useRef<Set<number>>(new Set()); // Pages already requested for prefetch
+  const pendingAnnotationScrollRef = useRef<string | null>(null); // Annotation to scroll to once its page is mounted
+  const [pageSizes, setPageSizes] = useState<Record<number, PageSize>>({}); // Unscaled size by 0-based page index
+  const [defaultPageSize, setDefaultPageSize] = useState<PageSize>(DEFAULT_PAGE_SIZE);
+  const [visibleRange, setVisibleRange] = useState<PageRange>({ first: 0, last: 0 }); // Pages in the viewport
+  const [prefetchRange, setPrefetchRange] = useState<PageRange>({ first: 0, last: 0 }); // Pages mounted at idle time
   
   // Track last annotation style for new annotations
   const [lastAnnotationStyle, setLastAnnotationStyle] = useState<Partial<Annotation>>({
@@ -117,6 +157,13 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
       pdfUrlRef.current = null;
     }
 
+    // A remote URL lets pdf.js fetch pages progressively with Range requests
+    if (pdfSourceUrl) {
+      console.log('Using remote PDF URL:', pdfSourceUrl);
+      setPdfUrl(pdfSourceUrl);
+      return;
+    }
+
     if (!pdfData) {
       console.log('No PDF data available');
       setPdfUrl(null);
@@ -153,7 +200,7 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
       console.error('Error creating PDF blob:', error);
       setPdfUrl(null);
     }
-  }, [pdfData]);
+  }, [pdfData, pdfSourceUrl]);
 
   // Clean up the blob URL when component unmounts
   useEffect(() => {
@@ -178,30 +225,147 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
     prevAnnotationsLengthRef.current = annotations.length;
   }, [annotations]);
 
-  // Add scroll listener to update current page in continuous mode
+  // Annotations grouped by page, so each mounted page gets its own without scanning the whole list
+  const annotationsByPage = useMemo(() => {
+    const byPage = new Map<number, Annotation[]>();
+    annotations.forEach(ann => {
+      const pageAnnotations = byPage.get(ann.page);
+      if (pageAnnotations) {
+        pageAnnotations.push(ann);
+      } else {
+        byPage.set(ann.page, [ann]);
+      }
+    });
+    return byPage;
+  }, [annotations]);
+
+  const recordPageSize = useCallback((index: number, page: PDFPageProxy) => {
+    const { width, height } = page.getViewport({ scale: 1 });
+    setPageSizes(prev => {
+      const known = prev[index];
+      if (known && known.width === width && known.height === height) return prev;
+      return { ...prev, [index]: { width, height } };
+    });
+  }, []);
+
+  // Top offset of every page (and the end of the last one) in continuous mode, at the current scale
+  const pageOffsets = useMemo(() => {
+    const offsets = new Array<number>(numPages + 1);
+    offsets[0] = 0;
+    for (let index = 0; index < numPages; index++) {
+      const size = pageSizes[index] || defaultPageSize;
+      offsets[index + 1] = offsets[index] + size.height * scale + PAGE_GAP;
+    }
+    return offsets;
+  }, [numPages, pageSizes, defaultPageSize, scale]);
+
+  // 0-based index of the page at a vertical position within the page list
+  const pageIndexAt = useCallback((y: number) => {
+    let low = 0;
+    let high = numPages - 1;
+    while (low < high) {
+      const middle = Math.ceil((low + high) / 2);
+      if (pageOffsets[middle] <= y) {
+        low = middle;
+      } else {
+        high = middle - 1;
+      }
+    }
+    return Math.max(0, low);
+  }, [numPages, pageOffsets]);
+
+  const scrollToPage = useCallback((pageNumber: number, smooth: boolean = true) => {
+    const container = containerRef.current;
+    if (!container) return;
+    const top = pageOffsets[pageNumber - 1] ?? 0;
+    if (smooth) {
+      container.scrollTo({ top, behavior: 'smooth' });
+    } else {
+      // The container has scroll-behavior: smooth; a jump must bypass it
+      container.style.scrollBehavior = 'auto';
+      container.scrollTop = top;
+      container.style.scrollBehavior = '';
+    }
+  }, [pageOffsets]);
+
+  // Work out which pages are in the viewport and update the current page in continuous mode
+  const updateVisibleRange = useCallback(() => {
+    const container = containerRef.current;
+    if (!container || numPages === 0) return;
+
+    const top = Math.max(0, container.scrollTop - CONTAINER_PADDING);
+    const first = pageIndexAt(top);
+    const last = pageIndexAt(top + container.clientHeight);
+    setVisibleRange(prev => (prev.first === first && prev.last === last ? prev : { first, last }));
+
+    const newCurrentPage = first + 1;
+    if (newCurrentPage !== currentPage) {
+      setCurrentPage(newCurrentPage);
+      setPageInputValue(newCurrentPage.toString());
+    }
+  }, [numPages, pageIndexAt, currentPage]);
+
+  // Add scroll listener to update the mounted pages and current page in continuous mode
   useEffect(() => {
     if (!continuousScroll || !containerRef.current) return;
 
+    const container = containerRef.current;
+    let frame = 0;
     const handleScroll = () => {
-      if (!containerRef.current) return;
-      
-      const pageHeight = 842 * scale + 20; // A4 height + margin
-      const scrollTop = containerRef.current.scrollTop;
-      const newCurrentPage = Math.floor(scrollTop / pageHeight) + 1;
-      
-      if (newCurrentPage !== currentPage && newCurrentPage >= 1 && newCurrentPage <= numPages) {
-        setCurrentPage(newCurrentPage);
-        setPageInputValue(newCurrentPage.toString());
-      }
+      if (frame) return;
+      frame = requestAnimationFrame(() => {
+        frame = 0;
+        updateVisibleRange();
+      });
     };
 
-    const container = containerRef.current;
-    container.addEventListener('scroll', handleScroll);
-    
+    updateVisibleRange();
+    container.addEventListener('scroll', handleScroll, { passive: true });
+    window.addEventListener('resize', handleScroll);
+
     return () => {
+      cancelAnimationFrame(frame);
       container.removeEventListener('scroll', handleScroll);
+      window.removeEventListener('resize', handleScroll);
     };
-  }, [continuousScroll, scale, currentPage, numPages]);
+  }, [continuousScroll, updateVisibleRange]);
+
+  // When the browser is idle, mount the pages next to the viewport and load the page objects a bit further out
+  useEffect(() => {
+    if (!continuousScroll || numPages === 0) return;
+
+    const handle = requestIdle(() => {
+      setPrefetchRange({
+        first: Math.max(0, visibleRange.first - OVERSCAN_PAGES),
+        last: Math.min(numPages - 1, visibleRange.last + OVERSCAN_PAGES),
+      });
+
+      const pdf = pdfDocumentRef.current;
+      if (!pdf) return;
+      const last = Math.min(numPages - 1, visibleRange.last + PREFETCH_PAGES);
+      for (let index = Math.max(0, visibleRange.first - PREFETCH_PAGES); index <= last; index++) {
+        if (requestedPagesRef.current.has(index)) continue;
+        requestedPagesRef.current.add(index);
+        const pageIndex = index;
+        pdf.getPage(pageIndex + 1)
+          .then(page => recordPageSize(pageIndex, page))
+          .catch(error => console.warn('Page prefetch failed:', error));
+      }
+    });
+
+    return () => cancelIdle(handle);
+  }, [continuousScroll, numPages, visibleRange, recordPageSize]);
+
+  // Scroll to an annotation once the page holding it has been mounted
+  useEffect(() => {
+    const annotationId = pendingAnnotationScrollRef.current;
+    if (!annotationId) return;
+    const annotationElement = document.querySelector(`[data-annotation-id="${annotationId}"]`);
+    if (annotationElement) {
+      pendingAnnotationScrollRef.current = null;
+      annotationElement.scrollIntoView({ behavior: 'smooth', block: 'center' });
+    }
+  });
 
   // Add keyboard and mouse wheel event listeners for zoom controls
   useEffect(() => {
@@ -239,12 +403,27 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
     };
   }, []);
 
-  const onDocumentLoadSuccess = useCallback(({ numPages }: { numPages: number }) => {
+  const onDocumentLoadSuccess = useCallback((pdf: PDFDocumentProxy) => {
+    const { numPages } = pdf;
     console.log('PDF document loaded successfully, pages:', numPages);
+    pdfDocumentRef.current = pdf;
+    requestedPagesRef.current = new Set([0]);
+    setPageSizes({});
+    setVisibleRange({ first: 0, last: 0 });
+    setPrefetchRange({ first: 0, last: 0 });
     setNumPages(numPages);
     setCurrentPage(1);
     setPageInputValue('1'); // Reset page input to 1
-  }, []);
+
+    // Until a page is loaded, assume it has the size of the first one
+    pdf.getPage(1)
+      .then(page => {
+        const { width, height } = page.getViewport({ scale: 1 });
+        setDefaultPageSize({ width, height });
+        recordPageSize(0, page);
+      })
+      .catch(error => console.warn('Could not read the first page size:', error));
+  }, [recordPageSize]);
 
   const onDocumentLoadError = useCallback((error: Error) => {
     console.error('Error loading PDF:', error);
@@ -322,13 +501,7 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
   const goToPrevious = () => {
     if (continuousScroll) {
       // Smooth scroll to previous page
-      const pageHeight = 842 * scale + 20; // A4 height + margin
-      if (containerRef.current) {
-        containerRef.current.scrollBy({
-          top: -pageHeight,
-          behavior: 'smooth'
-        });
-      }
+      scrollToPage(Math.max(1, currentPage - 1));
     } else {
       // Instant page switch
       setCurrentPage(prev => {
@@ -342,13 +515,7 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
   const goToNext = () => {
     if (continuousScroll) {
       // Smooth scroll to next page
-      const pageHeight = 842 * scale + 20; // A4 height + margin
-      if (containerRef.current) {
-        containerRef.current.scrollBy({
-          top: pageHeight,
-          behavior: 'smooth'
-        });
-      }
+      scrollToPage(Math.min(numPages, currentPage + 1));
     } else {
       // Instant page switch
       setCurrentPage(prev => {
@@ -379,15 +546,7 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
     
     if (continuousScroll) {
       // Smooth scroll to specific page
-      const pageHeight = 842 * scale + 20; // A4 height + margin
-      const targetScrollTop = (pageNumber - 1) * pageHeight;
-      
-      if (containerRef.current) {
-        containerRef.current.scrollTo({
-          top: targetScrollTop,
-          behavior: 'smooth'
-        });
-      }
+      scrollToPage(pageNumber);
     } else {
       setCurrentPage(pageNumber);
     }
@@ -585,17 +744,15 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
       setCurrentPage(nextAnnotation.page + 1); // Convert from 0-based to 1-based
       setPageInputValue((nextAnnotation.page + 1).toString());
       
-      // Scroll to the annotation if in continuous mode
+      // Scroll to the annotation if in continuous mode; its page may not be mounted yet,
+      // so jump to the page first and finish once the annotation element exists
       if (continuousScroll && containerRef.current) {
-        setTimeout(() => {
-          const annotationElement = document.querySelector(`[data-annotation-id="${nextAnnotation!.id}"]`);
-          if (annotationElement) {
-            annotationElement.scrollIntoView({ behavior: 'smooth', block: 'center' });
-          }
-        }, 100);
+        pendingAnnotationScrollRef.current = nextAnnotation.id;
+        scrollToPage(nextAnnotation.page + 1, false);
+        updateVisibleRange();
       }
     }
-  }, [annotations, selectedAnnotations, continuousScroll, getSortedAnnotations]);
+  }, [annotations, selectedAnnotations, continuousScroll, getSortedAnnotations, scrollToPage, updateVisibleRange]);
 
   // Navigate to the previous annotation
   const goToPreviousAnnotation = useCallback(() => {
@@ -629,19 +786,17 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
       setCurrentPage(previousAnnotation.page + 1); // Convert from 0-based to 1-based
       setPageInputValue((previousAnnotation.page + 1).toString());
       
-      // Scroll to the annotation if in continuous mode
+      // Scroll to the annotation if in continuous mode; its page may not be mounted yet,
+      // so jump to the page first and finish once the annotation element exists
       if (continuousScroll && containerRef.current) {
-        setTimeout(() => {
-          const annotationElement = document.querySelector(`[data-annotation-id="${previousAnnotation!.id}"]`);
-          if (annotationElement) {
-            annotationElement.scrollIntoView({ behavior: 'smooth', block: 'center' });
-          }
-        }, 100);
+        pendingAnnotationScrollRef.current = previousAnnotation.id;
+        scrollToPage(previousAnnotation.page + 1, false);
+        updateVisibleRange();
       }
     }
-  }, [annotations, selectedAnnotations, continuousScroll, getSortedAnnotations]);
+  }, [annotations, selectedAnnotations, continuousScroll, getSortedAnnotations, scrollToPage, updateVisibleRange]);
 
-  if (!pdfData || !pdfUrl) {
+  if (!pdfUrl) {
     return (
       <div className="pdf-viewer-placeholder">
         <div className="placeholder-content">
@@ -733,7 +888,7 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
       <div className="pdf-container" ref={containerRef}>
         <div className="pdf-content-wrapper">
           {continuousScroll ? (
-            // Continuous scroll mode - render all pages
+            // Continuous scroll mode - mount only the pages around the viewport
             <div className="pdf-pages-continuous">
               {(() => {
                 console.log('Rendering Document with URL:', pdfUrl);
@@ -744,39 +899,64 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
                 onLoadSuccess={onDocumentLoadSuccess}
                 onLoadError={onDocumentLoadError}
                 loading={<div>Loading PDF...</div>}
-                key={pdfData ? 'pdf-loaded' : 'no-pdf'}
+                key={pdfUrl ? 'pdf-loaded' : 'no-pdf'}
               >
-                {Array.from(new Array(numPages), (el, index) => (
-                  <div key={`page_${index + 1}`} className="pdf-page-wrapper">
-                    <Page
-                      pageNumber={index + 1}
-                      scale={scale}
-                      renderTextLayer={false}
-                      renderAnnotationLayer={false}
-                      loading={<div>Loading page {index + 1}...</div>}
-                      error={<div>Error loading page {index + 1}</div>}
-                    />
-                    
-                    <AnnotationOverlaySimple
-                      annotations={annotations.filter(ann => ann.page === index)}
-                      scale={scale}
-                      onDrop={createPageDropHandler(index)}
-                      onAnnotationUpdate={handleAnnotationUpdate}
-                      onAnnotationUpdateMultiple={handleAnnotationUpdateMultiple}
-                      onAnnotationDelete={onAnnotationDelete}
-                      onAnnotationDeleteMultiple={handleAnnotationDeleteMultiple}
-                      isSettingsDialogOpen={isSettingsDialogOpen}
-                      onSettingsDialogOpenChange={setIsSettingsDialogOpen}
-                      annotationMode={annotationMode}
-                      selectedAnnotations={selectedAnnotations}
-                      onAnnotationSelect={handleAnnotationSelect}
-                      onClearSelection={handleClearSelection}
-                      onRemoveFromSelection={handleRemoveFromSelection}
-                      newlyAddedAnnotationId={newlyAddedAnnotationId}
-                      onClearNewlyAdded={() => setNewlyAddedAnnotationId(null)}
-                    />
-                  </div>
-                ))}
+                {numPages > 0 && (() => {
+                  // Visible pages, plus the neighbours mounted once the browser was idle
+                  const first = Math.max(visibleRange.first - OVERSCAN_PAGES, Math.min(visibleRange.first, prefetchRange.first));
+                  const last = Math.min(visibleRange.last + OVERSCAN_PAGES, Math.max(visibleRange.last, prefetchRange.last), numPages - 1);
+                  const mountedPages = Array.from({ length: last - first + 1 }, (el, offset) => first + offset);
+
+                  return (
+                    <div
+                      className="pdf-pages-virtual"
+                      style={{
+                        paddingTop: pageOffsets[first],
+                        paddingBottom: pageOffsets[numPages] - pageOffsets[last + 1],
+                      }}
+                    >
+                      {mountedPages.map(index => {
+                        const size = pageSizes[index] || defaultPageSize;
+                        return (
+                          <div
+                            key={`page_${index + 1}`}
+                            className="pdf-page-wrapper"
+                            style={{ width: size.width * scale, height: size.height * scale }}
+                          >
+                            <Page
+                              pageNumber={index + 1}
+                              scale={scale}
+                              renderTextLayer={false}
+                              renderAnnotationLayer={false}
+                              loading={<div>Loading page {index + 1}...</div>}
+                              error={<div>Error loading page {index + 1}</div>}
+                              onLoadSuccess={page => recordPageSize(index, page)}
+                            />
+                            
+                            <AnnotationOverlaySimple
+                              annotations={annotationsByPage.get(index) || []}
+                              scale={scale}
+                              onDrop={createPageDropHandler(index)}
+                              onAnnotationUpdate={handleAnnotationUpdate}
+                              onAnnotationUpdateMultiple={handleAnnotationUpdateMultiple}
+                              onAnnotationDelete={onAnnotationDelete}
+                              onAnnotationDeleteMultiple={handleAnnotationDeleteMultiple}
+                              isSettingsDialogOpen={isSettingsDialogOpen}
+                              onSettingsDialogOpenChange={setIsSettingsDialogOpen}
+                              annotationMode={annotationMode}
+                              selectedAnnotations={selectedAnnotations}
+                              onAnnotationSelect={handleAnnotationSelect}
+                              onClearSelection={handleClearSelection}
+                              onRemoveFromSelection={handleRemoveFromSelection}
+                              newlyAddedAnnotationId={newlyAddedAnnotationId}
+                              onClearNewlyAdded={() => setNewlyAddedAnnotationId(null)}
+                            />
+                          </div>
+                        );
+                      })}
+                    </div>
+                  );
+                })()}
               </Document>
             </div>
           ) : (
@@ -791,7 +971,7 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
                 onLoadSuccess={onDocumentLoadSuccess}
                 onLoadError={onDocumentLoadError}
                 loading={<div>Loading PDF...</div>}
-                key={pdfData ? 'pdf-loaded' : 'no-pdf'}
+                key={pdfUrl ? 'pdf-loaded' : 'no-pdf'}
               >
                 <Page
                   pageNumber={currentPage}
@@ -806,7 +986,7 @@ const PDFViewer: React.FC<PDFViewerProps> = ({
               </Document>
               
               <AnnotationOverlaySimple
-                annotations={annotations.filter(ann => ann.page === currentPage - 1)}
+                annotations={annotationsByPage.get(currentPage - 1) || []}
                 scale={scale}
                 onDrop={(x, y) => handlePageDrop(x, y, currentPage - 1)}
                 onAnnotationUpdate={handleAnnotationUpdate}